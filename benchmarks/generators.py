@@ -0,0 +1,145 @@
+'''Seeded, reproducible synthetic directory trees and index databases for the benchmarks.'''
+import datetime
+import os
+import random
+import string
+
+from idrive.db_sqlite import (
+    db_init,
+    db_cursor,
+    db_close_all,
+    db_connect,
+    db_file_row,
+    db_folder_row,
+    db_cursor_insert_files,
+    create_table,
+    get_local_host,
+)
+from idrive.evsweb import idrive_get_host
+
+
+NAME_CHARS = string.ascii_letters + string.digits + '_-'
+BATCH_SIZE = 10000
+MTIME = 1600000000
+
+
+def random_name(rng, length):
+    return ''.join(rng.choices(NAME_CHARS, k=max(1, length)))
+
+
+def __unique_name(rng, name_length, names):
+    # vary names around the requested length, like real trees do, without repeats in a folder.
+    while True:
+        name = random_name(rng, rng.randint(max(1, name_length // 2), name_length * 3 // 2 + 1))
+        if name not in names:
+            names.add(name)
+            return name
+
+
+def make_tree(root, fanout=4, depth=3, files=8, name_length=12, file_size=0, seed=0):
+    '''Create a tree of fanout subfolders per folder, depth levels deep, with files of file_size zeros per folder, and return (folders, files).'''
+    rng = random.Random(seed)
+    folders, count = [(root, 0)], 0
+    n_folders = 0
+    while folders:
+        folder, level = folders.pop()
+        os.makedirs(folder, exist_ok=True)
+        n_folders += 1
+        names = set()
+        for _ in range(files):
+            with open(os.path.join(folder, __unique_name(rng, name_length, names)), 'wb') as f:
+                f.truncate(file_size)
+            count += 1
+        if level < depth:
+            folders.extend((os.path.join(folder, __unique_name(rng, name_length, names)), level + 1) for _ in range(fanout))
+    return n_folders, count
+
+
+def tree_folders(n, fanout=8, name_length=12, seed=0):
+    '''Return n folder paths of a virtual tree, folder i being a child of folder (i - 1) // fanout.'''
+    rng = random.Random(seed)
+    paths, names = ['/'], set()
+    for i in range(1, n):
+        if (i - 1) % fanout == 0:
+            names = set()
+        paths.append(paths[(i - 1) // fanout] + __unique_name(rng, name_length, names) + '/')
+    return paths
+
+
+def tree_files(rows, fanout=8, files=100, name_length=12, seed=0):
+    '''Yield (folder, filename, size, mtime) of rows files of a virtual tree, files per folder.'''
+    rng = random.Random(seed)
+    folders = tree_folders(max(1, -(-rows // files)), fanout=fanout, name_length=name_length, seed=seed)
+    for i in range(rows):
+        if i % files == 0:
+            names = set()
+        yield folders[i // files], __unique_name(rng, name_length, names), rng.randint(1, 1 << 24), MTIME + rng.randint(0, 1 << 24)
+
+
+def __mutate(rows, match, seed):
+    # change the size of a fraction of the files, so only match of them still match.
+    rng = random.Random(seed + 1)
+    for folder, filename, size, mtime in rows:
+        yield folder, filename, size if rng.random() < match else size + 1, mtime
+
+
+def make_files_db(db_name, rows, match=0.9, fanout=8, files=100, name_length=12, seed=0):
+    '''Create an index database under the cache folder with rows remote files, and the same local files with the size of 1 - match of them changed.'''
+    db_init(db_name)
+    cursor = db_cursor()
+    remote_host, local_host = idrive_get_host(), get_local_host()
+    for host, device_id, source in (
+            (remote_host, 'D01', tree_files(rows, fanout, files, name_length, seed)),
+            (local_host, None, __mutate(tree_files(rows, fanout, files, name_length, seed), match, seed))):
+        batch, folder = [], None
+        for row in source:
+            if row[0] != folder:
+                folder = row[0]
+                batch.append(db_folder_row(folder, host=host, device_id=device_id))
+            batch.append(db_file_row(row[0], row[1], host=host, device_id=device_id, size=row[2], mtime=row[3]))
+            if len(batch) >= BATCH_SIZE:
+                db_cursor_insert_files(cursor, batch)
+                cursor.connection.commit()
+                batch = []
+        db_cursor_insert_files(cursor, batch)
+        cursor.connection.commit()
+    # checkpoint, so the database is a single file that can be copied.
+    db_close_all()
+
+
+def __insert_batches(cursor, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            cursor.executemany(sql, batch)
+            batch = []
+    cursor.executemany(sql, batch)
+    cursor.connection.commit()
+
+
+def make_dirent_db(db_path, rows, match=1.0, fanout=8, files=100, name_length=12, seed=0):
+    '''Create a DirEnt database of rows files, with the size of 1 - match of them changed.'''
+    connection = db_connect(db_path)
+    cursor = connection.cursor()
+    create_table(cursor, 'DirEnt')
+    __insert_batches(cursor, '''INSERT INTO DirEnt (path, type, size, mtime, mtime_ns) VALUES (?, ?, ?, ?, ?)''',
+        ((folder + filename, 0o100000, size, mtime, mtime * 1000000000)
+         for folder, filename, size, mtime in __mutate(tree_files(rows, fanout, files, name_length, seed), match, seed)))
+    connection.close()
+
+
+def make_ibfile_db(db_path, rows, match=1.0, fanout=8, files=100, name_length=12, seed=0):
+    '''Create an IDrive client ibfolder/ibfile database of rows files, quoted like the client does, with the size of 1 - match of them changed.'''
+    connection = db_connect(db_path)
+    cursor = connection.cursor()
+    create_table(cursor, 'ibfolder')
+    create_table(cursor, 'ibfile')
+    folders = tree_folders(max(1, -(-rows // files)), fanout=fanout, name_length=name_length, seed=seed)
+    __insert_batches(cursor, '''INSERT INTO ibfolder (DIRID, NAME, DIR_PARENT) VALUES (?, ?, ?)''',
+        ((i + 1, f"'{folder}'", (i - 1) // fanout + 1 if i else 0) for i, folder in enumerate(folders)))
+    lmd = lambda mtime: datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    __insert_batches(cursor, '''INSERT INTO ibfile (DIRID, NAME, FILE_LMD, FILE_SIZE, BACKUP_STATUS) VALUES (?, ?, ?, ?, ?)''',
+        ((i // files + 1, f"'{filename}'", lmd(mtime), size, 1)
+         for i, (folder, filename, size, mtime) in enumerate(__mutate(tree_files(rows, fanout, files, name_length, seed), match, seed))))
+    connection.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''Time the ingest, sync, diff and query scripts in subprocesses on synthetic data, and write the results as JSON.'''
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+SCENARIOS = ('ingest-local', 'sync', 'diff', 'query')
+
+
+def __git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def __run(args, env):
+    # wall time, and the cpu time of the child, of one script run.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], env=env, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return elapsed, (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+
+
+def __timed(name, rows, repeat, run, setup=None):
+    times, cpu = [], []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        elapsed, cpu_time = run()
+        times.append(elapsed)
+        cpu.append(cpu_time)
+    result = dict(
+        scenario=name,
+        rows=rows,
+        times=times,
+        cpu_times=cpu,
+        min=min(times),
+        median=statistics.median(times),
+        rows_per_sec=rows / min(times) if rows else None,
+    )
+    print(f"{name:14} {rows:>10} rows: min {result['min']:.3f}s, median {result['median']:.3f}s", file=sys.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--rows', type=str, default='10000,100000', help='Comma separated database sizes, in files.')
+    parser.add_argument('-s', '--scenarios', type=str, default=','.join(SCENARIOS), help=f'Comma separated scenarios: {",".join(SCENARIOS)}.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs per scenario and size.')
+    parser.add_argument('--fanout', type=int, default=8, help='Subfolders per folder.')
+    parser.add_argument('--depth', type=int, default=3, help='Folder levels of the ingest-local tree.')
+    parser.add_argument('--files', type=int, default=100, help='Files per folder.')
+    parser.add_argument('--name-length', type=int, default=12, help='Average file and folder name length.')
+    parser.add_argument('--match', type=float, default=0.9, help='Fraction of local files with a remote match.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, default=None, help='Scratch folder, kept when given. Default: a temporary folder.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON results file. Default: stdout.')
+    args = parser.parse_args()
+
+    sizes = [int(rows) for rows in args.rows.split(',') if rows]
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"invalid scenario: {name}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='idrive-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    cache = os.path.join(workdir, 'cache')
+    # the generators and the scripts share one cache folder for index databases.
+    os.environ['XDG_CACHE_HOME'] = cache
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.path.join(ROOT, 'src'), os.environ.get('PYTHONPATH')))))
+    import generators
+    from idrive.db_sqlite import get_local_host
+    script = lambda name: os.path.join(ROOT, 'scripts', name)
+    shape = dict(fanout=args.fanout, files=args.files, name_length=args.name_length, seed=args.seed)
+
+    results = []
+    try:
+        if 'ingest-local' in scenarios:
+            tree = os.path.join(workdir, 'tree')
+            if not os.path.isdir(tree):
+                generators.make_tree(tree, depth=args.depth, **shape)
+            db_path = os.path.join(cache, 'idrive-backup', 'ingest.db')
+            remove = lambda: os.path.exists(db_path) and os.remove(db_path)
+            n_files = args.files * sum(args.fanout ** level for level in range(args.depth + 1))
+            results.append(__timed('ingest-local', n_files, args.repeat,
+                lambda: __run([script('idrive-ingest-local'), '-db', 'ingest.db', tree], env), setup=remove))
+
+        for rows in sizes:
+            if 'sync' in scenarios:
+                name = f'files-{rows}.db'
+                source = os.path.join(cache, 'idrive-backup', name)
+                if not os.path.exists(source):
+                    generators.make_files_db(name, rows, match=args.match, **shape)
+                copy = lambda: shutil.copyfile(source, os.path.join(cache, 'idrive-backup', 'sync.db'))
+                results.append(__timed('sync', rows, args.repeat,
+                    lambda: __run([script('idrive-sync'), '-db', 'sync.db'], env), setup=copy))
+
+            if 'diff' in scenarios or 'query' in scenarios:
+                ibfile = os.path.join(workdir, f'ibfile-{rows}.db')
+                dirent = os.path.join(workdir, f'DirEnt-{rows}.db')
+                if not os.path.exists(ibfile):
+                    generators.make_ibfile_db(ibfile, rows, **shape)
+                if 'diff' in scenarios and not os.path.exists(dirent):
+                    generators.make_dirent_db(dirent, rows, match=args.match, **shape)
+            if 'diff' in scenarios:
+                results.append(__timed('diff', rows, args.repeat,
+                    lambda: __run([script('idrive-diff'), ibfile, dirent], env)))
+            if 'query' in scenarios:
+                results.append(__timed('query', rows, args.repeat,
+                    lambda: __run(['-m', 'idrive.query', '-db', ibfile], env)))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        commit=__git_commit(),
+        date=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        host=get_local_host(),
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        args=vars(args),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,12 @@
 from .db_sqlite import *
 from .evsweb import *
+from .scanner import *
+from .frontier import *
+from .crawler import *
+from .sync import *
+from .rescan import *
+from .checkpoint import *
+from .ingest import *
+from .hasher import *
+from .planner import *
+from .metrics import *
@@ -0,0 +1,75 @@
+import logging
+import time
+
+from .db_sqlite import db_cursor_select_checkpoint, db_cursor_update_checkpoint
+from .metrics import metrics_count
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_CHECKPOINT_ROWS = 10000
+DEFAULT_CHECKPOINT_SECONDS = 5.0
+# PRAGMA synchronous of a run: whether a commit waits for the disk, see
+# https://www.sqlite.org/pragma.html#pragma_synchronous
+DURABILITY_LEVELS = ('off', 'normal', 'full')
+
+
+class Checkpointer:
+    '''Group the commits of an ingest loop every rows rows or seconds seconds, recording the progress of the run of a job with each.'''
+    # as a folder is marked scanned in the same transaction as its files, a killed run resumes from the folders
+    # pending as of its last checkpoint, and a run of the same job following one that did not finish resumes it.
+
+    def __init__(self, cursor, job=None, host=None, device_id=None, rows=DEFAULT_CHECKPOINT_ROWS, seconds=DEFAULT_CHECKPOINT_SECONDS, durability=None):
+        self.cursor = cursor
+        self.job = job
+        self.host = host
+        self.device_id = device_id
+        self.rows = rows
+        self.seconds = seconds
+        self.durability = durability
+        if durability is not None:
+            assert durability in DURABILITY_LEVELS, durability
+            # the safety level cannot change within a transaction
+            cursor.connection.commit()
+            cursor.execute(f'''PRAGMA synchronous = {durability.upper()}''')
+        self.__pending = 0
+        self.__last = time.monotonic()
+        self.progress = None
+        self.resumed = False
+        if job is not None:
+            progress = db_cursor_select_checkpoint(cursor, job, host=host, device_id=device_id)
+            self.resumed = progress is not None and not progress['done']
+            if self.resumed:
+                log.info(f"Resuming {job} from its checkpoint of {time.ctime(progress['updated'])}: {progress['folders']} folders, {progress['rows']} rows")
+            else:
+                now = time.time()
+                progress = dict(started=now, updated=now, folders=0, rows=0, commits=0, done=False)
+            self.progress = progress
+
+    def add(self, folders=1, rows=0):
+        '''Count folders and rows written, and commit if a checkpoint is due. Returns whether it committed.'''
+        self.__pending += rows
+        if self.progress is not None:
+            self.progress['folders'] += folders
+            self.progress['rows'] += rows
+        if self.__pending >= self.rows or time.monotonic() - self.__last >= self.seconds:
+            self.commit()
+            return True
+        return False
+
+    def commit(self):
+        '''Record the progress and commit now.'''
+        if self.progress is not None:
+            self.progress['updated'] = time.time()
+            self.progress['commits'] += 1
+            db_cursor_update_checkpoint(self.cursor, self.job, self.progress, host=self.host, device_id=self.device_id)
+        self.cursor.connection.commit()
+        metrics_count('db_commits')
+        self.__pending = 0
+        self.__last = time.monotonic()
+
+    def finish(self):
+        '''Record the run as done, so the next run starts over, and commit.'''
+        if self.progress is not None:
+            self.progress['done'] = True
+        self.commit()
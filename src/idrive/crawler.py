@@ -0,0 +1,205 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+from .evsweb import idrive_browseFolder_iter, idrive_get_session
+from .frontier import Frontier
+from .metrics import metrics_over_memory
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_CRAWL_WORKERS = 8
+DEFAULT_CRAWL_RETRIES = 5
+DEFAULT_CRAWL_BACKOFF = 0.5
+DEFAULT_CRAWL_MAX_BACKOFF = 60.0
+DEFAULT_CRAWL_BATCH_SIZE = 1000
+
+# files is a batch of the entries of folder, done is set on its last batch.
+CrawlResult = collections.namedtuple('CrawlResult', ('folder', 'files', 'error', 'done'), defaults=(True,))
+
+
+class CrawlStats:
+    '''Thread safe counters for a remote crawl.'''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.start = time.monotonic()
+        self.folders = 0
+        self.files = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def add(self, folders=0, files=0, requests=0, retries=0, throttled=0, errors=0):
+        with self.__lock:
+            self.folders += folders
+            self.files += files
+            self.requests += requests
+            self.retries += retries
+            self.throttled += throttled
+            self.errors += errors
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return dict(
+            folders=self.folders,
+            files=self.files,
+            requests=self.requests,
+            retries=self.retries,
+            throttled=self.throttled,
+            errors=self.errors,
+            elapsed=elapsed,
+            folders_per_sec=self.folders / elapsed,
+        )
+
+
+class AdaptiveLimiter:
+    '''Limit concurrent requests, halving the limit when throttled and growing it back on success.'''
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.active = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while self.active >= int(self.limit):
+                self.__condition.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.__condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                log.debug(f"AdaptiveLimiter: throttled, limit is now {int(self.limit)}")
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.__condition.notify_all()
+
+
+def __status_code(e):
+    response = getattr(e, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def __is_throttled(e):
+    return isinstance(e, requests.HTTPError) and __status_code(e) in (429, 503)
+
+
+def __is_transient(e):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return isinstance(e, requests.HTTPError) and (__status_code(e) or 0) >= 500
+
+
+def __retry_after(e):
+    try:
+        return float(e.response.headers.get('retry-after', 0))
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def crawl_folder(device_id, folder, limiter=None, retries=DEFAULT_CRAWL_RETRIES, backoff=DEFAULT_CRAWL_BACKOFF,
+        max_backoff=DEFAULT_CRAWL_MAX_BACKOFF, stats=None, batch_size=DEFAULT_CRAWL_BATCH_SIZE):
+    '''Browse a remote folder and yield CrawlResults of up to batch_size entries as they stream in, the last one done.'''
+    limiter = limiter or AdaptiveLimiter(1)
+    stats = stats or CrawlStats()
+    attempt = delivered = 0
+    while True:
+        limiter.acquire()
+        stats.add(requests=1)
+        files, seen = [], 0
+        try:
+            for file_info in idrive_browseFolder_iter(device_id, folder):
+                seen += 1
+                # a retry skips the entries already yielded
+                if seen <= delivered:
+                    continue
+                files.append(file_info)
+                if len(files) >= batch_size:
+                    delivered += len(files)
+                    stats.add(files=len(files))
+                    yield CrawlResult(folder, files, None, False)
+                    files = []
+        except GeneratorExit:
+            limiter.release()
+            raise
+        except Exception as e:
+            throttled = __is_throttled(e)
+            limiter.release(throttled=throttled)
+            if throttled:
+                stats.add(throttled=1)
+            if attempt >= retries or not (throttled or __is_transient(e)):
+                log.warning(f"crawl_folder(): {folder}: {e!r}")
+                stats.add(errors=1)
+                yield CrawlResult(folder, [], e, True)
+                return
+            delay = max(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)), __retry_after(e))
+            log.debug(f"crawl_folder(): {folder}: {e!r}, retry {attempt + 1}/{retries} in {delay:.2f}s")
+            stats.add(retries=1)
+            attempt += 1
+            time.sleep(delay)
+            continue
+        limiter.release()
+        stats.add(folders=1, files=len(files))
+        yield CrawlResult(folder, files, None, True)
+        return
+
+
+def crawl_tree(frontier, device_id, workers=None, retries=DEFAULT_CRAWL_RETRIES, backoff=DEFAULT_CRAWL_BACKOFF, stats=None, pending=None,
+        batch_size=DEFAULT_CRAWL_BATCH_SIZE, max_memory=None):
+    '''Browse the folders of a Frontier, or a list of roots, concurrently and yield CrawlResults of up to batch_size entries as they stream in.'''
+    # past max_memory bytes of resident memory, no new folder is started until the ones being browsed are done
+    if not isinstance(frontier, Frontier):
+        frontier = Frontier(frontier)
+    workers = workers or DEFAULT_CRAWL_WORKERS
+    idrive_get_session(pool_size=workers)
+    limiter = AdaptiveLimiter(workers)
+    results = queue.Queue(maxsize=workers * 2)
+
+    def crawl(folder):
+        done = False
+        try:
+            for result in crawl_folder(device_id, folder, limiter, retries, backoff, stats=stats, batch_size=batch_size):
+                done = result.done
+                results.put(result)
+        except Exception as e:
+            # never leave a folder without its done result
+            if not done:
+                results.put(CrawlResult(folder, [], e, True))
+
+    running = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                slots = 1 if metrics_over_memory(max_memory) else workers * 2
+                for folder in frontier.pop(slots - running):
+                    executor.submit(crawl, folder)
+                    running += 1
+                if not running:
+                    break
+                result = results.get()
+                if result.done:
+                    running -= 1
+                # with a pending predicate, only the subfolders it accepts, given their path and listed entry, are browsed
+                folders = ((os.path.join(result.folder, file_info['name']) + '/', file_info) for file_info in result.files if file_info['is_dir'])
+                frontier.push(folder for folder, file_info in folders if pending is None or pending(folder, file_info))
+                yield result
+                if result.done:
+                    frontier.done(result.folder)
+        finally:
+            # unblock the workers of an abandoned crawl, so they can finish
+            while running:
+                if results.get().done:
+                    running -= 1
@@ -5,8 +5,12 @@ import logging
 import os
 import sqlite3 as SQL
 import socket
+import threading
+import time
 from typing import Optional
 
+from .metrics import MetricsTimer, metrics_count, metrics_enabled, metrics_timed
+
 
 log = logging.getLogger(__name__.split('.',1)[0])
 
@@ -274,6 +278,7 @@ class FileStatus(enum.IntEnum):
     ERROR = -2
     SCANNED = 0
     DIRTY = 1
+    MOVED = 2
 
 
 __hostname = None
@@ -303,6 +308,11 @@ def __get_cache_dir(create=False):
     return __cache_dir
 
 
+def get_cache_dir(create=False):
+    '''Return the folder of the databases and caches, or None if it does not exist and create is not set.'''
+    return __get_cache_dir(create)
+
+
 __db_name = None
 
 def __get_db_name(db_name=None, host=None, device_id=None):
@@ -318,6 +328,52 @@ def __get_db_name(db_name=None, host=None, device_id=None):
     return DEFAULT_DB_NAME
 
 
+# performance settings applied to every connection, see db_set_pragmas().
+DB_PRAGMAS = dict(
+    journal_mode='WAL',
+    synchronous='NORMAL',
+    mmap_size=256 * 1024 * 1024,
+    cache_size=-64 * 1024,  # in KiB when negative
+    temp_store='MEMORY',
+)
+
+__db_pragmas = dict(DB_PRAGMAS)
+
+def db_set_pragmas(**pragmas):
+    '''Change the PRAGMAs of connections opened from now on, None removes one.'''
+    for name, value in pragmas.items():
+        if value is None:
+            __db_pragmas.pop(name, None)
+        else:
+            __db_pragmas[name] = value
+
+
+class DBConnection(SQL.Connection):
+    '''Connection timing its commits, when metrics are enabled.'''
+
+    def commit(self):
+        with MetricsTimer('db_commit_seconds'):
+            super().commit()
+
+
+def db_connect(db_path, readonly=False, **pragmas):
+    '''Open a connection with the configured PRAGMAs, overridden by pragmas.'''
+    if readonly:
+        conn = SQL.connect(f"file:{db_path}?mode=ro", uri=True, factory=DBConnection)
+    else:
+        conn = SQL.connect(db_path, factory=DBConnection)
+    if metrics_enabled():
+        conn.set_trace_callback(lambda statement: metrics_count('db_statements'))
+    # read-only connections run alongside the WAL writer, and leave its journal mode alone
+    for name, value in dict(__db_pragmas, **pragmas).items():
+        if readonly and name == 'journal_mode':
+            continue
+        conn.execute(f'''PRAGMA {name} = {value}''')
+    if readonly:
+        conn.execute('''PRAGMA query_only = 1''')
+    return conn
+
+
 def __db_create(db_name, db_dir=None):
     if not db_dir:
         db_dir = __get_cache_dir(True)
@@ -327,13 +383,27 @@ def __db_create(db_name, db_dir=None):
         #if os.path.isfile(tmp_db_path):
         #    os.remove(tmp_db_path)
         #conn = SQL.connect(tmp_db_path)
-        conn = SQL.connect(db_path)
+        conn = db_connect(db_path)
         __db_create_tables(conn)
         #conn.close()
         #if os.path.isfile(db_path):
         #    os.remove(tmp_db_path)
         #else:
         #    os.rename(tmp_db_path, db_path)
+    else:
+        conn = db_connect(db_path)
+        __db_upgrade_tables(conn)
+    conn.close()
+
+
+def db_create(db_path):
+    '''Create a database at a path, or upgrade the one there.'''
+    __db_create(os.path.basename(db_path), os.path.dirname(db_path) or os.curdir)
+
+
+def db_get_path(host=None, device_id=None):
+    '''Return the path of the current database.'''
+    return os.path.join(__get_cache_dir() or '', __get_db_name(host=host, device_id=device_id))
 
 
 def db_init(db_name=None, host=None, device_id=None):
@@ -348,46 +418,225 @@ def db_init(db_name=None, host=None, device_id=None):
     __db_create(db_name)
 
 
-__db_connections = dict()
+# connections are reused per (db path, readonly) within each thread.
+__db_connections = threading.local()
 
-def db_get_conn(host=None, device_id=None):
-    key = (str(host) if host is not None else None, str(device_id) if device_id else None)
-    conn = __db_connections.get(key)
+def db_get_conn(host=None, device_id=None, readonly=False):
+    cache_dir = __get_cache_dir()
+    db_name = __get_db_name(host=host, device_id=device_id)
+    db_path = os.path.join(cache_dir or '', db_name)
+    connections = getattr(__db_connections, 'connections', None)
+    if connections is None:
+        connections = __db_connections.connections = dict()
+    key = (db_path, readonly)
+    conn = connections.get(key)
     if conn is None:
-        cache_dir = __get_cache_dir()
-        db_name = __get_db_name(host=host, device_id=device_id)
-        db_path = os.path.join(cache_dir, db_name)
         if not os.path.isfile(db_path):
-            raise
-        else:
-            conn = SQL.connect(db_path)
+            raise FileNotFoundError(db_path)
+        conn = connections[key] = db_connect(db_path, readonly=readonly)
     return conn
 
-def db_cursor(host=None, device_id=None):
-    conn = db_get_conn(host=host, device_id=device_id)
+def db_cursor(host=None, device_id=None, readonly=False):
+    conn = db_get_conn(host=host, device_id=device_id, readonly=readonly)
     cursor = conn.cursor()
     return cursor
 
+def db_close_all():
+    '''Close the connections of the current thread.'''
+    connections = getattr(__db_connections, 'connections', None) or dict()
+    while connections:
+        _, conn = connections.popitem()
+        conn.close()
+
 
 def __db_create_tables(conn):
     cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE files ('''
+    # folder paths are stored once, files refer to their folder by id.
+    cursor.execute('''CREATE TABLE folders ('''
+        ''' id integer primary key,'''
         ''' host text not null,'''
         ''' device_id text default "" not null,'''
-        ''' folder text default "" not null,'''
-        ''' filename text default "" not null,'''
+        ''' path text not null,'''
+        ''' parent_id integer references folders (id),'''
+        ''' code integer default -1 not null CHECK(typeof(code) = "integer"),'''
+        ''' ino integer default -1 not null CHECK(typeof(ino) = "integer"),'''
+        ''' dev integer default -1 not null CHECK(typeof(dev) = "integer"),'''
+        ''' size integer default -1 not null CHECK(typeof(size) = "integer"),'''
+        ''' mtime real default -1 not null CHECK(typeof(mtime) = "real"),'''
+        ''' mtime_ns integer default -1 not null,'''
+        ''' ctime_ns integer default -1 not null,'''
+        ''' dir_size integer default -1 not null,'''
+        ''' unique (host, device_id, path) )''') # TODO: sql 3.37.0+ supports STRICT
+    cursor.execute('''CREATE INDEX idx_folders_parent ON folders (parent_id)''')
+    cursor.execute('''CREATE INDEX idx_folders_pending ON folders (host, device_id, code)''')
+    # folders are also looked up by path without a device id, which the unique index cannot narrow.
+    cursor.execute('''CREATE INDEX idx_folders_path ON folders (path, host)''')
+    cursor.execute('''CREATE TABLE entries ('''
+        ''' folder_id integer not null references folders (id),'''
+        ''' filename text not null,'''
         ''' code integer default -1 not null CHECK(typeof(code) = "integer"),'''
         ''' ino integer default -1 not null CHECK(typeof(ino) = "integer"),'''
         ''' dev integer default -1 not null CHECK(typeof(dev) = "integer"),'''
         ''' size integer default -1 not null CHECK(typeof(size) = "integer"),'''
         ''' mtime real default -1 not null CHECK(typeof(mtime) = "real"),'''
-        ''' md5 text )''') # TODO: sql 3.37.0+ supports STRICT
-    cursor.execute('''CREATE INDEX idx_files_path ON files (folder ASC, filename ASC)''')
-    cursor.execute('''CREATE INDEX idx_files_host ON files (host ASC)''')
-    cursor.execute('''CREATE INDEX idx_files_device_id ON files (device_id ASC)''')
-    cursor.execute('''CREATE INDEX idx_files_folder ON files (folder ASC)''')
-    cursor.execute('''CREATE INDEX idx_files_filename ON files (filename ASC)''')
+        ''' md5 text,'''
+        ''' mtime_ns integer default -1 not null,'''
+        ''' ctime_ns integer default -1 not null,'''
+        ''' primary key (folder_id, filename) ) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX idx_entries_match ON entries (filename, size)''')
+    __db_create_files_view(cursor)
+    __db_create_hash_tables(cursor)
+    __db_create_rollup_tables(cursor)
+    __db_create_checkpoint_tables(cursor)
+    __db_create_import_tables(cursor)
+    conn.commit()
+
+
+def __db_create_hash_tables(cursor):
+    # content hashes by (dev, ino, size, mtime_ns), kept across rescans, renames and moves.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS hashes ('''
+        ''' dev integer not null,'''
+        ''' ino integer not null,'''
+        ''' size integer not null,'''
+        ''' mtime_ns integer not null,'''
+        ''' md5 text not null,'''
+        ''' primary key (dev, ino, size, mtime_ns) ) WITHOUT ROWID''')
+    # partial index over the files still waiting to be hashed.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_entries_unhashed ON entries (folder_id, filename) WHERE md5 IS NULL''')
+    # hardlinks of a local file, by inode. Remote files have no inode.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_entries_inode ON entries (dev, ino) WHERE ino != -1''')
+    # remote candidates of a moved file, bucketed by size.
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_entries_size_md5 ON entries (size, md5) WHERE md5 IS NOT NULL''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_entries_size_mtime ON entries (size, mtime)''')
+
+
+def __db_create_rollup_tables(cursor):
+    # totals of the files directly in each folder, kept by triggers, and of
+    # its whole subtree, brought up to date from the stale folders by
+    # db_cursor_update_rollups().
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rollups ('''
+        ''' folder_id integer primary key references folders (id),'''
+        ''' depth integer not null,'''
+        ''' files integer default 0 not null,'''
+        ''' bytes integer default 0 not null,'''
+        ''' dirty_files integer default 0 not null,'''
+        ''' dirty_bytes integer default 0 not null,'''
+        ''' tree_folders integer default 1 not null,'''
+        ''' tree_files integer default 0 not null,'''
+        ''' tree_bytes integer default 0 not null,'''
+        ''' tree_dirty_files integer default 0 not null,'''
+        ''' tree_dirty_bytes integer default 0 not null,'''
+        ''' stale integer default 1 not null )''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_rollups_stale ON rollups (depth) WHERE stale''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_folder_insert AFTER INSERT ON folders BEGIN '''
+        '''INSERT INTO rollups (folder_id, depth) VALUES (NEW.id, length(NEW.path) - length(replace(NEW.path, '/', ''))); END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_folder_delete AFTER DELETE ON folders BEGIN '''
+        '''DELETE FROM rollups WHERE folder_id = OLD.id; '''
+        '''UPDATE rollups SET stale = 1 WHERE folder_id = OLD.parent_id; END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_folder_parent AFTER UPDATE OF parent_id ON folders '''
+        '''WHEN OLD.parent_id IS NOT NEW.parent_id BEGIN '''
+        '''UPDATE rollups SET stale = 1 WHERE folder_id IN (OLD.parent_id, NEW.parent_id); END''')
+    # sizes of -1 are unknown and count as 0 bytes.
+    totals = lambda row, sign: '''files = files {sign} 1, bytes = bytes {sign} max({row}.size, 0), '''\
+        '''dirty_files = dirty_files {sign} ({row}.code = {dirty}), dirty_bytes = dirty_bytes {sign} ({row}.code = {dirty}) * max({row}.size, 0)'''.format(
+            row=row, sign=sign, dirty=int(FileStatus.DIRTY))
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_entry_insert AFTER INSERT ON entries BEGIN '''
+        '''UPDATE rollups SET {new}, stale = 1 WHERE folder_id = NEW.folder_id; END'''.format(new=totals('NEW', '+')))
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_entry_delete AFTER DELETE ON entries BEGIN '''
+        '''UPDATE rollups SET {old}, stale = 1 WHERE folder_id = OLD.folder_id; END'''.format(old=totals('OLD', '-')))
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS rollups_entry_update AFTER UPDATE OF size, code ON entries '''
+        '''WHEN (OLD.size, OLD.code) IS NOT (NEW.size, NEW.code) BEGIN '''
+        '''UPDATE rollups SET {old}, stale = 1 WHERE folder_id = OLD.folder_id; '''
+        '''UPDATE rollups SET {new} WHERE folder_id = NEW.folder_id; END'''.format(old=totals('OLD', '-'), new=totals('NEW', '+')))
+
+
+def __db_create_checkpoint_tables(cursor):
+    # progress of the runs of each job, written with every commit of a run.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS checkpoints ('''
+        ''' job text not null,'''
+        ''' host text not null,'''
+        ''' device_id text default "" not null,'''
+        ''' started real not null,'''
+        ''' updated real not null,'''
+        ''' folders integer default 0 not null,'''
+        ''' rows integer default 0 not null,'''
+        ''' commits integer default 0 not null,'''
+        ''' done integer default 0 not null,'''
+        ''' primary key (job, host, device_id) )''')
+
+
+def __db_create_import_tables(cursor):
+    # the LAST_UPDATED up to which each IDrive client database was imported.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS imports ('''
+        ''' source text not null,'''
+        ''' host text not null,'''
+        ''' device_id text default "" not null,'''
+        ''' last_updated text,'''
+        ''' imported real not null,'''
+        ''' primary key (source, host, device_id) )''')
+
+
+def __db_create_files_view(cursor):
+    # the flat files table of earlier versions, with folder rows as filename "".
+    cursor.execute('''CREATE VIEW files AS '''
+        '''SELECT id AS folder_id, host, device_id, path AS folder, "" AS filename, code, ino, dev, size, mtime, '''
+        '''NULL AS md5, mtime_ns, ctime_ns, dir_size FROM folders '''
+        '''UNION ALL '''
+        '''SELECT folders.id, folders.host, folders.device_id, folders.path, entries.filename, entries.code, entries.ino, '''
+        '''entries.dev, entries.size, entries.mtime, entries.md5, entries.mtime_ns, entries.ctime_ns, -1 '''
+        '''FROM entries JOIN folders ON entries.folder_id = folders.id''')
+
+
+def __db_upgrade_tables(conn):
+    cursor = conn.cursor()
+    cursor.execute('''SELECT type FROM sqlite_master WHERE name = "files"''')
+    row = cursor.fetchone()
+    if row is not None and row[0] == 'table':
+        __db_migrate_files_table(conn)
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_folders_path ON folders (path, host)''')
+    # databases created before content hashing have no hash cache.
+    __db_create_hash_tables(cursor)
+    # nor, before subtree totals, rollups.
+    cursor.execute('''SELECT 1 FROM sqlite_master WHERE name = "rollups"''')
+    if cursor.fetchone() is None:
+        __db_create_rollup_tables(cursor)
+        db_cursor_rebuild_rollups(cursor)
+    # nor, before group commits, progress records.
+    __db_create_checkpoint_tables(cursor)
+    # nor, before client database imports, their records.
+    __db_create_import_tables(cursor)
+    conn.commit()
+
+
+def __db_migrate_files_table(conn):
+    # move the flat files table of earlier versions into folders and entries.
+    log.info("Migrating files table to folders and entries.")
+    cursor = conn.cursor()
+    columns = set(name for _, name, *_ in cursor.execute('''PRAGMA table_info(files)'''))
+    column = lambda name: name if name.rsplit('.', 1)[-1] in columns else '''-1'''
+    conn.create_function('parent_folder', 1, __parent_folder, deterministic=True)
+    cursor.execute('''ALTER TABLE files RENAME TO files_v1''')
+    __db_create_tables(conn)
+    cursor.execute('''INSERT OR IGNORE INTO folders (host, device_id, path, code, ino, dev, size, mtime, mtime_ns, ctime_ns, dir_size) '''
+        '''SELECT host, device_id, folder, code, ino, dev, size, mtime, {mtime_ns}, {ctime_ns}, {dir_size} FROM files_v1 WHERE filename = ""'''.format(
+            mtime_ns = column('mtime_ns'),
+            ctime_ns = column('ctime_ns'),
+            dir_size = column('dir_size'),
+        ))
+    cursor.execute('''INSERT OR IGNORE INTO folders (host, device_id, path) '''
+        '''SELECT DISTINCT host, device_id, folder FROM files_v1 WHERE filename != ""''')
+    cursor.execute('''UPDATE folders SET parent_id = (SELECT parent.id FROM folders AS parent '''
+        '''WHERE parent.host = folders.host AND parent.device_id = folders.device_id AND parent.path = parent_folder(folders.path))''')
+    cursor.execute('''INSERT OR REPLACE INTO entries (folder_id, filename, code, ino, dev, size, mtime, md5, mtime_ns, ctime_ns) '''
+        '''SELECT folders.id, filename, files_v1.code, files_v1.ino, files_v1.dev, files_v1.size, files_v1.mtime, md5, {mtime_ns}, {ctime_ns} '''
+        '''FROM files_v1 JOIN folders ON folders.host = files_v1.host AND folders.device_id = files_v1.device_id AND folders.path = files_v1.folder '''
+        '''WHERE filename != ""'''.format(
+            mtime_ns = column('files_v1.mtime_ns'),
+            ctime_ns = column('files_v1.ctime_ns'),
+        ))
+    cursor.execute('''DROP TABLE files_v1''')
     conn.commit()
+    cursor.execute('''VACUUM''')
 
 
 def __folder_path(folder):
@@ -398,11 +647,10 @@ def __folder_path(folder):
 
 
 def db_list_device_ids_by_host():
-    cursor = db_cursor()
-    fields = ('host', 'device_id')
-    result = db_cursor_select_fetchall_files(cursor, fields=fields, distinct=True)
+    cursor = db_cursor(readonly=True)
+    cursor.execute('''SELECT DISTINCT host, device_id FROM folders''')
     hosts = dict()
-    for host, device_id in result:
+    for host, device_id in cursor.fetchall():
         if host not in hosts:
             hosts[host] = []
         hosts[host].append(device_id)
@@ -418,6 +666,7 @@ def db_filter_files_by_status(status, fields: tuple, host=None, device_id=None):
     return cursor
 
 
+@metrics_timed('db_seconds')
 def db_cursor_select_fetchall_files(cursor, fields: tuple, where: Optional[dict] = None, distinct: bool = False):
     fields = ','.join(fields)
     conditions = where and ' AND '.join(map(lambda key: f'{key} = :{key}', where.keys()))
@@ -430,24 +679,7 @@ def db_cursor_select_fetchall_files(cursor, fields: tuple, where: Optional[dict]
     return result
 
 
-def __db_cursor_insert_file(cursor, data: dict):
-    primary_keys = set(('host', 'device_id', 'folder', 'filename'))
-    keys = set(data.keys()) & primary_keys
-    columns = ','.join(keys)
-    variables = ','.join(map(lambda key: ':' + key, keys))
-    conditions = ' AND '.join(map(lambda key: f'{key} = :{key}', keys))
-    cursor.execute(
-        '''INSERT INTO files ({columns}) '''
-        '''SELECT {variables} WHERE NOT EXISTS '''
-        '''(SELECT {columns} FROM files WHERE {conditions})'''
-        ''.format(columns=columns, variables=variables, conditions=conditions), data)
-
-    keys = set(data.keys()) - primary_keys
-    if keys:
-        predicates = ', '.join(map(lambda key: f'{key} = :{key}', keys))
-        cursor.execute('''UPDATE files SET {predicates} WHERE {conditions}'''.format(predicates=predicates, conditions=conditions), data)
-
-
+@metrics_timed('db_seconds')
 def db_cursor_select_fetchone_file(cursor, fields: tuple, where: dict):
     fields = ','.join(fields)
     conditions = ' AND '.join(map(lambda key: f'{key} = :{key}', where.keys()))
@@ -456,56 +688,117 @@ def db_cursor_select_fetchone_file(cursor, fields: tuple, where: dict):
     return result[0] if result is not None else None
 
 
+@metrics_timed('db_seconds')
 def db_cursor_update_file(cursor, data: dict, where: dict):
-    conditions = ' AND '.join(map(lambda key: f'{key} = :{key}', where.keys()))
+    # folder rows (filename "") live in folders, file rows in entries under their folder's id.
+    where = dict(where)
+    folder_where = {key: where.pop(key) for key in ('host', 'device_id', 'folder') if key in where}
+    folder_conditions = [f'{"path" if key == "folder" else key} = :{key}' for key in folder_where]
     predicates = ', '.join(map(lambda key: f'{key} = :{key}', data.keys()))
-    values = {**data, **where}
-    cursor.execute('''UPDATE files SET {predicates} WHERE {conditions}'''.format(predicates=predicates, conditions=conditions), values)
+    values = {**data, **folder_where, **where}
+    if where.get('filename') == "":
+        del where['filename']
+        table, conditions = 'folders', folder_conditions
+    else:
+        table = 'entries'
+        conditions = folder_conditions and [f'folder_id IN (SELECT id FROM folders WHERE {" AND ".join(folder_conditions)})']
+    conditions = ' AND '.join([*conditions, *map(lambda key: f'{key} = :{key}', where.keys())])
+    cursor.execute('''UPDATE {table} SET {predicates} {where}'''.format(
+        table = table,
+        predicates = predicates,
+        where = conditions and f'WHERE {conditions}' or '',
+    ), values)
 
 
-def db_cursor_insert_file(cursor, folder, filename, host=None, device_id=None, st_info=None, size=None, mtime=None):
-    '''Stat file and add to database.'''
+FILES_ROW_COLUMNS = ('host', 'device_id', 'folder', 'filename', 'code', 'ino', 'dev', 'size', 'mtime', 'mtime_ns', 'ctime_ns')
+
+# existing folder rows are left untouched, so re-adding a folder keeps its status.
+__db_insert_folder_sql = '''INSERT INTO folders (host, device_id, path, parent_id, code, ino, dev, size, mtime, mtime_ns, ctime_ns) '''\
+    '''VALUES (?, ?, ?, (SELECT id FROM folders WHERE host = ? AND device_id = ? AND path = ?), ?, ?, ?, ?, ?, ?, ?) '''\
+    '''ON CONFLICT (host, device_id, path) DO NOTHING'''
+
+# a single statement for every row, so sqlite compiles it once per connection.
+# re-added files go back to the default status, and keep their hash only when unchanged.
+__db_upsert_entries_conflict_sql = '''ON CONFLICT (folder_id, filename) DO UPDATE SET '''\
+    '''md5 = CASE WHEN (entries.ino, entries.size, entries.mtime, entries.mtime_ns) IS (excluded.ino, excluded.size, excluded.mtime, excluded.mtime_ns) '''\
+    '''THEN entries.md5 ELSE NULL END, {predicates}'''.format(
+        predicates = ', '.join(map(lambda key: f'{key} = excluded.{key}', FILES_ROW_COLUMNS[4:])),
+    )
+__db_upsert_entries_sql = '''INSERT INTO entries (folder_id, {columns}) VALUES (?, {variables}) {conflict}'''.format(
+    columns = ','.join(FILES_ROW_COLUMNS[3:]),
+    variables = ','.join('?' * len(FILES_ROW_COLUMNS[3:])),
+    conflict = __db_upsert_entries_conflict_sql,
+)
+
+
+def db_file_row(folder, filename, host=None, device_id=None, st_info=None, size=None, mtime=None):
+    '''Return a row tuple of FILES_ROW_COLUMNS for a file.'''
     assert host
     assert st_info is not None or (size is not None and mtime is not None)
     assert folder and filename
-    data = dict(
-        host=host,
-        folder=__folder_path(folder),
-        filename=filename,
-        code=FileStatus.DEFAULT,
-    )
-    if device_id:
-        data.update(dict(
-            device_id=device_id,
-        ))
     if st_info is not None:
-        data.update(dict(
-            ino=st_info.st_ino,
-            dev=st_info.st_dev,
-            size=st_info.st_size,
-            mtime=st_info.st_mtime,
-        ))
+        ino, dev, size, mtime = st_info.st_ino, st_info.st_dev, st_info.st_size, st_info.st_mtime
+        mtime_ns, ctime_ns = st_info.st_mtime_ns, st_info.st_ctime_ns
     else:
-        data.update(dict(
-            size=size,
-            mtime=mtime,
-        ))
-    __db_cursor_insert_file(cursor, data)
+        ino, dev, mtime_ns, ctime_ns = -1, -1, -1, -1
+    return (host, device_id or "", __folder_path(folder), filename, FileStatus.DEFAULT, ino, dev, size, float(mtime), mtime_ns, ctime_ns)
 
 
-def db_cursor_insert_folder(cursor, folder, host=None, device_id=None):
-    '''Add folder into database.'''
+def db_folder_row(folder, host=None, device_id=None):
+    '''Return a row tuple of FILES_ROW_COLUMNS for a folder.'''
     assert host
     assert folder
-    data = dict(
-        host=host,
-        folder=__folder_path(folder),
-    )
-    if device_id:
-        data.update(dict(
-            device_id=device_id,
-        ))
-    __db_cursor_insert_file(cursor, data)
+    return (host, device_id or "", __folder_path(folder), "", FileStatus.DEFAULT, -1, -1, -1, -1.0, -1, -1)
+
+
+def __parent_folder(folder):
+    return folder[:folder.rindex('/', 0, -1) + 1] if folder != '/' else None
+
+
+def __db_folder_values(row):
+    host, device_id, folder = row[:3]
+    return (host, device_id, folder, host, device_id, __parent_folder(folder), *row[4:])
+
+
+def __db_cursor_folder_ids(cursor, keys):
+    # map (host, device_id, folder) to folder ids, adding folders not seen before.
+    folder_ids = dict()
+    for key in keys:
+        cursor.execute('''SELECT id FROM folders WHERE host = ? AND device_id = ? AND path = ?''', key)
+        result = cursor.fetchone()
+        if result is None:
+            cursor.execute(__db_insert_folder_sql, __db_folder_values(db_folder_row(key[2], host=key[0], device_id=key[1])))
+            result = (cursor.lastrowid,)
+        folder_ids[key] = result[0]
+    return folder_ids
+
+
+@metrics_timed('db_seconds')
+def db_cursor_insert_files(cursor, rows):
+    '''Insert or update an iterable of file and folder rows with one executemany per table.'''
+    rows = list(rows)
+    cursor.executemany(__db_insert_folder_sql, (__db_folder_values(row) for row in rows if row[3] == ""))
+    count = cursor.rowcount
+    files = [row for row in rows if row[3] != ""]
+    if files:
+        folder_ids = __db_cursor_folder_ids(cursor, set(row[:3] for row in files))
+        cursor.executemany(__db_upsert_entries_sql, ((folder_ids[row[:3]], *row[3:]) for row in files))
+        count += cursor.rowcount
+    return count
+
+
+@metrics_timed('db_seconds')
+def db_cursor_insert_file(cursor, folder, filename, host=None, device_id=None, st_info=None, size=None, mtime=None):
+    '''Stat file and add to database.'''
+    row = db_file_row(folder, filename, host=host, device_id=device_id, st_info=st_info, size=size, mtime=mtime)
+    db_cursor_insert_files(cursor, (row,))
+
+
+@metrics_timed('db_seconds')
+def db_cursor_insert_folder(cursor, folder, host=None, device_id=None):
+    '''Add folder into database.'''
+    row = db_folder_row(folder, host=host, device_id=device_id)
+    db_cursor_insert_files(cursor, (row,))
 
 
 def db_any_file_path(filename, folder=None, host=None, device_id=None, **kwargs):
@@ -566,6 +859,15 @@ def db_fetch_next_folder(host=None, device_id=None):
     return result
 
 
+@metrics_timed('db_seconds')
+def db_cursor_select_pending_folders(cursor, host=None, device_id=None, limit=-1):
+    '''Return a list of up to limit unscanned folder paths.'''
+    assert host
+    cursor.execute('''SELECT path FROM folders WHERE host = ? AND device_id = ? AND code = ? LIMIT ?''',
+        (host, device_id or "", FileStatus.DEFAULT, limit))
+    return [folder for folder, in cursor]
+
+
 def db_has_folder(folder, host=None, device_id=None):
     '''Find a matching folder and return bool.'''
     assert host
@@ -580,6 +882,7 @@ def db_insert_folder(folder, host=None, device_id=None):
     cursor.connection.commit()
 
 
+@metrics_timed('db_seconds')
 def db_cursor_update_folder_size(cursor, folder, size, host=None, device_id=None):
     assert host
     # update the size of the folder in the database with the number of files/folders
@@ -598,6 +901,7 @@ def db_cursor_update_folder_size(cursor, folder, size, host=None, device_id=None
     db_cursor_update_file(cursor, data, where)
 
 
+@metrics_timed('db_seconds')
 def db_cursor_update_folder_status(cursor, folder, status, host=None, device_id=None):
     assert host
     # update the code of the folder in the database with the number of files/folders
@@ -616,6 +920,124 @@ def db_cursor_update_folder_status(cursor, folder, status, host=None, device_id=
     db_cursor_update_file(cursor, data, where)
 
 
+@metrics_timed('db_seconds')
+def db_cursor_update_folder_stat(cursor, folder, st_info, host=None, device_id=None):
+    assert host
+    # remember the folder's own metadata, to skip it on incremental rescans while unchanged
+    data = dict(
+        ino=st_info.st_ino,
+        dev=st_info.st_dev,
+        mtime=st_info.st_mtime,
+        mtime_ns=st_info.st_mtime_ns,
+        ctime_ns=st_info.st_ctime_ns,
+    )
+    where = dict(
+        host=host,
+        folder=__folder_path(folder),
+        filename="",
+    )
+    if device_id:
+        where.update(dict(
+            device_id=device_id,
+        ))
+    db_cursor_update_file(cursor, data, where)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_folder_status(cursor, folder, host=None, device_id=None):
+    '''Find a matching folder and return its status, or None.'''
+    assert host
+    cursor.execute('''SELECT code FROM folders WHERE host = ? AND device_id = ? AND path = ?''',
+        (host, device_id or "", __folder_path(folder)))
+    result = cursor.fetchone()
+    return result[0] if result is not None else None
+
+
+@metrics_timed('db_seconds')
+def db_cursor_update_folder_listings(cursor, rows, host=None, device_id=None):
+    '''Record (folder, mtime, dir_size) of folders as listed by their parent, resetting the status of those changed.'''
+    assert host
+    cursor.executemany('''UPDATE folders SET code = CASE WHEN (mtime, dir_size) IS (?, ?) THEN code ELSE ? END, mtime = ?, dir_size = ? '''
+        '''WHERE host = ? AND device_id = ? AND path = ?''',
+        ((float(mtime), dir_size, FileStatus.DEFAULT, float(mtime), dir_size, host, device_id or "", __folder_path(folder)) for folder, mtime, dir_size in rows))
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_folder_listing(cursor, folder, host=None, device_id=None):
+    '''Find a matching folder and return its (code, mtime, dir_size), or None.'''
+    assert host
+    cursor.execute('''SELECT code, mtime, dir_size FROM folders WHERE host = ? AND device_id = ? AND path = ?''',
+        (host, device_id or "", __folder_path(folder)))
+    return cursor.fetchone()
+
+
+@metrics_timed('db_seconds')
+def db_cursor_count_subtree_folders(cursor, folder, host=None, device_id=None):
+    '''Return the number of folders in a subtree, including itself.'''
+    assert host
+    folder = __folder_path(folder)
+    # every path under folder sorts between "folder/" and "folder0".
+    cursor.execute('''SELECT COUNT(*) FROM folders WHERE host = ? AND device_id = ? AND path >= ? AND path < ?''',
+        (host, device_id or "", folder, folder[:-1] + '0'))
+    return cursor.fetchone()[0]
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_scanned_folders(cursor, host=None, device_id=None):
+    '''Return a cursor over (folder, code, dev, ino, mtime_ns, ctime_ns) of all scanned or failed folders.'''
+    assert host
+    cursor.execute('''SELECT path, code, dev, ino, mtime_ns, ctime_ns FROM folders '''
+        '''WHERE host = ? AND device_id = ? AND code IN (?, ?)''',
+        (host, device_id or "", FileStatus.SCANNED, FileStatus.ERROR))
+    return cursor
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_folder_filenames(cursor, folder, host=None, device_id=None):
+    '''Return the set of filenames recorded in a folder.'''
+    assert host
+    cursor.execute('''SELECT filename FROM entries WHERE folder_id = (SELECT id FROM folders WHERE host = ? AND device_id = ? AND path = ?)''',
+        (host, device_id or "", __folder_path(folder)))
+    return set(filename for filename, in cursor)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_subfolders(cursor, folder, host=None, device_id=None):
+    '''Return the set of paths of the subfolders recorded in a folder.'''
+    assert host
+    folder = __folder_path(folder)
+    cursor.execute('''SELECT path FROM folders WHERE parent_id = (SELECT id FROM folders WHERE host = ? AND device_id = ? AND path = ?)''',
+        (host, device_id or "", folder))
+    return set(path for path, in cursor)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_reset_folders(cursor, folders, host=None, device_id=None):
+    '''Set folders back to the default status, so they are scanned again.'''
+    assert host
+    cursor.executemany('''UPDATE folders SET code = ? WHERE host = ? AND device_id = ? AND path = ?''',
+        ((FileStatus.DEFAULT, host, device_id or "", __folder_path(folder)) for folder in folders))
+
+
+@metrics_timed('db_seconds')
+def db_cursor_delete_subtrees(cursor, folders, host=None, device_id=None):
+    '''Delete folders with all the folders and files below them.'''
+    assert host
+    # every path under folder sorts between "folder/" and "folder0".
+    folders = [(host, device_id or "", folder, folder[:-1] + '0') for folder in map(__folder_path, folders)]
+    cursor.executemany('''DELETE FROM entries WHERE folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ? AND path >= ? AND path < ?)''', folders)
+    cursor.executemany('''DELETE FROM folders WHERE host = ? AND device_id = ? AND path >= ? AND path < ?''', folders)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_delete_files(cursor, folder, filenames, host=None, device_id=None):
+    '''Delete files of a folder by filename.'''
+    assert host
+    folder = __folder_path(folder)
+    cursor.executemany('''DELETE FROM entries WHERE folder_id = (SELECT id FROM folders WHERE host = ? AND device_id = ? AND path = ?) AND filename = ?''',
+        ((host, device_id or "", folder, filename) for filename in filenames if filename))
+
+
 def db_update_file_status(folder, filename, status, host=None, device_id=None):
     '''Update file status.'''
     assert host
@@ -636,17 +1058,337 @@ def db_update_file_status(folder, filename, status, host=None, device_id=None):
     cursor.connection.commit()
 
 
-def db_update_file_path_md5(path):
-    raise NotImplemented
+# files of the same content when both have an md5.
+__db_same_md5_sql = '''(remote.md5 IS NULL OR {local}.md5 IS NULL OR remote.md5 = {local}.md5)'''
+
+
+def __db_unmatched_files_where(remote_device_ids):
+    # local files without a remote file of the same name, size and known md5
+    # on any remote device, nor a hardlink of the same device with one.
+    return '''entries.folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?) AND entries.code = ? '''\
+        '''AND NOT EXISTS (SELECT 1 FROM entries AS remote JOIN folders AS remote_folder ON remote.folder_id = remote_folder.id '''\
+        '''WHERE remote.filename = entries.filename AND remote.size = entries.size AND {same_md5} '''\
+        '''AND remote_folder.host = ? AND remote_folder.device_id IN ({devices})) '''\
+        '''AND NOT (entries.ino != -1 AND EXISTS (SELECT 1 FROM entries AS link '''\
+        '''JOIN entries AS remote ON remote.filename = link.filename AND remote.size = link.size AND {same_link_md5} '''\
+        '''JOIN folders AS remote_folder ON remote.folder_id = remote_folder.id '''\
+        '''WHERE link.dev = entries.dev AND link.ino = entries.ino AND link.ino != -1 '''\
+        '''AND (link.size, link.mtime_ns) = (entries.size, entries.mtime_ns) AND link.filename != entries.filename '''\
+        '''AND link.folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?) '''\
+        '''AND remote_folder.host = ? AND remote_folder.device_id IN ({devices})))'''.format(
+            devices = ','.join('?' * len(remote_device_ids)),
+            same_md5 = __db_same_md5_sql.format(local='entries'),
+            same_link_md5 = __db_same_md5_sql.format(local='link'),
+        )
+
+
+def __db_moved_candidates_sql(remote_device_ids):
+    # pairs of an unmatched local file and a remote file of the same size,
+    # with its md5, or else with its mtime to the second, as lmds have no
+    # fraction. Only remote files without a local file of their name and
+    # size, that is gone from where it was backed up, are candidates.
+    # Empty files are all alike, and never moved.
+    # CROSS JOIN keeps the size bucket as the outer loop.
+    branch = '''SELECT entries.folder_id AS folder_id, entries.filename AS filename, entries.size AS size, '''\
+        '''remote.folder_id AS remote_folder_id, remote.filename AS remote_filename, coalesce(remote.md5 = entries.md5, 0) AS same_md5 '''\
+        '''FROM entries CROSS JOIN entries AS remote CROSS JOIN folders AS remote_folder ON remote.folder_id = remote_folder.id '''\
+        '''WHERE {unmatched} AND entries.size > 0 AND remote.size = entries.size AND {{condition}} '''\
+        '''AND remote_folder.host = ? AND remote_folder.device_id IN ({devices}) '''\
+        '''AND NOT EXISTS (SELECT 1 FROM entries AS twin WHERE twin.filename = remote.filename AND twin.size = remote.size AND {same_twin_md5} '''\
+        '''AND twin.folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?))'''.format(
+            unmatched = __db_unmatched_files_where(remote_device_ids),
+            devices = ','.join('?' * len(remote_device_ids)),
+            same_twin_md5 = __db_same_md5_sql.format(local='twin'),
+        )
+    # one branch per size bucketed index, so neither condition is an OR.
+    # md5 matches first, the surest pairs.
+    return '''SELECT * FROM ({by_md5} UNION {by_mtime}) ORDER BY same_md5 DESC, folder_id, filename, remote_folder_id, remote_filename'''.format(
+        by_md5 = branch.format(condition='''remote.md5 = entries.md5'''),
+        by_mtime = branch.format(condition='''remote.mtime > entries.mtime - 1 AND remote.mtime < entries.mtime + 1 AND ''' + __db_same_md5_sql.format(local='entries')),
+    )
+
+
+@metrics_timed('db_seconds')
+def db_cursor_count_files_by_status(cursor, status, host=None, device_id=None):
+    '''Return the number of files with a status.'''
+    assert host
+    cursor.execute('''SELECT COUNT(*) FROM entries JOIN folders ON entries.folder_id = folders.id '''
+        '''WHERE folders.host = ? AND folders.device_id = ? AND entries.code = ?''',
+        (host, device_id or "", status))
+    return cursor.fetchone()[0]
+
+
+@metrics_timed('db_seconds')
+def db_cursor_mark_unmatched_files(cursor, status, local_host=None, local_device_id=None, remote_host=None, remote_device_ids=(), dry_run=False):
+    '''Set the status of the DEFAULT local files without a remote match with one anti-join, and return a cursor over their (folder, filename).'''
+    assert local_host and remote_host
+    remote_device_ids = [device_id or "" for device_id in remote_device_ids]
+    where = __db_unmatched_files_where(remote_device_ids)
+    values = (local_host, local_device_id or "", FileStatus.DEFAULT, remote_host, *remote_device_ids,
+        local_host, local_device_id or "", remote_host, *remote_device_ids)
+    folder = '''(SELECT path FROM folders WHERE id = entries.folder_id)'''
+    if dry_run:
+        cursor.execute('''SELECT {folder}, filename FROM entries WHERE {where}'''.format(folder=folder, where=where), values)
+    else:
+        cursor.execute('''UPDATE entries SET code = ? WHERE {where} RETURNING {folder}, filename'''.format(folder=folder, where=where), (status, *values))
+    return cursor
+
+
+@metrics_timed('db_seconds')
+def db_cursor_mark_moved_files(cursor, status, local_host=None, local_device_id=None, remote_host=None, remote_device_ids=(), dry_run=False):
+    '''Set the status of the unmatched local files found under another name on a remote device, and return a list of their (folder, filename, size, remote path).'''
+    # candidates are assigned greedily, best pair first: a pair is taken when neither of its files
+    # is taken yet, so each remote file stands for one local file at most. With dry_run, the files
+    # are paired but not updated.
+    assert local_host and remote_host
+    remote_device_ids = [device_id or "" for device_id in remote_device_ids]
+    values = (local_host, local_device_id or "", FileStatus.DEFAULT, remote_host, *remote_device_ids,
+        local_host, local_device_id or "", remote_host, *remote_device_ids, remote_host, *remote_device_ids, local_host, local_device_id or "")
+    pairs, local_files, remote_files = [], set(), set()
+    for folder_id, filename, size, remote_folder_id, remote_filename, _ in cursor.execute(__db_moved_candidates_sql(remote_device_ids), values * 2).fetchall():
+        if (folder_id, filename) in local_files or (remote_folder_id, remote_filename) in remote_files:
+            continue
+        local_files.add((folder_id, filename))
+        remote_files.add((remote_folder_id, remote_filename))
+        pairs.append((folder_id, filename, size, remote_folder_id, remote_filename))
+    if not dry_run:
+        cursor.executemany('''UPDATE entries SET code = ? WHERE folder_id = ? AND filename = ?''',
+            ((status, folder_id, filename) for folder_id, filename, *_ in pairs))
+    paths = dict()
+    for folder_id in set(pair[0] for pair in pairs).union(pair[3] for pair in pairs):
+        paths[folder_id], = cursor.execute('''SELECT path FROM folders WHERE id = ?''', (folder_id,)).fetchone()
+    return [(paths[folder_id], filename, size, paths[remote_folder_id] + remote_filename) for folder_id, filename, size, remote_folder_id, remote_filename in pairs]
+
+
+def db_update_file_path_md5(path, md5, host=None, device_id=None):
+    '''Update file md5.'''
+    assert host
+    cursor = db_cursor(host=host, device_id=device_id)
+    folder, filename = os.path.split(path)
+    data = dict(
+        md5=md5,
+    )
+    where = dict(
+        host=host,
+        folder=__folder_path(folder),
+        filename=filename,
+    )
+    if device_id:
+        where.update(dict(
+            device_id=device_id,
+        ))
+    db_cursor_update_file(cursor, data, where)
+    cursor.connection.commit()
+
+
+@metrics_timed('db_seconds')
+def db_cursor_fill_cached_md5s(cursor, host=None, device_id=None):
+    '''Copy the md5 of unhashed files from the hash cache, and return the number of files filled.'''
+    assert host
+    cursor.execute('''UPDATE entries SET md5 = hashes.md5 FROM hashes '''
+        '''WHERE entries.md5 IS NULL AND (entries.dev, entries.ino, entries.size, entries.mtime_ns) = (hashes.dev, hashes.ino, hashes.size, hashes.mtime_ns) '''
+        '''AND entries.folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?)''',
+        (host, device_id or ""))
+    return cursor.rowcount
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_unhashed_files(cursor, host=None, device_id=None, after=None, limit=-1):
+    '''Return a list of up to limit (folder_id, folder, filename, dev, ino, size, mtime_ns) of unhashed files, ordered by and past the (folder_id, filename) after.'''
+    assert host
+    # of hardlinked files only the first unhashed link, db_cursor_update_file_md5s() records its md5 for all links.
+    # CROSS JOIN keeps entries as the outer loop, walking the partial index in key order.
+    cursor.execute('''SELECT entries.folder_id, folders.path, entries.filename, entries.dev, entries.ino, entries.size, entries.mtime_ns '''
+        '''FROM entries CROSS JOIN folders ON entries.folder_id = folders.id '''
+        '''WHERE entries.md5 IS NULL AND (entries.folder_id, entries.filename) > (?, ?) AND entries.ino != -1 '''
+        '''AND folders.host = ? AND folders.device_id = ? '''
+        '''AND NOT EXISTS (SELECT 1 FROM entries AS link WHERE link.dev = entries.dev AND link.ino = entries.ino AND link.ino != -1 '''
+        '''AND link.md5 IS NULL AND (link.size, link.mtime_ns) = (entries.size, entries.mtime_ns) '''
+        '''AND (link.folder_id, link.filename) < (entries.folder_id, entries.filename) AND link.folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?)) '''
+        '''ORDER BY entries.folder_id, entries.filename LIMIT ?''',
+        (*(after or (-1, "")), host, device_id or "", host, device_id or "", limit))
+    return cursor.fetchall()
+
+
+@metrics_timed('db_seconds')
+def db_cursor_update_file_md5s(cursor, rows, host=None, device_id=None):
+    '''Record (folder_id, filename, dev, ino, size, mtime_ns, md5) of hashed files unchanged since selected for all their hardlinks, and cache their hashes.'''
+    assert host
+    rows = list(rows)
+    cursor.executemany('''UPDATE entries SET md5 = ? WHERE dev = ? AND ino = ? AND ino != -1 AND (size, mtime_ns) = (?, ?) '''
+        '''AND folder_id IN (SELECT id FROM folders WHERE host = ? AND device_id = ?)''',
+        ((md5, *key, host, device_id or "") for _, _, *key, md5 in rows))
+    cursor.executemany('''INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, md5) VALUES (?, ?, ?, ?, ?)''',
+        (row[2:] for row in rows))
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_file_totals(cursor, host=None, device_id=None, status=None):
+    '''Return the files and bytes of a device, or of its files with status, in total and counting each inode once.'''
+    assert host
+    cursor.execute('''SELECT COUNT(*), TOTAL(links), TOTAL(size * links), TOTAL(size) FROM ('''
+        '''SELECT entries.size AS size, COUNT(*) AS links FROM entries JOIN folders ON entries.folder_id = folders.id '''
+        '''WHERE folders.host = ? AND folders.device_id = ? {status}'''
+        '''GROUP BY entries.dev, entries.ino, entries.size, entries.mtime_ns, '''
+        '''CASE WHEN entries.ino = -1 THEN entries.folder_id END, CASE WHEN entries.ino = -1 THEN entries.filename END)'''.format(
+            status = '''AND entries.code = ? ''' if status is not None else '''''',
+        ), (host, device_id or "", *((status,) if status is not None else ())))
+    unique_files, files, size, unique_size = cursor.fetchone()
+    return dict(files=int(files), bytes=int(size), unique_files=unique_files, unique_bytes=int(unique_size))
+
+
+# orders of the folders and of their files by db_cursor_select_status_folders()
+# and db_cursor_select_status_files().
+DB_STATUS_ORDERS = dict(
+    subtree=('path', 'filename'),
+    age=('min_mtime, path', 'mtime, filename'),
+    size=('bytes, path', 'size, filename'),
+)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_status_folders(cursor, status, host=None, device_id=None, order='subtree'):
+    '''Return the cursor over the (folder_id, folder, files, bytes, min_size, min_mtime) of the folders with files of a status, in one of the DB_STATUS_ORDERS.'''
+    # sizes of -1 are unknown and count as 0 bytes.
+    assert host
+    # CROSS JOIN walks entries in key order, grouping without a sort.
+    cursor.execute('''SELECT entries.folder_id AS folder_id, folders.path AS path, COUNT(*) AS files, TOTAL(max(entries.size, 0)) AS bytes, '''
+        '''MIN(max(entries.size, 0)) AS min_size, MIN(entries.mtime) AS min_mtime '''
+        '''FROM entries CROSS JOIN folders ON entries.folder_id = folders.id '''
+        '''WHERE folders.host = ? AND folders.device_id = ? AND entries.code = ? '''
+        '''GROUP BY entries.folder_id ORDER BY {order}'''.format(order=DB_STATUS_ORDERS[order][0]),
+        (host, device_id or "", status))
+    return cursor
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_status_files(cursor, folder_id, status, order='subtree'):
+    '''Return the cursor over the (filename, size, mtime) of the files of a status in a folder, in one of the DB_STATUS_ORDERS.'''
+    cursor.execute('''SELECT filename, max(size, 0) AS size, mtime FROM entries WHERE folder_id = ? AND code = ? ORDER BY {order}'''.format(
+        order=DB_STATUS_ORDERS[order][1]), (folder_id, status))
+    return cursor
+
+
+@metrics_timed('db_seconds')
+def db_cursor_update_rollups(cursor):
+    '''Bring the subtree totals of changed folders and their ancestors up to date, and return the number of folders updated.'''
+    # stale folders are summed up from their files and the totals of their subfolders, deepest first, one level per statement.
+    count = 0
+    while True:
+        cursor.execute('''SELECT MAX(depth) FROM rollups WHERE stale''')
+        depth = cursor.fetchone()[0]
+        if depth is None:
+            return count
+        cursor.execute('''UPDATE rollups SET stale = 1 WHERE folder_id IN (SELECT folders.parent_id FROM rollups AS child '''
+            '''JOIN folders ON folders.id = child.folder_id WHERE child.stale AND child.depth = ?) AND NOT stale''', (depth,))
+        cursor.execute('''UPDATE rollups SET tree_folders = 1 + children.folders, tree_files = rollups.files + children.files, '''
+            '''tree_bytes = rollups.bytes + children.bytes, tree_dirty_files = rollups.dirty_files + children.dirty_files, '''
+            '''tree_dirty_bytes = rollups.dirty_bytes + children.dirty_bytes, stale = 0 FROM ('''
+            '''SELECT stale.folder_id AS folder_id, COALESCE(SUM(child.tree_folders), 0) AS folders, COALESCE(SUM(child.tree_files), 0) AS files, '''
+            '''COALESCE(SUM(child.tree_bytes), 0) AS bytes, COALESCE(SUM(child.tree_dirty_files), 0) AS dirty_files, '''
+            '''COALESCE(SUM(child.tree_dirty_bytes), 0) AS dirty_bytes '''
+            '''FROM rollups AS stale LEFT JOIN folders AS subfolder ON subfolder.parent_id = stale.folder_id '''
+            '''LEFT JOIN rollups AS child ON child.folder_id = subfolder.id '''
+            '''WHERE stale.stale AND stale.depth = ? GROUP BY stale.folder_id) AS children '''
+            '''WHERE rollups.folder_id = children.folder_id''', (depth,))
+        count += cursor.rowcount
+
+
+@metrics_timed('db_seconds')
+def db_cursor_rebuild_rollups(cursor):
+    '''Recompute all folder totals from the files, and return the number of folders.'''
+    cursor.execute('''DELETE FROM rollups''')
+    cursor.execute('''INSERT INTO rollups (folder_id, depth, files, bytes, dirty_files, dirty_bytes) '''
+        '''SELECT folders.id, length(folders.path) - length(replace(folders.path, '/', '')), '''
+        '''COUNT(entries.folder_id), COALESCE(SUM(max(entries.size, 0)), 0), '''
+        '''COALESCE(SUM(entries.code = ?), 0), COALESCE(SUM((entries.code = ?) * max(entries.size, 0)), 0) '''
+        '''FROM folders LEFT JOIN entries ON entries.folder_id = folders.id GROUP BY folders.id''',
+        (FileStatus.DIRTY, FileStatus.DIRTY))
+    return db_cursor_update_rollups(cursor)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_rollups(cursor, folder, host=None, device_id=None, depth=0):
+    '''Return a list of (folder, folders, files, bytes, dirty_files, dirty_bytes) subtree totals of folder and its subfolders down to depth levels below it, in path order.'''
+    assert host
+    folder = __folder_path(folder)
+    cursor.execute('''SELECT folders.path, rollups.tree_folders, rollups.tree_files, rollups.tree_bytes, '''
+        '''rollups.tree_dirty_files, rollups.tree_dirty_bytes FROM folders JOIN rollups ON rollups.folder_id = folders.id '''
+        '''WHERE folders.host = ? AND folders.device_id = ? AND folders.path >= ? AND folders.path < ? AND rollups.depth <= ? '''
+        '''ORDER BY folders.path''',
+        (host, device_id or "", folder, folder[:-1] + '0', folder.count('/') + depth))
+    return cursor.fetchall()
+
+
+@metrics_timed('db_seconds')
+def db_cursor_select_checkpoint(cursor, job, host=None, device_id=None):
+    '''Return the progress of the last run of a job as a dict, or None if it never ran.'''
+    assert host
+    cursor.execute('''SELECT started, updated, folders, rows, commits, done FROM checkpoints WHERE job = ? AND host = ? AND device_id = ?''',
+        (job, host, device_id or ""))
+    row = cursor.fetchone()
+    return dict(zip(('started', 'updated', 'folders', 'rows', 'commits', 'done'), row)) if row is not None else None
+
+
+@metrics_timed('db_seconds')
+def db_cursor_update_checkpoint(cursor, job, progress, host=None, device_id=None):
+    '''Record the progress of the run of a job, a dict like db_cursor_select_checkpoint() returns.'''
+    assert host
+    cursor.execute('''INSERT OR REPLACE INTO checkpoints (job, host, device_id, started, updated, folders, rows, commits, done) '''
+        '''VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', (job, host, device_id or "", progress['started'], progress['updated'],
+        progress['folders'], progress['rows'], progress['commits'], int(progress['done'])))
+
+
+@metrics_timed('db_seconds')
+def db_cursor_merge_shard(cursor, shard_path):
+    '''Merge the folders and files of a shard database in one transaction, and return their counts.'''
+    # files are upserted like by db_cursor_insert_files() and folders of the shard replace their rows,
+    # so merging a shard again after a crash is harmless. a database can only be attached outside of a transaction.
+    cursor.connection.commit()
+    cursor.execute('''ATTACH DATABASE ? AS shard''', (shard_path,))
+    try:
+        cursor.execute('''INSERT INTO main.folders (host, device_id, path, code, ino, dev, size, mtime, mtime_ns, ctime_ns, dir_size) '''
+            '''SELECT host, device_id, path, code, ino, dev, size, mtime, mtime_ns, ctime_ns, dir_size FROM shard.folders WHERE true '''
+            '''ON CONFLICT (host, device_id, path) DO UPDATE SET code = excluded.code, ino = excluded.ino, dev = excluded.dev, '''
+            '''size = excluded.size, mtime = excluded.mtime, mtime_ns = excluded.mtime_ns, ctime_ns = excluded.ctime_ns, dir_size = excluded.dir_size''')
+        folders = cursor.rowcount
+        # folders new to the database get their parent by path.
+        cursor.execute('''UPDATE main.folders SET parent_id = parent.id FROM shard.folders AS child '''
+            '''JOIN shard.folders AS shard_parent ON shard_parent.id = child.parent_id '''
+            '''JOIN main.folders AS parent ON parent.host = shard_parent.host AND parent.device_id = shard_parent.device_id AND parent.path = shard_parent.path '''
+            '''WHERE folders.parent_id IS NULL AND folders.host = child.host AND folders.device_id = child.device_id AND folders.path = child.path''')
+        cursor.execute('''INSERT INTO main.entries (folder_id, {columns}) '''
+            '''SELECT folder.id, {values} FROM shard.entries AS entry JOIN shard.folders AS shard_folder ON shard_folder.id = entry.folder_id '''
+            '''JOIN main.folders AS folder ON folder.host = shard_folder.host AND folder.device_id = shard_folder.device_id AND folder.path = shard_folder.path '''
+            '''WHERE true {conflict}'''.format(
+                columns = ','.join(FILES_ROW_COLUMNS[3:]),
+                values = ','.join(f'entry.{name}' for name in FILES_ROW_COLUMNS[3:]),
+                conflict = __db_upsert_entries_conflict_sql,
+            ))
+        files = cursor.rowcount
+        cursor.connection.commit()
+    except BaseException:
+        cursor.connection.rollback()
+        raise
+    finally:
+        cursor.execute('''DETACH DATABASE shard''')
+    return folders, files
+
+
+@metrics_timed('db_seconds')
+def db_cursor_prune_hashes(cursor):
+    '''Delete cached hashes no file refers to anymore, and return the number deleted.'''
+    cursor.execute('''DELETE FROM hashes WHERE (dev, ino, size, mtime_ns) NOT IN (SELECT dev, ino, size, mtime_ns FROM entries)''')
+    return cursor.rowcount
 
 
 def create_table(cursor, table):
     columns = DB_SCHEMA[table]['columns']
-    indices = DB_SCHEMA[table].get('indices', [])
+    indices = DB_SCHEMA[table].get('indices', {})
     unique = DB_SCHEMA[table].get('unique')
     foreign_key = DB_SCHEMA[table].get('foreign key')
 
-    cursor.executemany([
+    statements = [
         '''CREATE TABLE {table} ({columns} {foreign_key} {unique})'''.format(
             table = table,
             columns = ','.join(map(lambda name: '''{name} {type} {default}'''.format(
@@ -654,13 +1396,13 @@ def create_table(cursor, table):
                 type = columns[name]['column_type'],
                 default = 'default {}'.format(columns[name]['default']) if 'default' in columns[name] else '',
                 ), columns.keys())),
-            foreign_key = '''foreign key ({columns}) references {references}'''.format(
+            foreign_key = ''', foreign key ({columns}) references {references}'''.format(
                 columns = ','.join(foreign_key['columns']),
                 references = ','.join(map(lambda table: '''{table} ({columns})'''.format(
                     table = table,
                     columns = ','.join(foreign_key['references'][table])), foreign_key['references'].keys())),
                 ) if foreign_key else '',
-            unique = '''unique ({columns})'''.format(
+            unique = ''', unique ({columns})'''.format(
                 columns = ','.join(unique),
                 ) if unique else '',
             ),
@@ -668,8 +1410,10 @@ def create_table(cursor, table):
         '''CREATE INDEX {name} ON {table} ({columns})'''.format(
             name = name,
             table = table,
-            columns = ','.join(indices[name]),
-            ), indices.keys())))
+            columns = ','.join(indices[name]['columns']),
+            ), indices.keys()))
+    for statement in statements:
+        cursor.execute(statement)
     cursor.connection.commit()
 
 
@@ -739,3 +1483,161 @@ def idrive_db_select_files(cursor):
         columns = ','.join(chain(ibfile, ibfolder)),
     ))
     return map(lambda row: dict(zip(ibfile + ibfolder, row)), cursor)
+
+
+def __sql_strip1(expression, char="'"):
+    # strip1() in SQL, so a scan needs no Python call per row.
+    char = char.replace("'", "''")
+    first = f'''(substr({expression}, 1, 1) = '{char}')'''
+    last = f'''(substr({expression}, -1) = '{char}' AND length({expression}) > 1)'''
+    return f'''substr({expression}, 1 + {first}, length({expression}) - {first} - {last})'''
+
+
+# columns of idrive_db_query_files(), by name.
+IBFILE_QUERY_COLUMNS = dict(
+    path=__sql_strip1('ibfolder.NAME') + ' || ' + __sql_strip1('ibfile.NAME'),
+    folder=__sql_strip1('ibfolder.NAME'),
+    name=__sql_strip1('ibfile.NAME'),
+    size='ibfile.FILE_SIZE',
+    mtime='ibfile.FILE_LMD',
+    status='ibfile.BACKUP_STATUS',
+    checksum='ibfile.CHECKSUM',
+    last_updated='ibfile.LAST_UPDATED',
+    file_id='ibfile.FILEID',
+    dir_id='ibfile.DIRID',
+)
+
+
+def idrive_db_query_files(cursor, columns=('path',), folder=None, min_size=None, max_size=None,
+        min_mtime=None, max_mtime=None, status=None):
+    '''Return a cursor over the IBFILE_QUERY_COLUMNS columns of the files of an IDrive client database, filtered in SQL by folder prefix, inclusive size and FILE_LMD ranges and BACKUP_STATUS values.'''
+    conditions, values = [], []
+    if folder:
+        conditions.append(f'''substr({IBFILE_QUERY_COLUMNS['folder']}, 1, ?) = ?''')
+        values.extend((len(folder), folder))
+    for expression, operator, value in (
+            ('ibfile.FILE_SIZE', '>=', min_size),
+            ('ibfile.FILE_SIZE', '<=', max_size),
+            ('ibfile.FILE_LMD', '>=', min_mtime),
+            ('ibfile.FILE_LMD', '<=', max_mtime)):
+        if value is not None:
+            conditions.append(f'''{expression} {operator} ?''')
+            values.append(value)
+    if status is not None:
+        conditions.append('''ibfile.BACKUP_STATUS IN ({})'''.format(','.join('?' * len(status))))
+        values.extend(status)
+    cursor.execute('''SELECT {columns} FROM ibfile JOIN ibfolder ON ibfile.DIRID = ibfolder.DIRID {where}'''.format(
+        columns = ','.join(IBFILE_QUERY_COLUMNS[name] for name in columns),
+        where = conditions and 'WHERE ' + ' AND '.join(conditions) or '',
+    ), values)
+    return cursor
+
+
+# BACKUP_STATUS of the files an IDrive client has backed up.
+IBFILE_BACKED_UP_STATUSES = (1,)
+
+# folder paths end with "/", and only the root has no parent.
+__sql_ibfolder_path = '''({folder} || CASE WHEN substr({folder}, -1) = '/' THEN '' ELSE '/' END)'''.format(folder=__sql_strip1('ibfolder.NAME'))
+__sql_has_parent = '''instr(substr({path}, 1, length({path}) - 1), '/') > 0'''
+
+# entries columns of an ibfile row. FILE_LMD is a UTC date, or a timestamp,
+# and a CHECKSUM that is no md5 is unknown.
+__ibfile_entry_columns = dict(
+    filename=__sql_strip1('ibfile.NAME'),
+    size='''coalesce(ibfile.FILE_SIZE, -1)''',
+    mtime='''CAST(coalesce(CASE WHEN typeof(ibfile.FILE_LMD) IN ('integer', 'real') THEN ibfile.FILE_LMD '''
+        '''ELSE strftime('%s', ibfile.FILE_LMD) END, -1) AS REAL)''',
+    md5='''CASE WHEN length({checksum}) = 32 THEN lower({checksum}) END'''.format(checksum=__sql_strip1('ibfile.CHECKSUM')),
+)
+
+
+@metrics_timed('db_seconds')
+def db_cursor_import_ibfile(cursor, ibfile_path, host=None, device_id=None, incremental=True, statuses=IBFILE_BACKED_UP_STATUSES):
+    '''Import the files of an IDrive client database as the files of a remote device in one transaction, and return a report.'''
+    # files of a BACKUP_STATUS in statuses are upserted, and files of any other status, or no longer in ibfile, deleted.
+    # When incremental, only the files whose LAST_UPDATED is past the last import of the same database are upserted.
+    assert host
+    device_id = device_id or ""
+    source = os.path.realpath(ibfile_path)
+    # a database can only be attached outside of a transaction.
+    cursor.connection.commit()
+    cursor.connection.create_function('parent_folder', 1, __parent_folder, deterministic=True)
+    cursor.execute('''ATTACH DATABASE ? AS ib''', (source,))
+    try:
+        since = None
+        if incremental:
+            cursor.execute('''SELECT last_updated FROM imports WHERE source = ? AND host = ? AND device_id = ?''', (source, host, device_id))
+            row = cursor.fetchone()
+            since = row[0] if row is not None else None
+        cursor.execute('''SELECT max(LAST_UPDATED) FROM ib.ibfile''')
+        last_updated = cursor.fetchone()[0] or since
+        changed, values = ('''ibfile.LAST_UPDATED > ?''', (since,)) if since is not None else ('''true''', ())
+
+        cursor.execute('''INSERT INTO main.folders (host, device_id, path, code) WITH RECURSIVE imported (path) AS ('''
+            '''SELECT {path} FROM ib.ibfolder WHERE ibfolder.DIRID IN (SELECT ibfile.DIRID FROM ib.ibfile WHERE {changed}) '''
+            '''UNION SELECT parent_folder(path) FROM imported WHERE {has_parent}) '''
+            '''SELECT ?, ?, path, ? FROM imported WHERE true '''
+            '''ON CONFLICT (host, device_id, path) DO NOTHING'''.format(
+                path = __sql_ibfolder_path,
+                changed = changed,
+                has_parent = __sql_has_parent.format(path='path'),
+            ), (*values, host, device_id, FileStatus.SCANNED))
+        folders = cursor.rowcount
+        cursor.execute('''UPDATE main.folders SET parent_id = parent.id FROM main.folders AS parent '''
+            '''WHERE folders.host = ? AND folders.device_id = ? AND folders.parent_id IS NULL AND {has_parent} '''
+            '''AND parent.host = folders.host AND parent.device_id = folders.device_id AND parent.path = parent_folder(folders.path)'''.format(
+                has_parent = __sql_has_parent.format(path='folders.path'),
+            ), (host, device_id))
+
+        # folder by folder, so each path is computed and looked up once, and
+        # the files of a folder are read by the (DIRID, NAME) index of ibfile.
+        select = '''FROM ib.ibfolder CROSS JOIN main.folders AS folder ON folder.host = ? AND folder.device_id = ? AND folder.path = {path} '''\
+            '''CROSS JOIN ib.ibfile ON ibfile.DIRID = ibfolder.DIRID '''\
+            '''WHERE ibfile.BACKUP_STATUS {{status}} IN ({statuses}) AND {{changed}}'''.format(
+                path = __sql_ibfolder_path,
+                statuses = ','.join('?' * len(statuses)),
+            )
+        cursor.execute('''INSERT INTO main.entries (folder_id, filename, size, mtime, md5, code) '''
+            '''SELECT folder.id, {columns}, ? {select} '''
+            '''ON CONFLICT (folder_id, filename) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '''
+            '''md5 = CASE WHEN excluded.md5 IS NOT NULL THEN excluded.md5 '''
+            '''WHEN (entries.size, entries.mtime) IS (excluded.size, excluded.mtime) THEN entries.md5 END'''.format(
+                columns = ','.join(__ibfile_entry_columns[name] for name in ('filename', 'size', 'mtime', 'md5')),
+                select = select.format(status='', changed=changed),
+            ), (FileStatus.DEFAULT, host, device_id, *statuses, *values))
+        files = cursor.rowcount
+        cursor.execute('''DELETE FROM main.entries WHERE (folder_id, filename) IN (SELECT folder.id, {filename} {select})'''.format(
+                filename = __ibfile_entry_columns['filename'],
+                select = select.format(status='NOT', changed=changed),
+            ), (host, device_id, *statuses, *values))
+        removed = cursor.rowcount
+        # files deleted from the client database have no row left to be updated. Every file backed up is an entry by now,
+        # so only when the device has more entries is there any to delete, by an anti-join against ibfile.
+        cursor.execute('''SELECT (SELECT count(*) FROM main.folders AS folder JOIN main.entries ON entries.folder_id = folder.id '''
+            '''WHERE folder.host = ? AND folder.device_id = ?) > (SELECT count(*) FROM ib.ibfile JOIN ib.ibfolder ON ibfile.DIRID = ibfolder.DIRID '''
+            '''WHERE ibfile.BACKUP_STATUS IN ({statuses}))'''.format(
+                statuses = ','.join('?' * len(statuses)),
+            ), (host, device_id, *statuses))
+        if cursor.fetchone()[0]:
+            cursor.execute('''DELETE FROM main.entries WHERE folder_id IN (SELECT id FROM main.folders WHERE host = ? AND device_id = ?) '''
+                '''AND (folder_id, filename) NOT IN (SELECT folder.id, {filename} {select})'''.format(
+                    filename = __ibfile_entry_columns['filename'],
+                    select = select.format(status='', changed='true'),
+                ), (host, device_id, host, device_id, *statuses))
+            removed += cursor.rowcount
+
+        cursor.execute('''INSERT OR REPLACE INTO main.imports (source, host, device_id, last_updated, imported) VALUES (?, ?, ?, ?, ?)''',
+            (source, host, device_id, last_updated, time.time()))
+        cursor.connection.commit()
+    except BaseException:
+        cursor.connection.rollback()
+        raise
+    finally:
+        cursor.execute('''DETACH DATABASE ib''')
+    return dict(
+        folders=folders,
+        files=files,
+        removed=removed,
+        since=since,
+        last_updated=last_updated,
+    )
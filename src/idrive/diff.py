@@ -0,0 +1,110 @@
+import csv
+import json
+import logging
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DIFF_KEYS = ('path', 'name', 'size')
+DIFF_FORMATS = ('text', 'csv', 'ndjson')
+
+ONLY_ONLINE = 'only-online'
+ONLY_LOCAL = 'only-local'
+MISMATCHED = 'mismatched'
+MATCHED = 'matched'
+
+
+def __sql_strip1(expression):
+    # util.strip1(expression, "'") in SQL
+    rstripped = f"(CASE WHEN substr({expression}, -1) = '''' THEN substr({expression}, 1, length({expression}) - 1) ELSE {expression} END)"
+    return f"(CASE WHEN substr({rstripped}, 1, 1) = '''' THEN substr({rstripped}, 2) ELSE {rstripped} END)"
+
+
+# (path, size) of every file in each kind of index database.
+__diff_sources = {
+    'entries': '''SELECT folders.path || entries.filename AS path, entries.size AS size '''
+               '''FROM entries JOIN folders ON entries.folder_id = folders.id''',
+    'files': '''SELECT folder || filename AS path, size FROM files WHERE filename != ""''',
+    'DirEnt': '''SELECT path, size FROM DirEnt''',
+    'ibfile': '''SELECT {folder} || {file} AS path, ibfile.FILE_SIZE AS size '''
+              '''FROM ibfile JOIN ibfolder ON ibfile.DIRID = ibfolder.DIRID'''.format(
+                  folder = __sql_strip1('ibfolder.NAME'),
+                  file = __sql_strip1('ibfile.NAME'),
+              ),
+}
+
+# the basename of a path, in SQL: rtrim() of every character but '/' leaves the dirname.
+__sql_basename = '''substr(path, length(rtrim(path, replace(path, '/', ''))) + 1)'''
+
+
+def __basename(path):
+    return path.rsplit('/', 1)[-1] if path is not None else None
+
+
+def diff_select(cursor, key=('size', 'name'), root='', min_size=1):
+    '''Stream the (key..., path, size) rows under root of an entries, files, DirEnt or ibfile database ordered by key.'''
+    tables = set(name for name, in cursor.execute('''SELECT name FROM sqlite_master WHERE type = "table"'''))
+    source = next((table for table in __diff_sources if table in tables), None)
+    if source is None:
+        raise ValueError("no entries, files, DirEnt or ibfile table in database")
+    # sort on SQL expressions only, a Python function would be called for every row
+    expressions = dict(
+        path='substr(path, length(:root) + 1)',
+        name=__sql_basename,
+        size='size',
+    )
+    columns = ','.join(expressions[name] for name in key)
+    cursor.execute('''SELECT {columns}, substr(path, length(:root) + 1), size FROM ({source}) '''
+        '''WHERE substr(path, 1, length(:root)) = :root AND size >= :min_size ORDER BY {order}'''.format(
+            columns = columns,
+            source = __diff_sources[source],
+            order = ','.join(str(i + 1) for i in range(len(key))),
+        ), dict(root=root, min_size=min_size))
+    return cursor
+
+
+def diff_merge(online, local, key=('size', 'name'), compare=('size',), matched=False):
+    '''Merge two key ordered streams of diff_select() and yield (status, online, local), pairing equal keys one to one.'''
+    # a pair is MISMATCHED when any of its compare fields differ, so never with nothing to compare
+    n = len(key)
+    fields = dict(path=lambda row: row[0], name=lambda row: __basename(row[0]), size=lambda row: row[1])
+    compare = [fields[name] for name in compare]
+    online, local = iter(online), iter(local)
+    a, b = next(online, None), next(local, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[:n] < b[:n]):
+            yield ONLY_ONLINE, a[n:], None
+            a = next(online, None)
+        elif a is None or b[:n] < a[:n]:
+            yield ONLY_LOCAL, None, b[n:]
+            b = next(local, None)
+        else:
+            a_row, b_row = a[n:], b[n:]
+            if any(field(a_row) != field(b_row) for field in compare):
+                yield MISMATCHED, a_row, b_row
+            elif matched:
+                yield MATCHED, a_row, b_row
+            a, b = next(online, None), next(local, None)
+
+
+def diff_write(results, stream, format='text'):
+    '''Write diff_merge() results to a stream and return counts by status.'''
+    counts = {ONLY_ONLINE: 0, ONLY_LOCAL: 0, MISMATCHED: 0, MATCHED: 0}
+    marks = {ONLY_ONLINE: '-', ONLY_LOCAL: '+', MISMATCHED: '!', MATCHED: '='}
+    writer = csv.writer(stream) if format == 'csv' else None
+    if writer is not None:
+        writer.writerow(('status', 'online_path', 'online_size', 'local_path', 'local_size'))
+    for status, online, local in results:
+        counts[status] += 1
+        if format == 'ndjson':
+            stream.write(json.dumps(dict(
+                status=status,
+                online=online and dict(path=online[0], size=online[1]),
+                local=local and dict(path=local[0], size=local[1]),
+            )) + '\n')
+        elif writer is not None:
+            writer.writerow((status, *(online or ('', '')), *(local or ('', ''))))
+        else:
+            for row in filter(None, (online, local)):
+                stream.write(f'{marks[status]} {row[1]: 12} {row[0]}\n')
+    return counts
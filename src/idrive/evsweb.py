@@ -1,24 +1,193 @@
+import calendar
+import codecs
+import contextlib
+import datetime
+import json
 import logging
+import os
+import re
+import sqlite3
+import threading
+import time
 import requests
+import requests.adapters
+
+from .db_sqlite import get_cache_dir
+from .metrics import MetricsTimer, metrics_count
 
 
 log = logging.getLogger(__name__.split('.',1)[0])
 
+DEFAULT_STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_CACHE_NAME = 'evs-cache.db'
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_MAX_ENTRY_SIZE = 16 * 1024 * 1024
+# seconds a response stays fresh, by command. Responses of other commands,
+# like getServerAddress and validateAccount, are not cached: their key
+# would not tell accounts apart.
+DEFAULT_CACHE_TTLS = dict(browseFolder=15 * 60)
+
 
 __idrive_host = "evs.idrive.com"
+__idrive_scheme = "https"
 
 def idrive_get_host():
     return __idrive_host
 
+def idrive_set_host(host, scheme=None):
+    '''Point the client at another EVS server, e.g. a local stand-in.'''
+    global __idrive_host, __idrive_scheme
+    __idrive_host = host
+    if scheme:
+        __idrive_scheme = scheme
+
 
 __idrive_session = None
+__idrive_timeout = None
 
-def idrive_get_session():
+def idrive_get_session(pool_size=None):
+    '''Return the shared session, resizing its connection pool if pool_size is given.'''
     global __idrive_session
     if __idrive_session is None:
         __idrive_session = requests.Session()
+    if pool_size:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        __idrive_session.mount('https://', adapter)
+        __idrive_session.mount('http://', adapter)
     return __idrive_session
 
+def idrive_set_timeout(timeout):
+    global __idrive_timeout
+    __idrive_timeout = timeout
+
+
+class ResponseCache:
+    '''Persistent LRU cache of the successful EVS responses of the commands with a TTL, by (server, device_id, command, path).'''
+    # only response bodies are stored, never the credentials of a request. Responses of over max_entry_size
+    # bytes are not cached at all. Threads and processes can read the cache at once, as its journal is in WAL mode.
+
+    def __init__(self, path=None, max_size=DEFAULT_CACHE_MAX_SIZE, ttls=None, max_entry_size=DEFAULT_CACHE_MAX_ENTRY_SIZE):
+        self.path = path or os.path.join(get_cache_dir(True), DEFAULT_CACHE_NAME)
+        self.max_size = max_size
+        self.max_entry_size = min(max_entry_size, max_size)
+        self.ttls = dict(DEFAULT_CACHE_TTLS if ttls is None else ttls)
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        conn = self.__conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS responses ('''
+            ''' server text not null, device_id text not null, command text not null, path text not null,'''
+            ''' content blob not null, size integer not null, created real not null, accessed real not null,'''
+            ''' primary key (server, device_id, command, path) )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)''')
+        # running total of the response sizes, so a put needs not sum the whole table
+        conn.execute('''CREATE TABLE IF NOT EXISTS meta ( name text primary key, value integer not null )''')
+        conn.execute('''INSERT OR IGNORE INTO meta (name, value) SELECT 'size', TOTAL(size) FROM responses''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS responses_size_insert AFTER INSERT ON responses BEGIN '''
+            ''' UPDATE meta SET value = value + new.size WHERE name = 'size'; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS responses_size_update AFTER UPDATE OF size ON responses BEGIN '''
+            ''' UPDATE meta SET value = value - old.size + new.size WHERE name = 'size'; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS responses_size_delete AFTER DELETE ON responses BEGIN '''
+            ''' UPDATE meta SET value = value - old.size WHERE name = 'size'; END''')
+        conn.commit()
+
+    def __conn(self):
+        # a connection per thread, waiting for the writer of another process.
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('''PRAGMA journal_mode = WAL''')
+            conn.execute('''PRAGMA synchronous = NORMAL''')
+        return conn
+
+    def __count(self, command, hits=0, misses=0, stores=0, evictions=0):
+        with self.__lock:
+            self.hits += hits
+            self.misses += misses
+            self.stores += stores
+            self.evictions += evictions
+        for name, n in (('hits', hits), ('misses', misses), ('stores', stores), ('evictions', evictions)):
+            if n:
+                metrics_count(f'evs_cache_{name}', n, command=command)
+
+    def ttl(self, command):
+        '''Return the seconds a response of command stays fresh, or None if it is not cached.'''
+        return self.ttls.get(command)
+
+    def get(self, key):
+        '''Return the content of a fresh response, or None.'''
+        conn = self.__conn()
+        now = time.time()
+        row = conn.execute('''SELECT content, created FROM responses WHERE (server, device_id, command, path) = (?, ?, ?, ?)''', key).fetchone()
+        if row is None or row[1] + (self.ttl(key[2]) or 0) <= now:
+            self.__count(key[2], misses=1)
+            return None
+        try:
+            conn.execute('''UPDATE responses SET accessed = ? WHERE (server, device_id, command, path) = (?, ?, ?, ?)''', (now, *key))
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # the recency of a response is a hint, not worth waiting for a busy writer.
+            log.debug(f"ResponseCache.get(): {e!r}")
+            conn.rollback()
+        self.__count(key[2], hits=1)
+        return row[0]
+
+    def put(self, key, content):
+        '''Store the content of a successful response, evicting the least recently used past max_size.'''
+        if len(content) > self.max_entry_size:
+            return
+        conn = self.__conn()
+        now = time.time()
+        with conn:
+            # an upsert rather than a REPLACE, whose implicit delete would not fire the size triggers
+            conn.execute('''INSERT INTO responses (server, device_id, command, path, content, size, created, accessed) '''
+                '''VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (server, device_id, command, path) DO UPDATE SET '''
+                '''content = excluded.content, size = excluded.size, created = excluded.created, accessed = excluded.accessed''',
+                (*key, content, len(content), now, now))
+            total, = conn.execute('''SELECT value FROM meta WHERE name = 'size' ''').fetchone()
+            evicted = []
+            if total > self.max_size:
+                # walk the least recently used responses by idx_responses_accessed, only as far as needed
+                for rowid, size in conn.execute('''SELECT rowid, size FROM responses ORDER BY accessed, rowid'''):
+                    evicted.append((rowid,))
+                    total -= size
+                    if total <= self.max_size:
+                        break
+                conn.executemany('''DELETE FROM responses WHERE rowid = ?''', evicted)
+        self.__count(key[2], stores=1, evictions=len(evicted))
+
+    def clear(self):
+        '''Delete all responses.'''
+        with self.__conn() as conn:
+            conn.execute('''DELETE FROM responses''')
+
+    def report(self):
+        entries, size = self.__conn().execute('''SELECT COUNT(*), (SELECT value FROM meta WHERE name = 'size') FROM responses''').fetchone()
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            stores=self.stores,
+            evictions=self.evictions,
+            entries=entries,
+            bytes=int(size),
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
+
+
+__idrive_cache = None
+
+def idrive_get_cache():
+    return __idrive_cache
+
+def idrive_set_cache(cache):
+    '''Cache responses in a ResponseCache, or not at all with None.'''
+    global __idrive_cache
+    __idrive_cache = cache
+
 
 __idrive_uid = __idrive_pwd = __idrive_web_api_server = __idrive_device_id = None
 
@@ -26,12 +195,11 @@ def idrive_set_device_id(device_id):
     global __idrive_device_id
     __idrive_device_id = device_id
 
-def idrive_session_post(command=None, data=None, **params):
-    params = dict(params)
+def __idrive_post(command, data, params, stream=False):
     uid, pwd, host, device_id = params.pop('uid', __idrive_uid), params.pop('pwd', __idrive_pwd), params.pop('host', __idrive_web_api_server), params.pop('device_id', __idrive_device_id)
 
     session = idrive_get_session()
-    url = f"https://{host}/evs/{command}"
+    url = f"{__idrive_scheme}://{host}/evs/{command}"
     params = params or None
     data = dict(data or {})
     if device_id:
@@ -39,15 +207,44 @@ def idrive_session_post(command=None, data=None, **params):
     log.debug('idrive_session_post(): request: {}'.format(dict(host=host,command=command,params=params,data=data)))
     data.update(dict(uid=uid, pwd=pwd, json='yes'))
 
-    response = session.post(url, params=params, data=data)
-
-    response.raise_for_status()
+    try:
+        with MetricsTimer('evs_post_seconds', command=command):
+            response = session.post(url, params=params, data=data, timeout=__idrive_timeout, stream=stream)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        status = getattr(e.response, 'status_code', None) or type(e).__name__
+        metrics_count('evs_post_errors', command=command, status=status)
+        raise
     assert 'application/json' in response.headers.get('content-type',''), dict(status_code=response.status_code, content=response.content)
+    return url, response
+
+
+def __idrive_cache_key(command, data, params):
+    # the key of a cached response of command, or None if it is not cached.
+    if __idrive_cache is None or not __idrive_cache.ttl(command):
+        return None
+    data = data or {}
+    device_id = params.get('device_id', __idrive_device_id) or data.get('device_id')
+    return (params.get('host', __idrive_web_api_server) or "", device_id or "", command, data.get('p') or "")
+
 
-    result = response.json()
+def idrive_session_post(command=None, data=None, **params):
+    '''Post a command, or use its fresh response in the cache of idrive_set_cache(), and return its response contents, or the whole response without contents.'''
+    key = __idrive_cache_key(command, data, params)
+    content = __idrive_cache.get(key) if key is not None else None
+    if content is None:
+        url, response = __idrive_post(command, data, dict(params))
+        content = response.content
+        metrics_count('evs_response_bytes', len(content), command=command)
+    else:
+        url, key = 'cache', None
+
+    result = json.loads(content)
     log.debug('idrive_session_post(): response: {} {}'.format(url, result))
     message = result.get('message', None)
     assert message == "SUCCESS", result
+    if key is not None:
+        __idrive_cache.put(key, content)
     if 'contents' in result:
         contents = result['contents']
         assert isinstance(contents, list), result
@@ -55,6 +252,118 @@ def idrive_session_post(command=None, data=None, **params):
     return result
 
 
+__json_decoder = json.JSONDecoder()
+__json_whitespace = re.compile(r'[ \t\n\r]*')
+
+def __iter_json_items(chunks, key, result):
+    # yield the items of the array at key of the JSON object read from text
+    # chunks, and collect its other members in result. Only the current item
+    # and one chunk are held in memory.
+    chunks = iter(chunks)
+    buffer, pos = '', 0
+
+    def fill():
+        nonlocal buffer, pos
+        for chunk in chunks:
+            if chunk:
+                buffer, pos = buffer[pos:] + chunk, 0
+                return True
+        return False
+
+    def peek():
+        nonlocal pos
+        while True:
+            pos = __json_whitespace.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                raise json.JSONDecodeError('Unexpected end of response', buffer, pos)
+
+    def expect(chars):
+        nonlocal pos
+        char = peek()
+        if char not in chars:
+            raise json.JSONDecodeError(f'Expecting one of {chars!r}', buffer, pos)
+        pos += 1
+        return char
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = __json_decoder.raw_decode(buffer, pos)
+                # a number cut at the end of the buffer may go on in the next chunk
+                if end < len(buffer) and buffer[end] not in '0123456789.eE+-':
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                pass
+            if not fill():
+                obj, pos = __json_decoder.raw_decode(buffer, pos)
+                return obj
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        name = value()
+        expect(':')
+        if name == key and peek() == '[':
+            expect('[')
+            if peek() == ']':
+                expect(']')
+            else:
+                while True:
+                    yield value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            result[name] = value()
+        if expect(',}') == '}':
+            return
+
+
+def idrive_session_post_iter(command=None, data=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, **params):
+    '''Like idrive_session_post(), but yield the items of the response contents as they are read, chunk_size bytes at a time.'''
+    # a message other than SUCCESS raises an AssertionError, after the items that preceded it in the response.
+    key = __idrive_cache_key(command, data, params)
+    content = __idrive_cache.get(key) if key is not None else None
+    result, count = dict(), 0
+    if content is not None:
+        url, cached = 'cache', None
+        response = contextlib.nullcontext()
+        chunks = (content.decode(json.detect_encoding(content)),)
+    else:
+        url, response = __idrive_post(command, data, dict(params), stream=True)
+        # the raw response is kept for the cache, unless it grows too large.
+        cached = [] if key is not None else None
+        def read():
+            nonlocal cached
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+            size = 0
+            for chunk in response.iter_content(chunk_size):
+                size += len(chunk)
+                if cached is not None and size > __idrive_cache.max_entry_size:
+                    cached = None
+                elif cached is not None:
+                    cached.append(chunk)
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+            metrics_count('evs_response_bytes', size, command=command)
+        chunks = read()
+    with response:
+        for item in __iter_json_items(chunks, 'contents', result):
+            if not count:
+                assert result.get('message', "SUCCESS") == "SUCCESS", result
+            count += 1
+            yield item
+    log.debug('idrive_session_post_iter(): response: {} {} contents: {} items'.format(url, result, count))
+    assert result.get('message', None) == "SUCCESS", result
+    if cached is not None:
+        __idrive_cache.put(key, b''.join(cached))
+
+
 def idrive_getServerAddress(**kwargs):
     host = __idrive_host
     command = "getServerAddress"
@@ -99,3 +408,39 @@ def idrive_browseFolder(device_id, path=None):
             )
     contents = idrive_session_post(command=command, data=data)
     return contents
+
+
+def idrive_browseFolder_iter(device_id, path=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    '''Like idrive_browseFolder(), but yield the entries of the folder as the response streams in.'''
+    path = path or '/'
+    command = 'browseFolder'
+    data = dict(p=path, device_id=device_id)
+    return idrive_session_post_iter(command=command, data=data, chunk_size=chunk_size)
+
+
+def idrive_parse_lmd(lmd):
+    '''Convert a last modified date of a browseFolder entry to a UTC timestamp.'''
+    return int(round(datetime.datetime.strptime(lmd, '%Y/%m/%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()))
+
+
+def idrive_format_lmd(mtime):
+    '''Convert a UTC timestamp to a last modified date of a browseFolder entry.'''
+    return datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).strftime('%Y/%m/%d %H:%M:%S')
+
+
+def idrive_parse_lmds(lmds):
+    '''Convert last modified dates of browseFolder entries to UTC timestamps, None stays None.'''
+    # dates are sliced rather than parsed with strptime, and the timestamp of each day computed once
+    days, mtimes = dict(), []
+    for lmd in lmds:
+        if lmd is None:
+            mtimes.append(None)
+            continue
+        day = days.get(lmd[:10])
+        if day is None:
+            if len(lmd) != 19 or lmd[4] != '/' or lmd[7] != '/' or lmd[10] != ' ' or lmd[13] != ':' or lmd[16] != ':':
+                mtimes.append(idrive_parse_lmd(lmd))
+                continue
+            day = days[lmd[:10]] = calendar.timegm((int(lmd[0:4]), int(lmd[5:7]), int(lmd[8:10]), 0, 0, 0))
+        mtimes.append(day + int(lmd[11:13]) * 3600 + int(lmd[14:16]) * 60 + int(lmd[17:19]))
+    return mtimes
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+'''A local stand-in for the IDrive EVS web API, serving a synthetic, recorded or indexed tree with injected latency, errors and throttling.'''
+import argparse
+import collections
+import http.server
+import json
+import random
+import signal
+import string
+import sys
+import threading
+import time
+import urllib.parse
+
+from .evsweb import idrive_format_lmd
+
+
+DEFAULT_DEVICE_ID = 'D01'
+NAME_CHARS = string.ascii_letters + string.digits + '_-'
+
+
+class SyntheticTree:
+    '''A remote tree of fanout subfolders and files per folder, depth levels deep, derived from the seed and each path without keeping it in memory.'''
+
+    def __init__(self, fanout=8, depth=3, files=100, name_length=12, seed=0):
+        self.fanout = fanout
+        self.depth = depth
+        self.files = files
+        self.name_length = name_length
+        self.seed = seed
+
+    def __name(self, rng, names):
+        while True:
+            name = ''.join(rng.choices(NAME_CHARS, k=rng.randint(max(1, self.name_length // 2), self.name_length * 3 // 2 + 1)))
+            if name not in names:
+                names.add(name)
+                return name
+
+    def __call__(self, path):
+        '''Return the browseFolder contents of a folder, or None if there is no such folder.'''
+        level = path.count('/') - 1
+        if level > self.depth or not path.startswith('/') or not path.endswith('/'):
+            return None
+        rng = random.Random(f'{self.seed}:{path}')
+        names = set()
+        contents = []
+        if level < self.depth:
+            contents.extend(dict(name=self.__name(rng, names), is_dir=True, size=str(self.files + self.fanout),
+                lmd=idrive_format_lmd(1600000000 + rng.randint(0, 1 << 24))) for _ in range(self.fanout))
+        contents.extend(dict(name=self.__name(rng, names), is_dir=False, size=str(rng.randint(1, 1 << 24)),
+            lmd=idrive_format_lmd(1600000000 + rng.randint(0, 1 << 24))) for _ in range(self.files))
+        # only listings of folders the parent lists exist.
+        if level > 0:
+            parent, name = path[:path.rindex('/', 0, -1) + 1], path[path.rindex('/', 0, -1) + 1:-1]
+            if not any(entry['is_dir'] and entry['name'] == name for entry in self(parent) or ()):
+                return None
+        return contents
+
+
+def load_tree(path):
+    '''Load a recorded tree, a JSON object of browseFolder contents by folder path.'''
+    with open(path) as f:
+        return json.load(f).get
+
+
+def load_index_tree(cursor, host, device_id=None):
+    '''Build a tree from the folders and files of an index database.'''
+    listings = collections.defaultdict(list)
+    cursor.execute('''SELECT folder, filename, size, mtime, dir_size FROM files WHERE host = ? AND device_id = ? ORDER BY folder, filename''',
+        (host, device_id or ""))
+    for folder, filename, size, mtime, dir_size in cursor:
+        if filename:
+            listings[folder].append(dict(name=filename, is_dir=False, size=str(size), lmd=idrive_format_lmd(max(mtime, 0))))
+        elif folder != '/':
+            listings.setdefault(folder, [])
+            parent, name = folder[:folder.rindex('/', 0, -1) + 1], folder[folder.rindex('/', 0, -1) + 1:-1]
+            listings[parent].append(dict(name=name, is_dir=True, size=str(max(dir_size, 0)), lmd=idrive_format_lmd(max(mtime, 0))))
+    return dict(listings).get
+
+
+class FakeEVSStats:
+    '''Thread safe counters of the requests served.'''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.errors = 0
+        self.throttled = 0
+        self.bytes = 0
+
+    def add(self, command, errors=0, throttled=0, bytes=0):
+        with self.__lock:
+            self.requests[command] += 1
+            self.errors += errors
+            self.throttled += throttled
+            self.bytes += bytes
+
+    def report(self):
+        with self.__lock:
+            return dict(
+                requests=sum(self.requests.values()),
+                commands=dict(self.requests),
+                errors=self.errors,
+                throttled=self.throttled,
+                bytes=self.bytes,
+            )
+
+
+class FakeEVSHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type='application/json', headers=()):
+        server = self.server
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if not server.bandwidth:
+            self.wfile.write(body)
+            return
+        # trickle the body out at the configured bytes per second.
+        chunk = max(1024, int(server.bandwidth / 20))
+        for offset in range(0, len(body), chunk):
+            self.wfile.write(body[offset:offset + chunk])
+            self.wfile.flush()
+            time.sleep(len(body[offset:offset + chunk]) / server.bandwidth)
+
+    def send_result(self, command, result):
+        body = json.dumps(result).encode()
+        self.server.stats.add(command, bytes=len(body))
+        self.send_body(200, body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_body(404, b'')
+            return
+        self.send_body(200, json.dumps(self.server.stats.report()).encode())
+
+    def do_POST(self):
+        server = self.server
+        command = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+        data = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get('content-length', 0))).decode())
+        data = {key: values[0] for key, values in data.items()}
+        server.delay()
+        fault = server.fault()
+        if fault == 429 or fault == 503:
+            server.stats.add(command, throttled=1)
+            self.send_body(fault, b'', content_type='text/plain', headers=(('retry-after', str(server.retry_after)),))
+            return
+        if fault == 500:
+            server.stats.add(command, errors=1)
+            self.send_body(500, b'', content_type='text/plain')
+            return
+        if server.credentials is not None and (data.get('uid'), data.get('pwd')) != server.credentials:
+            self.send_result(command, dict(message='ERROR', desc='INVALID USER'))
+            return
+        if command == 'getServerAddress':
+            self.send_result(command, dict(message='SUCCESS', webApiServer=server.address))
+        elif command == 'validateAccount':
+            self.send_result(command, dict(message='SUCCESS', desc='VALID ACCOUNT'))
+        elif command == 'listDevices':
+            contents = [dict(device_id=device_id, nick_name=device_id, os='Linux') for device_id in server.devices]
+            self.send_result(command, dict(message='SUCCESS', contents=contents))
+        elif command == 'browseFolder':
+            contents = server.tree(data.get('p') or '/') if data.get('device_id') in server.devices else None
+            if contents is None:
+                self.send_result(command, dict(message='ERROR', desc='INVALID PATH'))
+            else:
+                self.send_result(command, dict(message='SUCCESS', contents=contents))
+        else:
+            self.send_result(command, dict(message='ERROR', desc='INVALID COMMAND'))
+
+
+class FakeEVSServer(http.server.ThreadingHTTPServer):
+    '''A threaded fake EVS server, usable as a context manager that serves in the background.'''
+    daemon_threads = True
+
+    def __init__(self, tree, address=('127.0.0.1', 0), devices=(DEFAULT_DEVICE_ID,), credentials=None, latency=0.0, jitter=0.0,
+            bandwidth=None, error_rate=0.0, throttle_rate=0.0, rate_limit=None, retry_after=1, seed=None, verbose=False):
+        super().__init__(address, FakeEVSHandler)
+        # tree maps a folder path to its browseFolder contents, or None.
+        self.tree = tree
+        self.devices = tuple(devices)
+        self.credentials = credentials
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.stats = FakeEVSStats()
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__tokens = float(rate_limit or 0)
+        self.__refilled = time.monotonic()
+        self.__thread = None
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.server_address[:2])
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.__lock:
+                jitter = self.__rng.uniform(0, self.jitter)
+            time.sleep(self.latency + jitter)
+
+    def fault(self):
+        '''Return the status code of an injected failure of a request, or None.'''
+        with self.__lock:
+            if self.rate_limit:
+                # token bucket of rate_limit requests per second, bursting up to one second's worth.
+                now = time.monotonic()
+                self.__tokens = min(float(self.rate_limit), self.__tokens + (now - self.__refilled) * self.rate_limit)
+                self.__refilled = now
+                if self.__tokens < 1:
+                    return 429
+                self.__tokens -= 1
+            draw = self.__rng.random()
+        if draw < self.error_rate:
+            return 500
+        if draw < self.error_rate + self.throttle_rate:
+            return 503
+        return None
+
+    def __enter__(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--bind', type=str, default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on, 0 for any.')
+    parser.add_argument('--tree', type=str, default=None, help='Recorded tree: JSON object of browseFolder contents by folder path.')
+    parser.add_argument('--db', type=str, default=None, help='Serve the files of this index database instead.')
+    parser.add_argument('--db-host', type=str, default='evs.idrive.com', help='Host of the files served from --db.')
+    parser.add_argument('--db-device-id', type=str, default=None, help='Device ID of the files served from --db.')
+    parser.add_argument('--fanout', type=int, default=8, help='Synthetic tree: subfolders per folder.')
+    parser.add_argument('--depth', type=int, default=3, help='Synthetic tree: folder levels.')
+    parser.add_argument('--files', type=int, default=100, help='Synthetic tree: files per folder.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic tree and of injected faults.')
+    parser.add_argument('-dev', '--device-id', type=str, action='append', help=f'Device ID served, repeatable. Default: {DEFAULT_DEVICE_ID}.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many random seconds added to every request.')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Response bytes per second, per connection.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests failing with 503.')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Requests per second served before answering 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of throttled requests.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+
+    if args.tree:
+        tree = load_tree(args.tree)
+    elif args.db:
+        from .db_sqlite import db_connect
+        tree = load_index_tree(db_connect(args.db, readonly=True).cursor(), args.db_host, args.db_device_id)
+    else:
+        tree = SyntheticTree(fanout=args.fanout, depth=args.depth, files=args.files, seed=args.seed)
+
+    server = FakeEVSServer(tree, address=(args.bind, args.port), devices=args.device_id or (DEFAULT_DEVICE_ID,),
+        latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed,
+        verbose=args.verbose)
+    print(f"Serving fake EVS on http://{server.address}/ (stats at /stats)", file=sys.stderr)
+    # stop on SIGTERM too, printing the stats like on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.report()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import logging
+
+from .db_sqlite import db_cursor_select_pending_folders
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_FRONTIER_SIZE = 100000
+
+
+class Frontier:
+    '''In-memory queue of folders to scan, spilling past max_size to the unscanned folders of the database.'''
+
+    def __init__(self, folders=(), cursor=None, host=None, device_id=None, max_size=DEFAULT_FRONTIER_SIZE):
+        self.cursor = cursor
+        self.host = host
+        self.device_id = device_id
+        self.max_size = max_size if cursor is not None else None
+        self.__queue = list(folders)
+        self.__in_flight = set()
+        self.__spilled = False
+        if cursor is not None:
+            self.__refill()
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def __refill(self):
+        # skip folders already handed out, they are still unscanned in the database.
+        folders = db_cursor_select_pending_folders(self.cursor, host=self.host, device_id=self.device_id,
+            limit=self.max_size + len(self.__in_flight) + 1)
+        queued = set(self.__queue)
+        folders = [folder for folder in folders if folder not in self.__in_flight and folder not in queued]
+        self.__spilled = len(folders) > self.max_size
+        self.__queue.extend(folders[:self.max_size])
+        log.debug(f"Frontier: loaded {len(folders[:self.max_size])} folders from database")
+
+    def push(self, folders):
+        '''Queue discovered folders for scanning.'''
+        for folder in folders:
+            if self.max_size is not None and len(self.__queue) >= self.max_size:
+                self.__spilled = True
+                break
+            self.__queue.append(folder)
+
+    def pop(self, n=1):
+        '''Hand out up to n folders, or an empty list when the crawl is done.'''
+        if n <= 0:
+            return []
+        if not self.__queue and self.__spilled:
+            self.__refill()
+        # depth first, so the queue stays small and scans stay local on disk.
+        folders = self.__queue[-n:][::-1]
+        del self.__queue[-n:]
+        self.__in_flight.update(folders)
+        return folders
+
+    def done(self, folder):
+        '''Release a folder handed out by pop() once its status is written.'''
+        self.__in_flight.discard(folder)
@@ -0,0 +1,149 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+
+from .metrics import metrics_count, metrics_timed
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_HASH_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_HASH_BLOCK_SIZE = 1024 * 1024
+DEFAULT_HASH_MMAP_SIZE = 64 * 1024 * 1024
+
+HashResult = collections.namedtuple('HashResult', ('row', 'md5', 'error'))
+
+
+class HashStats:
+    '''Thread safe counters for content hashing.'''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.start = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.cached = 0
+        self.changed = 0
+        self.errors = 0
+
+    def add(self, files=0, bytes=0, cached=0, changed=0, errors=0):
+        with self.__lock:
+            self.files += files
+            self.bytes += bytes
+            self.cached += cached
+            self.changed += changed
+            self.errors += errors
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return dict(
+            files=self.files,
+            bytes=self.bytes,
+            cached=self.cached,
+            changed=self.changed,
+            errors=self.errors,
+            elapsed=elapsed,
+            files_per_sec=self.files / elapsed,
+            bytes_per_sec=self.bytes / elapsed,
+        )
+
+
+class ByteBudget:
+    '''Limit the bytes read per second, shared by all hashing threads.'''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.__next = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, n):
+        # each read reserves its share of a virtual clock, and sleeps until its turn
+        with self.__lock:
+            now = time.monotonic()
+            self.__next = max(self.__next, now)
+            delay = self.__next - now
+            self.__next += n / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def __stat_key(st_info):
+    return (st_info.st_dev, st_info.st_ino, st_info.st_size, st_info.st_mtime_ns)
+
+
+@metrics_timed('hash_file_seconds')
+def hash_file(path, key=None, block_size=DEFAULT_HASH_BLOCK_SIZE, mmap_size=DEFAULT_HASH_MMAP_SIZE, budget=None):
+    '''Return the hex md5 of a file, or None when its (dev, ino, size, mtime_ns) no longer matches key.'''
+    with open(path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        st_info = os.fstat(fd)
+        if key is not None and __stat_key(st_info) != tuple(key):
+            return None
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        md5 = hashlib.md5()
+        # large files through a read only mapping, smaller ones through one reused buffer
+        if st_info.st_size >= mmap_size:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+                for offset in range(0, len(view), block_size):
+                    block = view[offset:offset + block_size]
+                    if budget is not None:
+                        budget.consume(len(block))
+                    md5.update(block)
+                    block.release()
+        else:
+            buffer = bytearray(block_size)
+            with memoryview(buffer) as view:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    if budget is not None:
+                        budget.consume(n)
+                    md5.update(view[:n])
+        if key is not None and __stat_key(os.fstat(fd)) != tuple(key):
+            # modified while it was read.
+            return None
+    return md5.hexdigest()
+
+
+def __hash_row(row, block_size, budget, stats):
+    _, folder, filename, *key = row
+    try:
+        md5 = hash_file(os.path.join(folder, filename), key, block_size=block_size, budget=budget)
+    except OSError as e:
+        log.warning(f"hash_file(): {folder}{filename}: {e}")
+        if stats is not None:
+            stats.add(errors=1)
+        return HashResult(row, None, e)
+    if md5 is not None:
+        metrics_count('hash_bytes', key[2])
+    if stats is not None:
+        if md5 is None:
+            stats.add(changed=1)
+        else:
+            stats.add(files=1, bytes=key[2])
+    return HashResult(row, md5, None)
+
+
+def hash_files(rows, workers=None, block_size=DEFAULT_HASH_BLOCK_SIZE, budget=None, stats=None):
+    '''Hash rows of db_cursor_select_unhashed_files() concurrently and yield a HashResult per file as it completes.'''
+    workers = workers or DEFAULT_HASH_WORKERS
+    rows = iter(rows)
+    running = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for row in rows:
+                running.add(executor.submit(__hash_row, row, block_size, budget, stats))
+                if len(running) >= workers * 2:
+                    break
+            if not running:
+                break
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,295 @@
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import logging
+import multiprocessing
+import os
+
+from .db_sqlite import (
+    FileStatus,
+    db_connect,
+    db_create,
+    db_cursor_insert_files,
+    db_file_row,
+    db_folder_row,
+    db_cursor_update_folder_size,
+    db_cursor_update_folder_status,
+    db_cursor_update_folder_stat,
+    db_cursor_update_folder_listings,
+    db_cursor_select_folder_listing,
+    db_cursor_select_folder_filenames,
+    db_cursor_select_subfolders,
+    db_cursor_select_pending_folders,
+    db_cursor_count_subtree_folders,
+    db_cursor_reset_folders,
+    db_cursor_delete_files,
+    db_cursor_delete_subtrees,
+    db_cursor_update_rollups,
+    db_cursor_merge_shard,
+)
+from .checkpoint import Checkpointer, DEFAULT_CHECKPOINT_ROWS, DEFAULT_CHECKPOINT_SECONDS
+from .crawler import crawl_tree, CrawlStats, DEFAULT_CRAWL_RETRIES, DEFAULT_CRAWL_BATCH_SIZE
+from .evsweb import idrive_parse_lmd, idrive_parse_lmds
+from .frontier import Frontier, DEFAULT_FRONTIER_SIZE
+from .scanner import scan_tree, ScanStats, DEFAULT_SCAN_BATCH_SIZE
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_INGEST_PROCESSES = os.cpu_count() or 1
+DEFAULT_SHARD_DEPTH = 1
+SHARD_BY = ('subtree', 'device')
+
+__stats_counters = ('folders', 'files', 'entries', 'stat_calls', 'links', 'errors')
+
+
+def __listing_metadata(file_info):
+    # (mtime, size) of a folder as listed by its parent, if the listing has them.
+    lmd, size = file_info.get('lmd'), file_info.get('size')
+    if lmd is None or size is None:
+        return None
+    return idrive_parse_lmd(lmd), int(size)
+
+
+def ingest_online(cursor, frontier, host, device_id, workers=None, retries=DEFAULT_CRAWL_RETRIES, stats=None, recrawl=False, checkpoint=None,
+        batch_size=DEFAULT_CRAWL_BATCH_SIZE, skipped=None, max_memory=None):
+    '''Browse the remote folders of a Frontier and write their files and subfolders to the database in batches with their subtree totals, and return the CrawlStats.'''
+    stats = stats or CrawlStats()
+    checkpoint = checkpoint or Checkpointer(cursor)
+    skipped = skipped if skipped is not None else dict(folders=0, requests=0)
+
+    pending = None
+    if recrawl:
+        # only browse the folders whose listed metadata changed since their last crawl
+        def pending(folder, file_info):
+            metadata = __listing_metadata(file_info)
+            listing = db_cursor_select_folder_listing(cursor, folder, host=host, device_id=device_id)
+            if metadata is not None and listing is not None:
+                code, mtime, dir_size = listing
+                if code == FileStatus.SCANNED and (mtime, dir_size) == (float(metadata[0]), metadata[1]):
+                    skipped['folders'] += 1
+                    skipped['requests'] += db_cursor_count_subtree_folders(cursor, folder, host=host, device_id=device_id)
+                    return False
+            # pending in the database too, should the recrawl be resumed or the frontier spill
+            if listing is not None:
+                db_cursor_reset_folders(cursor, [folder], host=host, device_id=device_id)
+            return True
+
+    # large folders arrive in batches, interleaved with other folders: count
+    # their entries, and when recrawling their vanished files and subfolders,
+    # until done
+    counts, vanished, vanished_folders = collections.Counter(), dict(), dict()
+    for result in crawl_tree(frontier, device_id, workers=workers, retries=retries, stats=stats, pending=pending, batch_size=batch_size,
+            max_memory=max_memory):
+        root_folder, files = result.folder, result.files
+        if result.error is not None:
+            counts.pop(root_folder, None)
+            vanished.pop(root_folder, None)
+            vanished_folders.pop(root_folder, None)
+            db_cursor_update_folder_status(cursor, root_folder, FileStatus.ERROR, host=host, device_id=device_id)
+            checkpoint.add()
+            continue
+
+        if recrawl:
+            if root_folder not in vanished:
+                vanished[root_folder] = db_cursor_select_folder_filenames(cursor, root_folder, host=host, device_id=device_id)
+                vanished_folders[root_folder] = db_cursor_select_subfolders(cursor, root_folder, host=host, device_id=device_id)
+            vanished[root_folder].difference_update(file_info['name'] for file_info in files if not file_info['is_dir'])
+            vanished_folders[root_folder].difference_update(os.path.join(root_folder, file_info['name']) + '/' for file_info in files if file_info['is_dir'])
+
+        # add this batch of files and subfolders to database
+        rows, listings = [], []
+        mtimes = idrive_parse_lmds([file_info.get('lmd') for file_info in files])
+        for file_info, mtime in zip(files, mtimes):
+            filename, is_dir = file_info['name'], file_info['is_dir']
+            if is_dir:
+                folder = os.path.join(root_folder, filename) + '/'
+                rows.append(db_folder_row(folder, host=host, device_id=device_id))
+                if mtime is not None and file_info.get('size') is not None:
+                    listings.append((folder, mtime, int(file_info['size'])))
+            else:
+                rows.append(db_file_row(root_folder, filename, host=host, device_id=device_id, size=int(file_info['size']), mtime=mtime))
+        db_cursor_insert_files(cursor, rows)
+        db_cursor_update_folder_listings(cursor, listings, host=host, device_id=device_id)
+        counts[root_folder] += len(files)
+        if not result.done:
+            checkpoint.add(folders=0, rows=len(rows))
+            continue
+
+        if recrawl:
+            # forget files and subfolders removed since the last crawl, the subfolders with their subtree
+            db_cursor_delete_files(cursor, root_folder, vanished.pop(root_folder), host=host, device_id=device_id)
+            db_cursor_delete_subtrees(cursor, vanished_folders.pop(root_folder), host=host, device_id=device_id)
+
+        # update the size of the folder in the database with the number of files/folders
+        size = counts.pop(root_folder)
+        db_cursor_update_folder_size(cursor, root_folder, size, host=host, device_id=device_id)
+        db_cursor_update_folder_status(cursor, root_folder, FileStatus.SCANNED, host=host, device_id=device_id)
+
+        # commit when a checkpoint is due
+        checkpoint.add(rows=len(rows))
+    db_cursor_update_rollups(cursor)
+    checkpoint.commit()
+    return stats
+
+
+def ingest_local(cursor, frontier, host, workers=None, stats=None, pending=None, incremental=False, checkpoint=None,
+        batch_size=DEFAULT_SCAN_BATCH_SIZE, max_memory=None):
+    '''Scan local folders from a Frontier and write their files and subfolders to the database in batches with their subtree totals, and return the ScanStats.'''
+    # folders are committed in groups by a Checkpointer, each with its status once done, so an interrupted ingest resumes from the folders still pending.
+    stats = stats or ScanStats()
+    checkpoint = checkpoint or Checkpointer(cursor)
+    # large folders arrive in batches, interleaved with other folders: when
+    # incremental, track their files not listed again until done
+    vanished = dict()
+    for result in scan_tree(frontier, workers=workers, stats=stats, pending=pending, batch_size=batch_size, max_memory=max_memory):
+        if result.error is not None:
+            vanished.pop(result.folder, None)
+            db_cursor_update_folder_status(cursor, result.folder, FileStatus.ERROR, host=host)
+            checkpoint.add()
+            continue
+
+        # add this batch of files and subfolders to database
+        rows = [db_file_row(result.folder, filename, st_info=st_info, host=host) for filename, st_info in result.files]
+        rows.extend(db_folder_row(os.path.join(result.folder, filename) + '/', host=host) for filename, _ in result.folders)
+        db_cursor_insert_files(cursor, rows)
+        if incremental:
+            if result.folder not in vanished:
+                vanished[result.folder] = db_cursor_select_folder_filenames(cursor, result.folder, host=host)
+            vanished[result.folder].difference_update(filename for filename, _ in result.files)
+        if not result.done:
+            checkpoint.add(folders=0, rows=len(rows))
+            continue
+
+        if incremental:
+            # forget files removed since the last scan
+            db_cursor_delete_files(cursor, result.folder, vanished.pop(result.folder), host=host)
+
+        # update the size of the folder in the database with the number of files/folders
+        db_cursor_update_folder_size(cursor, result.folder, result.count, host=host)
+        db_cursor_update_folder_stat(cursor, result.folder, result.st_info, host=host)
+        db_cursor_update_folder_status(cursor, result.folder, FileStatus.SCANNED, host=host)
+
+        # commit when a checkpoint is due
+        checkpoint.add(rows=len(rows))
+    db_cursor_update_rollups(cursor)
+    checkpoint.commit()
+    return stats
+
+
+def ingest_shard(shard_path, host, workers=None, frontier_size=DEFAULT_FRONTIER_SIZE, checkpoint_rows=DEFAULT_CHECKPOINT_ROWS,
+        checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS, durability=None, batch_size=DEFAULT_SCAN_BATCH_SIZE, max_memory=None):
+    '''Ingest the pending folders of a shard database in a worker process, and return the report of its ScanStats.'''
+    conn = db_connect(shard_path)
+    try:
+        cursor = conn.cursor()
+        frontier = Frontier(cursor=cursor, host=host, max_size=frontier_size)
+        checkpoint = Checkpointer(cursor, rows=checkpoint_rows, seconds=checkpoint_seconds, durability=durability)
+        return ingest_local(cursor, frontier, host, workers=workers, checkpoint=checkpoint, batch_size=batch_size,
+            max_memory=max_memory).report()
+    finally:
+        conn.close()
+
+
+def __shard_paths(db_path):
+    '''Return the paths of the shard databases left next to a database.'''
+    return sorted(glob.glob(glob.escape(db_path) + '.shard-*.db'))
+
+
+def __remove_db(db_path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_path + suffix)
+
+
+def __folder_depth(folder):
+    return folder.count('/')
+
+
+def __partition_folders(folders, shards, shard_by):
+    if shard_by == 'device':
+        groups = collections.defaultdict(list)
+        for folder in folders:
+            try:
+                groups[os.stat(folder).st_dev].append(folder)
+            except OSError:
+                groups[None].append(folder)
+        return list(groups.values())
+    # sorted paths dealt round robin, so neighbouring subtrees, which are
+    # likely on the same disk, land in different shards.
+    folders = sorted(folders)
+    return [folders[i::shards] for i in range(min(shards, len(folders)))]
+
+
+def __seed_shard(shard_path, folders, host):
+    db_create(shard_path)
+    conn = db_connect(shard_path)
+    try:
+        db_cursor_insert_files(conn.cursor(), (db_folder_row(folder, host=host) for folder in folders))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def __run_shards(cursor, shard_paths, host, processes, workers, frontier_size, batch_size, max_memory, checkpoint, stats):
+    # shards are ingested in worker processes and merged here, one at a time,
+    # as they complete. A failed shard is left on disk to resume later.
+    failed = []
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = {executor.submit(ingest_shard, shard_path, host, workers, frontier_size,
+            checkpoint.rows, checkpoint.seconds, checkpoint.durability, batch_size, max_memory): shard_path for shard_path in shard_paths}
+        for future in concurrent.futures.as_completed(futures):
+            shard_path = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                log.warning(f"ingest_sharded(): {shard_path}: {e!r}")
+                failed.append(shard_path)
+                continue
+            stats.add(**{name: report[name] for name in __stats_counters})
+            folders, files = db_cursor_merge_shard(cursor, shard_path)
+            log.debug(f"ingest_sharded(): merged {folders} folders, {files} files from {shard_path}")
+            __remove_db(shard_path)
+            checkpoint.add(folders=report['folders'], rows=report['entries'])
+    return failed
+
+
+def ingest_sharded(cursor, db_path, root, host, processes=None, shards=None, workers=None, shard_depth=DEFAULT_SHARD_DEPTH,
+        shard_by='subtree', frontier_size=DEFAULT_FRONTIER_SIZE, stats=None, checkpoint=None, batch_size=DEFAULT_SCAN_BATCH_SIZE,
+        max_memory=None):
+    '''Ingest the pending folders with several processes, each into its own {db_path}.shard-N.db merged back as it completes, and return the ScanStats.'''
+    # the folders less than shard_depth levels below root are scanned first, and the pending folders left
+    # split into shards by subtree or by device. shards left by an interrupted run are resumed and merged first.
+    # max_memory applies to each worker process on its own.
+    processes = processes or DEFAULT_INGEST_PROCESSES
+    shards = shards or processes * 4
+    stats = stats or ScanStats()
+    checkpoint = checkpoint or Checkpointer(cursor)
+
+    failed = []
+    shard_paths = __shard_paths(db_path)
+    if shard_paths:
+        log.info(f"Resuming {len(shard_paths)} shards")
+        failed = __run_shards(cursor, shard_paths, host, processes, workers, frontier_size, batch_size, max_memory, checkpoint, stats)
+
+    # the folders of failed shards are still pending here, and are not handed out twice
+    if not failed:
+        # scan the top of the tree here, to split the pending folders below it
+        max_depth = __folder_depth(os.path.join(root, '')) + shard_depth
+        top = lambda folder: __folder_depth(folder) < max_depth
+        folders = [folder for folder in db_cursor_select_pending_folders(cursor, host=host) if top(folder)]
+        ingest_local(cursor, Frontier(folders), host, workers=workers, stats=stats, pending=top, checkpoint=checkpoint,
+            batch_size=batch_size, max_memory=max_memory)
+
+        shard_paths = []
+        for i, folders in enumerate(__partition_folders(db_cursor_select_pending_folders(cursor, host=host), shards, shard_by)):
+            shard_path = f'{db_path}.shard-{i:04d}.db'
+            __seed_shard(shard_path, folders, host)
+            shard_paths.append(shard_path)
+        log.info(f"Ingesting {len(shard_paths)} shards with {processes} processes")
+        __run_shards(cursor, shard_paths, host, processes, workers, frontier_size, batch_size, max_memory, checkpoint, stats)
+    db_cursor_update_rollups(cursor)
+    checkpoint.commit()
+    return stats
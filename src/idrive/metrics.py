@@ -0,0 +1,223 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+# upper bounds in seconds of the timing histogram buckets, the last one is +Inf.
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf'))
+
+__enabled = False
+__lock = threading.Lock()
+__counters = dict()
+__histograms = dict()
+__start = time.monotonic()
+
+
+def metrics_enable(enabled=True):
+    '''Turn metrics collection on or off. It is off until enabled.'''
+    global __enabled, __start
+    if enabled and not __enabled:
+        __start = time.monotonic()
+    __enabled = enabled
+
+
+def metrics_enabled():
+    return __enabled
+
+
+def metrics_reset():
+    with __lock:
+        __counters.clear()
+        __histograms.clear()
+
+
+def __key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def metrics_count(name, n=1, **labels):
+    '''Add n to a counter.'''
+    if not __enabled:
+        return
+    key = __key(name, labels)
+    with __lock:
+        __counters[key] = __counters.get(key, 0) + n
+
+
+def metrics_observe(name, seconds, **labels):
+    '''Add a duration to a timing histogram.'''
+    if not __enabled:
+        return
+    key = __key(name, labels)
+    with __lock:
+        histogram = __histograms.get(key)
+        if histogram is None:
+            histogram = __histograms[key] = [0, 0.0, seconds, seconds, [0] * len(METRICS_BUCKETS)]
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2] = min(histogram[2], seconds)
+        histogram[3] = max(histogram[3], seconds)
+        histogram[4][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+
+
+class MetricsTimer:
+    '''Context manager adding the duration of its block to a timing histogram.'''
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if metrics_enabled():
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            metrics_observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def metrics_timed(name, **labels):
+    '''Decorate a function to time its calls in a histogram, labeled with the function name.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not __enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics_observe(name, time.perf_counter() - start, function=func.__name__, **labels)
+        return wrapper
+    return decorator
+
+
+def metrics_peak_rss():
+    '''Return the peak resident memory in bytes of the process, or of its largest child process.'''
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    # in kilobytes, but in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def metrics_rss():
+    '''Return the resident memory in bytes of the process, or its peak where unknown.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return metrics_peak_rss()
+
+
+def metrics_over_memory(max_memory):
+    '''Return whether the resident memory of the process exceeds max_memory bytes, if any, counting the times it does.'''
+    if not max_memory or metrics_rss() <= max_memory:
+        return False
+    metrics_count('memory_throttled')
+    return True
+
+
+def metrics_report():
+    '''Return all metrics collected so far, with process totals, as a JSON serializable dict.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with __lock:
+        counters = [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in sorted(__counters.items())]
+        histograms = [dict(
+            name=name,
+            labels=dict(labels),
+            count=count,
+            sum=total,
+            min=low,
+            max=high,
+            mean=total / count,
+            buckets={str(bound): n for bound, n in zip(METRICS_BUCKETS, buckets)},
+        ) for (name, labels), (count, total, low, high, buckets) in sorted(__histograms.items())]
+    return dict(
+        process=dict(
+            elapsed=time.monotonic() - __start,
+            cpu_user=usage.ru_utime,
+            cpu_system=usage.ru_stime,
+            max_rss_kb=usage.ru_maxrss,
+        ),
+        counters=counters,
+        histograms=histograms,
+    )
+
+
+def __prometheus_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels.items()) + '}'
+
+
+def metrics_prometheus(report, prefix='idrive', job=None):
+    '''Format a metrics_report() in the Prometheus text exposition format.'''
+    extra = dict(job=job) if job else dict()
+    lines, types = [], set()
+    def metric_type(name, type):
+        if name not in types:
+            types.add(name)
+            lines.append(f'# TYPE {name} {type}')
+    for name, value in report['process'].items():
+        metric_type(f'{prefix}_process_{name}', 'gauge')
+        lines.append(f'{prefix}_process_{name}{__prometheus_labels({}, **extra)} {value}')
+    for counter in report['counters']:
+        name = f'{prefix}_{counter["name"]}_total'
+        metric_type(name, 'counter')
+        lines.append(f'{name}{__prometheus_labels(counter["labels"], **extra)} {counter["value"]}')
+    for histogram in report['histograms']:
+        name = f'{prefix}_{histogram["name"]}'
+        metric_type(name, 'histogram')
+        cumulative = 0
+        for bound, n in histogram['buckets'].items():
+            cumulative += n
+            le = '+Inf' if bound == 'inf' else bound
+            lines.append(f'{name}_bucket{__prometheus_labels(histogram["labels"], le=le, **extra)} {cumulative}')
+        lines.append(f'{name}_sum{__prometheus_labels(histogram["labels"], **extra)} {histogram["sum"]}')
+        lines.append(f'{name}_count{__prometheus_labels(histogram["labels"], **extra)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def __write_atomic(path, text):
+    # the textfile collector may read at any time, so never leave a partial file.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def metrics_add_arguments(parser):
+    '''Add the --stats and --prometheus options of every script to an ArgumentParser.'''
+    parser.add_argument('--stats', type=str, default=None, help='Collect metrics and write them as JSON to this file, - for stderr.')
+    parser.add_argument('--prometheus', type=str, default=None, help='Collect metrics and write them to this Prometheus textfile collector file.')
+
+
+def metrics_start(args):
+    '''Enable metrics if the script was asked for them.'''
+    if args.stats or args.prometheus:
+        metrics_enable()
+
+
+def metrics_finish(args, job=None):
+    '''Write the metrics the script was asked for.'''
+    if not metrics_enabled():
+        return
+    report = metrics_report()
+    if args.stats == '-':
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+    elif args.stats:
+        __write_atomic(args.stats, json.dumps(report, indent=2) + '\n')
+    if args.prometheus:
+        __write_atomic(args.prometheus, metrics_prometheus(report, job=job))
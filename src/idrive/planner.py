@@ -0,0 +1,98 @@
+import collections
+import logging
+import time
+
+from .db_sqlite import (
+    DB_STATUS_ORDERS,
+    FileStatus,
+    db_cursor_select_status_folders,
+    db_cursor_select_status_files,
+)
+from .metrics import metrics_count
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_BATCH_BYTES = 1024 * 1024 * 1024
+DEFAULT_BATCH_FILES = 10000
+PLAN_PRIORITIES = tuple(DB_STATUS_ORDERS)
+
+# files is a list of the (filename, size) of the batch, all in folder.
+UploadBatch = collections.namedtuple('UploadBatch', ('number', 'folder', 'files', 'bytes'))
+
+
+class PlanStats:
+    '''Counters for an upload plan.'''
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.batches = 0
+        self.files = 0
+        self.bytes = 0
+        self.huge = 0
+        self.deferred_files = 0
+        self.deferred_bytes = 0
+
+    def add(self, batches=0, files=0, bytes=0, huge=0, deferred_files=0, deferred_bytes=0):
+        self.batches += batches
+        self.files += files
+        self.bytes += bytes
+        self.huge += huge
+        self.deferred_files += deferred_files
+        self.deferred_bytes += deferred_bytes
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return dict(
+            batches=self.batches,
+            files=self.files,
+            bytes=self.bytes,
+            huge=self.huge,
+            deferred_files=self.deferred_files,
+            deferred_bytes=self.deferred_bytes,
+            elapsed=elapsed,
+            files_per_sec=self.files / elapsed,
+        )
+
+
+def plan_batches(cursor, host, device_id=None, priority='subtree', batch_bytes=DEFAULT_BATCH_BYTES, batch_files=DEFAULT_BATCH_FILES,
+        huge_size=None, budget=None, stats=None):
+    '''Yield UploadBatches of up to batch_bytes and batch_files of the DIRTY files of a device, folder by folder in one of the PLAN_PRIORITIES.'''
+    # files of at least huge_size bytes, by default batch_bytes, get a batch of their own. With a budget,
+    # files that do not fit are deferred, and folders whose smallest file does not fit are not read at all.
+    huge_size = huge_size or batch_bytes
+    stats = stats or PlanStats()
+    remaining = budget if budget is not None else float('inf')
+    number = 0
+
+    def batch(folder, files, size, huge=0):
+        nonlocal number, remaining
+        number += 1
+        remaining -= size
+        stats.add(batches=1, files=len(files), bytes=size, huge=huge)
+        metrics_count('plan_files', len(files))
+        metrics_count('plan_bytes', size)
+        return UploadBatch(number, folder, files, size)
+
+    # folders and their files are read through cursors of their own, as
+    # both are paged through while batches are yielded.
+    folders = db_cursor_select_status_folders(cursor.connection.cursor(), FileStatus.DIRTY, host=host, device_id=device_id, order=priority)
+    files_cursor = cursor.connection.cursor()
+    for folder_id, folder, count, size, min_size, _ in folders:
+        if min_size > remaining:
+            stats.add(deferred_files=count, deferred_bytes=int(size))
+            continue
+        files, files_size = [], 0
+        for filename, size, _ in db_cursor_select_status_files(files_cursor, folder_id, FileStatus.DIRTY, order=priority):
+            if size > remaining - files_size:
+                stats.add(deferred_files=1, deferred_bytes=size)
+            elif size >= huge_size:
+                yield batch(folder, [(filename, size)], size, huge=1)
+            else:
+                if files and (files_size + size > batch_bytes or len(files) >= batch_files):
+                    yield batch(folder, files, files_size)
+                    files, files_size = [], 0
+                files.append((filename, size))
+                files_size += size
+        if files:
+            yield batch(folder, files, files_size)
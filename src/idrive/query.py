@@ -1,19 +1,57 @@
 #!/usr/bin/env python
 
 import argparse
+import csv
+import io
+import json
 import os
 import pathlib
-import sqlite3 as sql
+import sys
 
-from idrive.db_sqlite import idrive_db_select_files
-from idrive.util import strip1
+from idrive.db_sqlite import db_connect, idrive_db_query_files, IBFILE_QUERY_COLUMNS
+from idrive.metrics import metrics_add_arguments, metrics_start, metrics_finish, metrics_count
+
+
+QUERY_FORMATS = ('text', 'csv', 'ndjson')
+QUERY_BATCH_SIZE = 10000
+
+
+def query_write(cursor, columns, stream, format='text', batch_size=QUERY_BATCH_SIZE):
+    '''Write the rows of idrive_db_query_files() to a stream and return their count.'''
+    writer = csv.writer(stream) if format == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        count += len(rows)
+        if format == 'ndjson':
+            stream.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+        elif writer is not None:
+            writer.writerows(rows)
+        else:
+            stream.writelines('\t'.join(map(str, row)) + '\n' for row in rows)
+    return count
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-db', '--database', type=pathlib.Path, default='index.db')
+    parser.add_argument('-c', '--columns', type=str, default='path', help=f'Comma separated columns to output: {",".join(IBFILE_QUERY_COLUMNS)}.')
+    parser.add_argument('-f', '--format', choices=QUERY_FORMATS, default='text', help='Output format, text is tab separated.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Output file. Default: stdout.')
+    parser.add_argument('--folder', type=str, default=None, help='Only files under this folder path prefix.')
+    parser.add_argument('--min-size', type=int, default=None, help='Only files of at least this size.')
+    parser.add_argument('--max-size', type=int, default=None, help='Only files of at most this size.')
+    parser.add_argument('--mtime-after', type=str, default=None, help='Only files modified at or after this FILE_LMD, e.g. "2024-01-31 00:00:00".')
+    parser.add_argument('--mtime-before', type=str, default=None, help='Only files modified at or before this FILE_LMD.')
+    parser.add_argument('--status', type=int, action='append', default=None, help='Only files of this BACKUP_STATUS, may be repeated.')
+    metrics_add_arguments(parser)
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
+    metrics_start(args)
     db_path = args.database
     verbose = args.verbose
 
@@ -21,12 +59,34 @@ def main():
         parser.error(f"ERROR: {db_path} is not a valid database")
         return
 
-    connection = sql.connect(f"file:{db_path}?mode=ro", uri=True)
+    columns = tuple(filter(None, args.columns.split(',')))
+    for name in columns:
+        if name not in IBFILE_QUERY_COLUMNS:
+            parser.error(f"invalid column: {name}")
+
+    connection = db_connect(db_path, readonly=True)
+
+    # only the requested columns of the matching rows leave SQLite, and they
+    # are written in batches as they are read
+    cursor = idrive_db_query_files(connection.cursor(), columns=columns, folder=args.folder,
+        min_size=args.min_size, max_size=args.max_size,
+        min_mtime=args.mtime_after, max_mtime=args.mtime_before, status=args.status)
+    if args.output:
+        stream = open(args.output, 'w', encoding='utf-8', errors='surrogateescape', newline='')
+    else:
+        stream = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='surrogateescape', newline='', write_through=False)
+    try:
+        count = query_write(cursor, columns, stream, format=args.format)
+    finally:
+        if args.output:
+            stream.close()
+        else:
+            stream.flush()
+    metrics_count('query_rows', count)
 
-    cursor = connection.cursor()
-    results = idrive_db_select_files(cursor)
-    for file in results:
-        print(strip1(file['ibfolder.NAME'], "'") + strip1(file['ibfile.NAME'], "'"))
+    if verbose:
+        print(f'{count} files', file=sys.stderr)
+    metrics_finish(args, job='idrive-query')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,59 @@
+import concurrent.futures
+import logging
+import os
+
+from .db_sqlite import (
+    FileStatus,
+    db_cursor_select_scanned_folders,
+    db_cursor_reset_folders,
+    db_cursor_delete_subtrees,
+)
+from .metrics import metrics_count
+from .scanner import DEFAULT_SCAN_WORKERS
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+
+def __stat_folder(folder):
+    try:
+        return os.stat(folder)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except OSError:
+        # unreadable now, rescan it so it is marked as an error.
+        return False
+
+
+def mark_changed_folders(cursor, host, device_id=None, workers=None, stats=None):
+    '''Stat every scanned folder, reset the changed ones so they are scanned again, and delete the vanished ones.'''
+    # changed means a new (dev, ino, mtime_ns, ctime_ns), i.e. entries were added, removed or renamed.
+    # Files modified in place in an unchanged folder are only noticed by a full scan.
+    workers = workers or DEFAULT_SCAN_WORKERS
+    select = db_cursor_select_scanned_folders(cursor.connection.cursor(), host=host, device_id=device_id)
+    checked, changed, vanished = 0, [], []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = select.fetchmany(workers * 256)
+            if not rows:
+                break
+            checked += len(rows)
+            metrics_count('fs_stat_calls', len(rows))
+            if stats is not None:
+                stats.add(stat_calls=len(rows))
+            for row, st_info in zip(rows, executor.map(__stat_folder, (row[0] for row in rows))):
+                folder, code, *metadata = row
+                if st_info is None:
+                    vanished.append(folder)
+                elif not st_info or code != FileStatus.SCANNED or \
+                        tuple(metadata) != (st_info.st_dev, st_info.st_ino, st_info.st_mtime_ns, st_info.st_ctime_ns):
+                    changed.append(folder)
+    log.debug(f"mark_changed_folders(): {len(changed)} changed, {len(vanished)} vanished of {checked} folders")
+    # the subfolders of a vanished folder, scanned or not, are gone too
+    db_cursor_delete_subtrees(cursor, vanished, host=host, device_id=device_id)
+    db_cursor_reset_folders(cursor, changed, host=host, device_id=device_id)
+    return dict(
+        checked=checked,
+        changed=len(changed),
+        vanished=len(vanished),
+    )
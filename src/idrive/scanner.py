@@ -0,0 +1,206 @@
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import queue
+import threading
+import time
+
+from .frontier import Frontier
+from .metrics import metrics_count, metrics_observe, metrics_over_memory
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+DEFAULT_SCAN_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+DEFAULT_INODE_CACHE_SIZE = 1 << 20
+DEFAULT_SCAN_BATCH_SIZE = 1000
+
+# folders and files are a batch of the entries of folder, count the entries
+# listed so far, and done is set on its last batch.
+ScanResult = collections.namedtuple('ScanResult', ('folder', 'st_info', 'folders', 'files', 'count', 'error', 'done'), defaults=(True,))
+
+
+class ScanStats:
+    '''Thread safe counters for a filesystem scan.'''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.start = time.monotonic()
+        self.folders = 0
+        self.files = 0
+        self.entries = 0
+        self.stat_calls = 0
+        self.links = 0
+        self.errors = 0
+
+    def add(self, folders=0, files=0, entries=0, stat_calls=0, links=0, errors=0):
+        with self.__lock:
+            self.folders += folders
+            self.files += files
+            self.entries += entries
+            self.stat_calls += stat_calls
+            self.links += links
+            self.errors += errors
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return dict(
+            folders=self.folders,
+            files=self.files,
+            entries=self.entries,
+            stat_calls=self.stat_calls,
+            links=self.links,
+            errors=self.errors,
+            elapsed=elapsed,
+            files_per_sec=self.files / elapsed,
+            stat_calls_per_entry=self.stat_calls / self.entries if self.entries else 0.0,
+        )
+
+
+class InodeCache:
+    '''Thread safe map of (dev, ino) to the stat of files with several hardlinks, forgetting the oldest past max_size.'''
+
+    def __init__(self, max_size=DEFAULT_INODE_CACHE_SIZE):
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+        self.__inodes = collections.OrderedDict()
+
+    def get(self, dev, ino):
+        with self.__lock:
+            return self.__inodes.get((dev, ino))
+
+    def add(self, st_info):
+        if st_info.st_nlink < 2:
+            return
+        with self.__lock:
+            self.__inodes[(st_info.st_dev, st_info.st_ino)] = st_info
+            if len(self.__inodes) > self.max_size:
+                self.__inodes.popitem(last=False)
+
+
+@contextlib.contextmanager
+def __open_folder(folder):
+    # scan by directory fd where supported, so stat() is relative to the open directory
+    if os.scandir in os.supports_fd:
+        fd = os.open(folder, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        try:
+            st_info = os.fstat(fd)
+            with os.scandir(fd) as it:
+                yield st_info, it
+        finally:
+            os.close(fd)
+    else:
+        st_info = os.stat(folder)
+        with os.scandir(folder) as it:
+            yield st_info, it
+
+
+def __count_scan(stats, files=0, entries=0, stat_calls=0, links=0, folders=0, errors=0):
+    metrics_count('fs_stat_calls', stat_calls)
+    metrics_count('fs_entries', entries)
+    metrics_count('fs_links', links)
+    if stats is not None:
+        stats.add(folders=folders, files=files, entries=entries, stat_calls=stat_calls, links=links, errors=errors)
+
+
+def scan_folder_iter(folder, stats=None, inodes=None, batch_size=DEFAULT_SCAN_BATCH_SIZE):
+    '''List a folder and yield ScanResults of its own stat and up to batch_size subfolders and regular files as it is read, stat-ing regular files only, once per inode with an InodeCache.'''
+    # the last ScanResult is done, with the error if the folder could not be listed. Without a batch_size,
+    # the whole folder is one ScanResult.
+    folders, files, count, entries_count, stat_calls, links = [], [], 0, 0, 0, 0
+    # the time spent listing, not waiting for the batches to be consumed
+    elapsed, start = 0.0, time.perf_counter()
+    try:
+        with __open_folder(folder) as (st_info, entries):
+            stat_calls += 1
+            for entry in entries:
+                filename = entry.name
+                # for now, ignore dot files and folders
+                if filename.startswith('.'):
+                    continue
+                count += 1
+                entries_count += 1
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((filename, None))
+                elif entry.is_file(follow_symlinks=False):
+                    # files of a folder are on its device
+                    file_st_info = inodes.get(st_info.st_dev, entry.inode()) if inodes is not None else None
+                    if file_st_info is not None:
+                        links += 1
+                    else:
+                        stat_calls += 1
+                        file_st_info = entry.stat(follow_symlinks=False)
+                        if inodes is not None:
+                            inodes.add(file_st_info)
+                    files.append((filename, file_st_info))
+                if batch_size and len(folders) + len(files) >= batch_size:
+                    elapsed += time.perf_counter() - start
+                    __count_scan(stats, files=len(files), entries=entries_count, stat_calls=stat_calls, links=links)
+                    yield ScanResult(folder, st_info, folders, files, count, None, False)
+                    folders, files, entries_count, stat_calls, links = [], [], 0, 0, 0
+                    start = time.perf_counter()
+    except OSError as e:
+        log.warning(f"scan_folder(): {folder}: {e}")
+        metrics_count('fs_errors')
+        __count_scan(stats, entries=entries_count, stat_calls=stat_calls, links=links, errors=1)
+        yield ScanResult(folder, None, [], [], count, e, True)
+        return
+    metrics_observe('fs_scan_folder_seconds', elapsed + time.perf_counter() - start)
+    __count_scan(stats, files=len(files), entries=entries_count, stat_calls=stat_calls, links=links, folders=1)
+    yield ScanResult(folder, st_info, folders, files, count, None, True)
+
+
+def scan_folder(folder, stats=None, inodes=None):
+    '''List a whole folder and return its ScanResult, see scan_folder_iter().'''
+    result, = scan_folder_iter(folder, stats=stats, inodes=inodes, batch_size=None)
+    return result
+
+
+def scan_tree(frontier, workers=None, stats=None, pending=None, inodes=None, batch_size=DEFAULT_SCAN_BATCH_SIZE, max_memory=None):
+    '''Walk the folders of a Frontier, or a list of roots, concurrently and yield ScanResults of up to batch_size entries as they are listed, sharing an InodeCache.'''
+    # at most 2 * workers batches wait to be consumed, so memory stays bounded however large a folder is, and past
+    # max_memory bytes of resident memory no new folder is started until the ones being listed are done.
+    if not isinstance(frontier, Frontier):
+        frontier = Frontier(frontier)
+    workers = workers or DEFAULT_SCAN_WORKERS
+    inodes = inodes if inodes is not None else InodeCache()
+    results = queue.Queue(maxsize=workers * 2)
+
+    def scan(folder):
+        done = False
+        try:
+            for result in scan_folder_iter(folder, stats, inodes, batch_size):
+                done = result.done
+                results.put(result)
+        except Exception as e:
+            # never leave a folder without its done result
+            if not done:
+                results.put(ScanResult(folder, None, [], [], 0, e, True))
+
+    running = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                slots = 1 if metrics_over_memory(max_memory) else workers * 2
+                for folder in frontier.pop(slots - running):
+                    executor.submit(scan, folder)
+                    running += 1
+                if not running:
+                    break
+                result = results.get()
+                if result.done:
+                    running -= 1
+                # with a pending predicate, only the subfolders it accepts are walked
+                folders = (os.path.join(result.folder, filename) + '/' for filename, _ in result.folders)
+                frontier.push(filter(pending, folders) if pending is not None else folders)
+                # the caller writes the listing before asking for the next result
+                yield result
+                if result.done:
+                    frontier.done(result.folder)
+        finally:
+            # unblock the workers of an abandoned scan, so they can finish
+            while running:
+                if results.get().done:
+                    running -= 1
@@ -0,0 +1,54 @@
+import logging
+import time
+
+from .db_sqlite import (
+    FileStatus,
+    db_cursor_count_files_by_status,
+    db_cursor_mark_moved_files,
+    db_cursor_mark_unmatched_files,
+    db_cursor_select_file_totals,
+    db_cursor_update_rollups,
+)
+
+
+log = logging.getLogger(__name__.split('.',1)[0])
+
+
+def sync_device(cursor, local_host, local_device_id, remote_host, remote_device_ids, dry_run=False, moves=True):
+    '''Mark every local file without a remote file of the same name and size, directly or through a hardlink, DIRTY, or MOVED when found under another name, in one transaction, and return a report.'''
+    start = time.monotonic()
+    examined = db_cursor_count_files_by_status(cursor, FileStatus.DEFAULT, host=local_host, device_id=local_device_id)
+    moved_files, moved_bytes = set(), 0
+    if moves:
+        for folder, filename, size, remote_path in db_cursor_mark_moved_files(cursor, FileStatus.MOVED,
+                local_host=local_host, local_device_id=local_device_id,
+                remote_host=remote_host, remote_device_ids=remote_device_ids, dry_run=dry_run):
+            # the remote file only needs to be renamed, not uploaded again.
+            log.debug(f"Marked file MOVED: {folder}{filename} from {remote_path}")
+            moved_files.add((folder, filename))
+            moved_bytes += size
+    dirty = 0
+    for folder, filename in db_cursor_mark_unmatched_files(cursor, FileStatus.DIRTY,
+            local_host=local_host, local_device_id=local_device_id,
+            remote_host=remote_host, remote_device_ids=remote_device_ids, dry_run=dry_run):
+        if (folder, filename) in moved_files:
+            # only in a dry run, where moved files are still DEFAULT.
+            continue
+        # mark files with no match with a status to schedule for backup.
+        log.debug(f"Marked file DIRTY: {folder}{filename}")
+        dirty += 1
+    if not dry_run:
+        db_cursor_update_rollups(cursor)
+        cursor.connection.commit()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    totals = db_cursor_select_file_totals(cursor, host=local_host, device_id=local_device_id, status=FileStatus.DIRTY)
+    return dict(
+        examined=examined,
+        dirty=dirty,
+        dirty_bytes=totals['bytes'],
+        dirty_unique_bytes=totals['unique_bytes'],
+        moved=len(moved_files),
+        moved_bytes=moved_bytes,
+        elapsed=elapsed,
+        rows_per_sec=examined / elapsed,
+    )
@@ -0,0 +1,66 @@
+import contextlib
+import http.server
+import json
+import sqlite3
+import threading
+import urllib.parse
+
+
+def create_index_db():
+    from idrive import db_sqlite
+    conn = sqlite3.connect(':memory:')
+    db_sqlite.__db_create_tables(conn)
+    return conn
+
+
+def upgrade_index_db(conn):
+    from idrive import db_sqlite
+    db_sqlite.__db_upgrade_tables(conn)
+    return conn
+
+
+@contextlib.contextmanager
+def evs_server(listings, failures=None):
+    '''Log into a minimal EVS server browsing a dict of folder listings, failing the paths of failures with a 503.'''
+    from idrive.evsweb import idrive_login, idrive_set_host
+    failures = failures if failures is not None else dict()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            command = self.path.rsplit('/', 1)[-1]
+            data = urllib.parse.parse_qs(self.rfile.read(int(self.headers['content-length'])).decode())
+            path = data.get('p', [''])[0]
+            if failures.get(path):
+                failures[path] -= 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            result = dict(message='SUCCESS')
+            if command == 'getServerAddress':
+                result.update(webApiServer='{}:{}'.format(*self.server.server_address))
+            elif command == 'validateAccount':
+                result.update(desc='VALID ACCOUNT')
+            elif command == 'browseFolder':
+                if path in listings:
+                    result.update(contents=listings[path])
+                else:
+                    result.update(message='FAILURE', desc='No such folder')
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        idrive_set_host('{}:{}'.format(*server.server_address), scheme='http')
+        assert idrive_login('uid', 'pwd')
+        yield server
+    finally:
+        server.shutdown()
+        idrive_set_host('evs.idrive.com', scheme='https')
@@ -0,0 +1,66 @@
+import unittest
+
+from helpers import create_index_db
+
+
+class TestCheckpointer(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [db_folder_row('/', host='h')])
+        self.cursor.connection.commit()
+
+    def test_group_commits(self):
+        from idrive.checkpoint import Checkpointer
+        checkpoint = Checkpointer(self.cursor, job='ingest', host='h', rows=4, seconds=float('inf'))
+        self.assertFalse(checkpoint.resumed)
+        self.assertEqual([checkpoint.add(rows=2) for _ in range(4)], [False, True, False, True])
+        self.assertEqual((checkpoint.progress['folders'], checkpoint.progress['rows'], checkpoint.progress['commits']), (4, 8, 2))
+
+    def test_resume(self):
+        from idrive.checkpoint import Checkpointer
+        checkpoint = Checkpointer(self.cursor, job='ingest', host='h', rows=1)
+        checkpoint.add(rows=1)
+        # a run that did not finish is resumed by the next run of the same job only
+        checkpoint = Checkpointer(self.cursor, job='ingest', host='h')
+        self.assertTrue(checkpoint.resumed)
+        self.assertEqual(checkpoint.progress['folders'], 1)
+        self.assertFalse(Checkpointer(self.cursor, job='other', host='h').resumed)
+        checkpoint.finish()
+        self.assertFalse(Checkpointer(self.cursor, job='ingest', host='h').resumed)
+
+    def test_durability(self):
+        from idrive.checkpoint import Checkpointer
+        Checkpointer(self.cursor, durability='off')
+        self.assertEqual(self.cursor.execute('''PRAGMA synchronous''').fetchone(), (0,))
+
+
+class TestIngestCheckpoints(unittest.TestCase):
+    def test_ingest_local(self):
+        import os
+        import tempfile
+        from idrive.checkpoint import Checkpointer
+        from idrive.db_sqlite import FileStatus, db_connect, db_create, db_cursor_insert_files, db_folder_row
+        from idrive.frontier import Frontier
+        from idrive.ingest import ingest_local
+        with tempfile.TemporaryDirectory() as root:
+            for path in ('a/x', 'b/y', 'c/z', 'd/w'):
+                os.makedirs(os.path.dirname(os.path.join(root, 'tree', path)), exist_ok=True)
+                open(os.path.join(root, 'tree', path), 'w').close()
+            folder = os.path.join(root, 'tree') + '/'
+            db_path = os.path.join(root, 'index.db')
+            db_create(db_path)
+            cursor = db_connect(db_path).cursor()
+            db_cursor_insert_files(cursor, [db_folder_row(folder, host='h')])
+            checkpoint = Checkpointer(cursor, job='ingest', host='h', rows=4, seconds=float('inf'), durability='normal')
+            ingest_local(cursor, Frontier(cursor=cursor, host='h'), 'h', workers=1, checkpoint=checkpoint)
+            # the root folder has 4 subfolders, each with 1 file, plus the final commit
+            self.assertEqual(checkpoint.progress['commits'], 3)
+            self.assertEqual((checkpoint.progress['folders'], checkpoint.progress['rows']), (5, 8))
+            # a run killed before it finished finds its folders written
+            cursor.connection.close()
+            cursor = db_connect(db_path).cursor()
+            self.assertTrue(Checkpointer(cursor, job='ingest', host='h').resumed)
+            codes = set(code for code, in cursor.execute('''SELECT code FROM folders WHERE host = "h"'''))
+            self.assertEqual(codes, {FileStatus.SCANNED})
+            cursor.connection.close()
@@ -0,0 +1,76 @@
+import unittest
+
+from helpers import evs_server
+
+
+LISTINGS = {
+    '/': [dict(name='a', is_dir=True), dict(name='x', is_dir=False, size='1', lmd='2020/01/01 00:00:00')],
+    '/a/': [dict(name='y', is_dir=False, size='2', lmd='2020/01/01 00:00:00')],
+}
+
+
+class TestCrawler(unittest.TestCase):
+    def test_crawl_tree(self):
+        from idrive.crawler import crawl_tree, CrawlStats
+        stats = CrawlStats()
+        with evs_server(LISTINGS):
+            results = {result.folder: result for result in crawl_tree(['/'], 'dev', workers=4, stats=stats)}
+        self.assertEqual(sorted(results), ['/', '/a/'])
+        self.assertEqual(results['/a/'].files, LISTINGS['/a/'])
+        report = stats.report()
+        self.assertEqual((report['folders'], report['files'], report['requests']), (2, 3, 2))
+
+    def test_retry_throttled(self):
+        from idrive.crawler import crawl_tree, CrawlStats
+        stats = CrawlStats()
+        with evs_server(LISTINGS, failures={'/a/': 2}):
+            results = {result.folder: result for result in crawl_tree(['/'], 'dev', workers=4, backoff=0.01, stats=stats)}
+        self.assertIsNone(results['/a/'].error)
+        self.assertEqual((stats.report()['retries'], stats.report()['throttled']), (2, 2))
+
+    def test_retries_exhausted(self):
+        from idrive.crawler import crawl_folder, CrawlStats
+        stats = CrawlStats()
+        with evs_server(LISTINGS, failures={'/a/': 3}):
+            *_, result = crawl_folder('dev', '/a/', retries=1, backoff=0.01, stats=stats)
+        self.assertIsNotNone(result.error)
+        self.assertEqual((stats.report()['retries'], stats.report()['errors']), (1, 1))
+
+    def test_no_retry_of_failures(self):
+        from idrive.crawler import crawl_folder, CrawlStats
+        stats = CrawlStats()
+        with evs_server(LISTINGS):
+            *_, result = crawl_folder('dev', '/missing/', backoff=0.01, stats=stats)
+        self.assertIsInstance(result.error, AssertionError)
+        self.assertEqual((stats.report()['requests'], stats.report()['retries']), (1, 0))
+
+    def test_adaptive_limiter(self):
+        from idrive.crawler import AdaptiveLimiter
+        limiter = AdaptiveLimiter(8)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 4.0)
+        for _ in range(100):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 8.0)
+
+    def test_batches(self):
+        from idrive.crawler import crawl_tree
+        from idrive.fakeevs import FakeEVSServer, SyntheticTree
+        from idrive.evsweb import idrive_login, idrive_set_host
+        tree = SyntheticTree(fanout=2, depth=1, files=25, seed=2)
+        with FakeEVSServer(tree) as server:
+            try:
+                idrive_set_host(server.address, scheme='http')
+                self.assertTrue(idrive_login('uid', 'pwd'))
+                results = list(crawl_tree(['/'], 'D01', workers=2, batch_size=10))
+            finally:
+                idrive_set_host('evs.idrive.com', scheme='https')
+        self.assertTrue(all(len(result.files) <= 10 and result.error is None for result in results))
+        # each folder is done once, after all its batches
+        done = [result.folder for result in results if result.done]
+        self.assertEqual(sorted(done), sorted(['/'] + [f'/{info["name"]}/' for info in tree('/') if info['is_dir']]))
+        for folder in done:
+            self.assertTrue([result.done for result in results if result.folder == folder][-1])
+        self.assertEqual(sum(len(result.files) for result in results), 27 + 50)
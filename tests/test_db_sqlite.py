@@ -0,0 +1,237 @@
+import sqlite3
+import unittest
+
+from helpers import create_index_db, upgrade_index_db
+
+
+class TestInsertFiles(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row, db_folder_row
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [
+            db_folder_row('/a', host='h'),
+            db_file_row('/a', 'x', host='h', size=1, mtime=1),
+        ])
+
+    def select(self):
+        return self.cursor.execute('''SELECT folder, filename, code, size, mtime FROM files ORDER BY filename''').fetchall()
+
+    def test_insert_files(self):
+        from idrive.db_sqlite import FileStatus
+        self.assertEqual(self.select(), [('/a/', '', FileStatus.DEFAULT, -1, -1.0), ('/a/', 'x', FileStatus.DEFAULT, 1, 1.0)])
+
+    def test_update_files(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_insert_files, db_file_row, db_folder_row
+        self.cursor.execute('''UPDATE folders SET code = ?''', (FileStatus.SCANNED,))
+        self.cursor.execute('''UPDATE entries SET code = ?''', (FileStatus.SCANNED,))
+        db_cursor_insert_files(self.cursor, [
+            db_folder_row('/a', host='h'),
+            db_file_row('/a', 'x', host='h', size=2, mtime=2),
+        ])
+        # a re-added folder keeps its status, a re-added file is reset like before
+        self.assertEqual(self.select(), [('/a/', '', FileStatus.SCANNED, -1, -1.0), ('/a/', 'x', FileStatus.DEFAULT, 2, 2.0)])
+
+    def test_device_ids(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row
+        db_cursor_insert_files(self.cursor, [db_file_row('/a', 'x', host='h', device_id='D01', size=3, mtime=3)])
+        rows = self.cursor.execute('''SELECT device_id, size FROM files WHERE filename = "x" ORDER BY device_id''').fetchall()
+        self.assertEqual(rows, [('', 1), ('D01', 3)])
+
+    def test_subfolders(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row, db_cursor_select_subfolders
+        db_cursor_insert_files(self.cursor, [db_folder_row(folder, host='h') for folder in ('/a/b', '/a/b/c', '/a/d', '/ab')])
+        self.assertEqual(db_cursor_select_subfolders(self.cursor, '/a', host='h'), {'/a/b/', '/a/d/'})
+
+    def test_delete_subtrees(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row, db_cursor_delete_subtrees
+        db_cursor_insert_files(self.cursor, [db_file_row('/a/b', 'y', host='h', size=1, mtime=1), db_file_row('/ab', 'z', host='h', size=1, mtime=1)])
+        db_cursor_delete_subtrees(self.cursor, ['/a'], host='h')
+        self.assertEqual(self.cursor.execute('''SELECT folder, filename FROM files''').fetchall(), [('/ab/', ''), ('/ab/', 'z')])
+        self.assertEqual(self.cursor.execute('''SELECT COUNT(*) FROM entries''').fetchone(), (1,))
+
+
+class TestMigrateFilesTable(unittest.TestCase):
+    def test_migrate_files_table(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('''CREATE TABLE files (host text not null, device_id text default "" not null, folder text default "" not null, filename text default "" not null,'''
+            ''' code integer default -1 not null, ino integer default -1 not null, dev integer default -1 not null, size integer default -1 not null, mtime real default -1 not null, md5 text)''')
+        conn.executemany('''INSERT INTO files (host, folder, filename, code, size, mtime) VALUES (?, ?, ?, ?, ?, ?)''', [
+            ('h', '/a/', '', 0, 1, -1.0),
+            ('h', '/a/', 'x', 1, 2, 3.0),
+            ('h', '/a/b/', 'y', -1, 4, 5.0),
+        ])
+        upgrade_index_db(conn)
+        rows = conn.execute('''SELECT folder, filename, code, size, mtime_ns FROM files ORDER BY folder, filename''').fetchall()
+        self.assertEqual(rows, [('/a/', '', 0, 1, -1), ('/a/', 'x', 1, 2, -1), ('/a/b/', '', -1, -1, -1), ('/a/b/', 'y', -1, 4, -1)])
+        parents = conn.execute('''SELECT child.path, parent.path FROM folders AS child LEFT JOIN folders AS parent ON child.parent_id = parent.id''').fetchall()
+        self.assertEqual(sorted(parents, key=str), [('/a/', None), ('/a/b/', '/a/')])
+        indexes = set(name for name, in conn.execute('''SELECT name FROM sqlite_master WHERE type = "index"'''))
+        self.assertIn('idx_folders_path', indexes)
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_cursor_update_rollups, db_file_row, db_folder_row
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [
+            db_folder_row('/', host='h'), db_folder_row('/a/', host='h'), db_folder_row('/a/b/', host='h'),
+            db_file_row('/', 'x', host='h', size=1, mtime=0), db_file_row('/a/', 'y', host='h', size=2, mtime=0),
+            db_file_row('/a/b/', 'z', host='h', size=4, mtime=0), db_file_row('/a/b/', 'w', host='h', size=8, mtime=0),
+            db_file_row('/', 'other', host='o', size=16, mtime=0),
+        ])
+        self.assertEqual(db_cursor_update_rollups(self.cursor), 4)
+
+    def test_select_rollups(self):
+        from idrive.db_sqlite import db_cursor_select_rollups
+        totals = db_cursor_select_rollups(self.cursor, '/', host='h', depth=1)
+        self.assertEqual(totals, [('/', 3, 4, 15, 0, 0), ('/a/', 2, 3, 14, 0, 0)])
+
+    def test_update_changed_folders(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_delete_files, db_cursor_select_rollups, db_cursor_update_rollups
+        self.cursor.execute('''UPDATE entries SET code = ? WHERE filename = "z"''', (FileStatus.DIRTY,))
+        db_cursor_delete_files(self.cursor, '/a/', ['y'], host='h')
+        # only the changed folders and their ancestors are summed up again
+        self.assertEqual(db_cursor_update_rollups(self.cursor), 3)
+        totals = db_cursor_select_rollups(self.cursor, '/a/', host='h', depth=5)
+        self.assertEqual(totals, [('/a/', 2, 2, 12, 1, 4), ('/a/b/', 1, 2, 12, 1, 4)])
+
+    def test_delete_subtrees(self):
+        from idrive.db_sqlite import db_cursor_delete_subtrees, db_cursor_rebuild_rollups, db_cursor_select_rollups, db_cursor_update_rollups
+        db_cursor_delete_subtrees(self.cursor, ['/a/b/'], host='h')
+        db_cursor_update_rollups(self.cursor)
+        totals = db_cursor_select_rollups(self.cursor, '/', host='h', depth=5)
+        self.assertEqual(totals, [('/', 2, 2, 3, 0, 0), ('/a/', 1, 1, 2, 0, 0)])
+        db_cursor_rebuild_rollups(self.cursor)
+        self.assertEqual(db_cursor_select_rollups(self.cursor, '/', host='h', depth=5), totals)
+
+
+class TestMergeShard(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = self.tmp.name + '/test.db'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_merge_existing_folder(self):
+        from idrive.db_sqlite import (
+            FileStatus, db_connect, db_create, db_cursor_insert_files, db_cursor_merge_shard,
+            db_cursor_update_folder_listings, db_cursor_update_folder_status, db_file_row, db_folder_row,
+        )
+        for path in (self.db_path, self.db_path + '.shard'):
+            db_create(path)
+        cursor = db_connect(self.db_path).cursor()
+        db_cursor_insert_files(cursor, [db_folder_row('/', host='h'), db_folder_row('/a/', host='h'), db_file_row('/a/', 'x', host='h', size=1, mtime=1)])
+        cursor.connection.commit()
+        shard = db_connect(self.db_path + '.shard')
+        db_cursor_insert_files(shard.cursor(), [db_folder_row('/a/', host='h'), db_folder_row('/a/b/', host='h'),
+            db_file_row('/a/', 'x', host='h', size=2, mtime=2), db_file_row('/a/b/', 'y', host='h', size=3, mtime=3)])
+        db_cursor_update_folder_listings(shard.cursor(), [('/a/', 5, 7)], host='h')
+        db_cursor_update_folder_status(shard.cursor(), '/a/', FileStatus.SCANNED, host='h')
+        shard.commit()
+        shard.close()
+        self.assertEqual(db_cursor_merge_shard(cursor, self.db_path + '.shard'), (2, 2))
+        # the folder already in the database takes the status and listing of the shard, and keeps its parent
+        rows = cursor.execute('''SELECT folders.path, folders.code, folders.mtime, folders.dir_size, parent.path FROM folders '''
+            '''LEFT JOIN folders AS parent ON parent.id = folders.parent_id ORDER BY folders.path''').fetchall()
+        self.assertEqual(rows, [('/', FileStatus.DEFAULT, -1.0, -1, None), ('/a/', FileStatus.SCANNED, 5.0, 7, '/'), ('/a/b/', FileStatus.DEFAULT, -1.0, -1, '/a/')])
+        files = cursor.execute('''SELECT folder, filename, size FROM files WHERE filename != "" ORDER BY folder''').fetchall()
+        self.assertEqual(files, [('/a/', 'x', 2), ('/a/b/', 'y', 3)])
+        cursor.connection.close()
+
+
+class TestImportIbfile(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from idrive.db_sqlite import create_table, db_connect, db_create
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ibfile_path = self.tmp.name + '/ib.db'
+        self.ib = sqlite3.connect(self.ibfile_path)
+        create_table(self.ib.cursor(), 'ibfolder')
+        create_table(self.ib.cursor(), 'ibfile')
+        self.ib.executemany('''INSERT INTO ibfolder (DIRID, NAME) VALUES (?, ?)''', [(1, "'/home/'"), (2, "'/home/me/docs'")])
+        self.ib.executemany('''INSERT INTO ibfile (DIRID, NAME, FILE_LMD, FILE_SIZE, BACKUP_STATUS, CHECKSUM, LAST_UPDATED) VALUES (?, ?, ?, ?, ?, ?, ?)''', [
+            (1, "'a'", '2024-01-01 00:00:10', 10, 1, "'0123456789ABCDEF0123456789ABCDEF'", '2024-01-01 00:00:00'),
+            (2, "'b'", '2024-01-01 00:00:20', 20, 1, "'-'", '2024-01-01 00:00:00'),
+            (2, "'c'", '2024-01-01 00:00:30', 30, 0, "'-'", '2024-01-01 00:00:00'),
+        ])
+        self.ib.commit()
+        db_create(self.tmp.name + '/index.db')
+        self.cursor = db_connect(self.tmp.name + '/index.db').cursor()
+
+    def tearDown(self):
+        self.ib.close()
+        self.cursor.connection.close()
+        self.tmp.cleanup()
+
+    def files(self):
+        return self.cursor.execute('''SELECT folder, filename, size, mtime, md5 FROM files WHERE host = "evs" AND device_id = "D01" AND filename != "" '''
+            '''ORDER BY filename''').fetchall()
+
+    def test_import(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_import_ibfile
+        report = db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        self.assertEqual((report['folders'], report['files'], report['removed']), (4, 2, 0))
+        self.assertEqual(self.files(), [
+            ('/home/', 'a', 10, 1704067210.0, '0123456789abcdef0123456789abcdef'),
+            ('/home/me/docs/', 'b', 20, 1704067220.0, None),
+        ])
+        # missing parents are added, and all folders are scanned
+        folders = dict(self.cursor.execute('''SELECT child.path, parent.path FROM folders AS child LEFT JOIN folders AS parent ON parent.id = child.parent_id'''))
+        self.assertEqual(folders, {'/': None, '/home/': '/', '/home/me/': '/home/', '/home/me/docs/': '/home/me/'})
+        self.assertEqual(set(code for code, in self.cursor.execute('''SELECT code FROM folders''')), {FileStatus.SCANNED})
+
+    def test_incremental(self):
+        from idrive.db_sqlite import db_cursor_import_ibfile
+        db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        # only the files updated since are read again
+        self.ib.execute('''UPDATE ibfile SET FILE_SIZE = 11, LAST_UPDATED = ? WHERE NAME = "'a'"''', ('2024-02-01 00:00:00',))
+        self.ib.execute('''UPDATE ibfile SET BACKUP_STATUS = 0, LAST_UPDATED = ? WHERE NAME = "'b'"''', ('2024-02-01 00:00:00',))
+        self.ib.commit()
+        report = db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        self.assertEqual((report['since'], report['last_updated']), ('2024-01-01 00:00:00', '2024-02-01 00:00:00'))
+        self.assertEqual((report['folders'], report['files'], report['removed']), (0, 1, 1))
+        self.assertEqual(self.files(), [('/home/', 'a', 11, 1704067210.0, '0123456789abcdef0123456789abcdef')])
+        report = db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        self.assertEqual((report['files'], report['removed']), (0, 0))
+
+    def test_incremental_deleted_files(self):
+        from idrive.db_sqlite import db_cursor_import_ibfile, db_cursor_insert_files, db_file_row
+        db_cursor_insert_files(self.cursor, [db_file_row('/other/', 'z', host='evs', device_id='D02', size=1, mtime=1)])
+        db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        # rows deleted from the client database are not updated, but no longer in ibfile
+        self.ib.execute('''DELETE FROM ibfile WHERE NAME = "'b'"''')
+        self.ib.commit()
+        report = db_cursor_import_ibfile(self.cursor, self.ibfile_path, host='evs', device_id='D01')
+        self.assertEqual((report['files'], report['removed']), (0, 1))
+        self.assertEqual([filename for _, filename, *_ in self.files()], ['a'])
+        # the files of other devices are kept
+        self.assertEqual(self.cursor.execute('''SELECT filename FROM files WHERE device_id = "D02" AND filename != ""''').fetchall(), [('z',)])
+
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = self.tmp.name + '/test.db'
+        sqlite3.connect(self.db_path).close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pragmas(self):
+        from idrive.db_sqlite import db_connect
+        conn = db_connect(self.db_path)
+        self.assertEqual(conn.execute('''PRAGMA journal_mode''').fetchone(), ('wal',))
+        self.assertEqual(conn.execute('''PRAGMA temp_store''').fetchone(), (2,))
+        conn.close()
+
+    def test_readonly(self):
+        from idrive.db_sqlite import db_connect
+        conn = db_connect(self.db_path, readonly=True, temp_store='FILE')
+        self.assertEqual(conn.execute('''PRAGMA temp_store''').fetchone(), (1,))
+        self.assertEqual(conn.execute('''PRAGMA query_only''').fetchone(), (1,))
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute('''CREATE TABLE t (x)''')
+        conn.close()
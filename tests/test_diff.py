@@ -0,0 +1,49 @@
+import sqlite3
+import unittest
+
+from helpers import create_index_db
+
+
+class TestDiff(unittest.TestCase):
+    def test_diff_merge(self):
+        from idrive.diff import diff_merge, ONLY_ONLINE, ONLY_LOCAL, MISMATCHED
+        online = [('/a', '/a', 1), ('/b', '/b', 2), ('/c', '/c', 3)]
+        local = [('/b', '/b', 2), ('/c', '/c', 4), ('/d', '/d', 5)]
+        results = list(diff_merge(online, local, key=('path',), compare=('size',)))
+        self.assertEqual(results, [
+            (ONLY_ONLINE, ('/a', 1), None),
+            (MISMATCHED, ('/c', 3), ('/c', 4)),
+            (ONLY_LOCAL, None, ('/d', 5)),
+        ])
+
+    def test_diff_merge_duplicate_keys(self):
+        from idrive.diff import diff_merge, ONLY_LOCAL, MATCHED
+        online = [(1, 'x', '/a/x', 1)]
+        local = [(1, 'x', '/b/x', 1), (1, 'x', '/c/x', 1)]
+        # nothing to compare but the key, so pairs are never mismatched
+        results = list(diff_merge(online, local, key=('size', 'name'), compare=(), matched=True))
+        self.assertEqual(results, [(MATCHED, ('/a/x', 1), ('/b/x', 1)), (ONLY_LOCAL, None, ('/c/x', 1))])
+
+    def test_diff_select_files(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row
+        from idrive.diff import diff_select
+        cursor = create_index_db().cursor()
+        db_cursor_insert_files(cursor, [
+            db_file_row('/root/b', 'y', host='h', size=2, mtime=0),
+            db_file_row('/root/a', 'z', host='h', size=1, mtime=0),
+            db_file_row('/root', 'x', host='h', size=2, mtime=0),
+            db_file_row('/root', 'empty', host='h', size=0, mtime=0),
+            db_file_row('/other', 'w', host='h', size=1, mtime=0),
+        ])
+        rows = list(diff_select(cursor, key=('size', 'name'), root='/root/'))
+        self.assertEqual(rows, [(1, 'z', 'a/z', 1), (2, 'x', 'x', 2), (2, 'y', 'b/y', 2)])
+
+    def test_diff_select_ibfile(self):
+        from idrive.diff import diff_select
+        conn = sqlite3.connect(':memory:')
+        conn.execute('''CREATE TABLE ibfolder (DIRID integer primary key, NAME text)''')
+        conn.execute('''CREATE TABLE ibfile (DIRID integer, NAME text, FILE_SIZE integer)''')
+        conn.execute('''INSERT INTO ibfolder VALUES (1, "'/a/'")''')
+        conn.executemany('''INSERT INTO ibfile VALUES (1, ?, ?)''', [("'x'", 1), ("y", 2)])
+        rows = list(diff_select(conn.cursor(), key=('path',)))
+        self.assertEqual(rows, [('/a/x', '/a/x', 1), ('/a/y', '/a/y', 2)])
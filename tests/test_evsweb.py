@@ -0,0 +1,93 @@
+import unittest
+
+
+class TestBrowseFolder(unittest.TestCase):
+    def setUp(self):
+        from idrive.evsweb import idrive_login, idrive_set_host
+        from idrive.fakeevs import FakeEVSServer, SyntheticTree
+        self.tree = SyntheticTree(fanout=2, depth=1, files=25, seed=2)
+        self.server = FakeEVSServer(self.tree).__enter__()
+        idrive_set_host(self.server.address, scheme='http')
+        self.assertTrue(idrive_login('uid', 'pwd'))
+
+    def tearDown(self):
+        from idrive.evsweb import idrive_set_host
+        idrive_set_host('evs.idrive.com', scheme='https')
+        self.server.__exit__(None, None, None)
+
+    def test_browse_folder_iter(self):
+        from idrive.evsweb import idrive_browseFolder, idrive_browseFolder_iter
+        self.assertEqual(list(idrive_browseFolder_iter('D01', '/', chunk_size=7)), self.tree('/'))
+        self.assertEqual(list(idrive_browseFolder_iter('D01', '/')), idrive_browseFolder('D01', '/'))
+
+    def test_browse_folder_iter_failure(self):
+        from idrive.evsweb import idrive_browseFolder_iter
+        with self.assertRaises(AssertionError):
+            list(idrive_browseFolder_iter('D01', '/missing/'))
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name + '/cache.db'
+
+    def tearDown(self):
+        from idrive.evsweb import idrive_set_cache, idrive_set_host
+        idrive_set_cache(None)
+        idrive_set_host('evs.idrive.com', scheme='https')
+        self.tmp.cleanup()
+
+    def test_browse_folder(self):
+        import sqlite3
+        from idrive.evsweb import idrive_login, idrive_set_host, idrive_set_cache, idrive_browseFolder, idrive_browseFolder_iter, ResponseCache
+        from idrive.fakeevs import FakeEVSServer, SyntheticTree
+        tree = SyntheticTree(fanout=2, depth=1, files=20, seed=3)
+        cache = ResponseCache(self.path)
+        with FakeEVSServer(tree) as server:
+            idrive_set_host(server.address, scheme='http')
+            self.assertTrue(idrive_login('uid', 'pwd'))
+            idrive_set_cache(cache)
+            for _ in range(2):
+                self.assertEqual(list(idrive_browseFolder_iter('D01', '/')), tree('/'))
+            self.assertEqual(idrive_browseFolder('D01', '/'), tree('/'))
+            # failures are not cached
+            for _ in range(2):
+                with self.assertRaises(AssertionError):
+                    idrive_browseFolder('D01', '/missing/')
+            self.assertEqual(server.stats.report()['commands']['browseFolder'], 3)
+        report = cache.report()
+        self.assertEqual((report['hits'], report['misses'], report['stores']), (2, 3, 1))
+        rows = sqlite3.connect(self.path).execute('''SELECT server, device_id, command, path, content FROM responses''').fetchall()
+        self.assertEqual([row[1:4] for row in rows], [('D01', 'browseFolder', '/')])
+        self.assertFalse(any(b'pwd' in content for *_, content in rows))
+        cache.ttls['browseFolder'] = 0
+        self.assertIsNone(cache.get(tuple(rows[0][:4])))
+
+    def test_evictions(self):
+        import sqlite3
+        from idrive.evsweb import ResponseCache
+        cache = ResponseCache(self.path, max_size=4000)
+        for i in range(10):
+            cache.put(('s', 'D01', 'browseFolder', f'/{i}/'), b'x' * 1000)
+        # a response stored again replaces its size in the total
+        cache.put(('s', 'D01', 'browseFolder', '/9/'), b'x' * 500)
+        report = cache.report()
+        self.assertEqual((report['stores'], report['evictions'], report['entries'], report['bytes']), (11, 6, 4, 3500))
+        self.assertEqual(report['bytes'], sqlite3.connect(self.path).execute('''SELECT TOTAL(size) FROM responses''').fetchone()[0])
+        # the least recently used responses were evicted
+        self.assertIsNone(cache.get(('s', 'D01', 'browseFolder', '/5/')))
+        self.assertIsNotNone(cache.get(('s', 'D01', 'browseFolder', '/6/')))
+        # the total of a cache is kept when opened again
+        self.assertEqual(ResponseCache(self.path, max_size=4000).report()['bytes'], 3500)
+
+
+class TestParseLmd(unittest.TestCase):
+    def test_parse_lmds(self):
+        from idrive.evsweb import idrive_format_lmd, idrive_parse_lmd, idrive_parse_lmds
+        lmds = ['2020/01/01 00:00:00', '2020/01/01 12:34:56', None, '2024/02/29 23:59:59', '2024-02-29 23:59:59']
+        with self.assertRaises(ValueError):
+            idrive_parse_lmds(lmds)
+        lmds.pop()
+        self.assertEqual(idrive_parse_lmds(lmds), [lmd and idrive_parse_lmd(lmd) for lmd in lmds])
+        self.assertEqual(idrive_format_lmd(idrive_parse_lmd(lmds[1])), lmds[1])
@@ -0,0 +1,54 @@
+import unittest
+
+from helpers import create_index_db
+
+
+class TestFakeEVS(unittest.TestCase):
+    def tearDown(self):
+        from idrive.evsweb import idrive_set_host
+        idrive_set_host('evs.idrive.com', scheme='https')
+
+    def login(self, server):
+        from idrive.evsweb import idrive_login, idrive_set_host
+        idrive_set_host(server.address, scheme='http')
+        self.assertTrue(idrive_login('uid', 'pwd'))
+
+    def test_synthetic_tree(self):
+        from idrive.fakeevs import SyntheticTree
+        tree = SyntheticTree(fanout=3, depth=2, files=2, seed=1)
+        self.assertEqual(len(tree('/')), 5)
+        self.assertEqual(tree('/'), SyntheticTree(fanout=3, depth=2, files=2, seed=1)('/'))
+        self.assertIsNone(tree('/missing/'))
+
+    def test_index_tree(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row, db_folder_row
+        from idrive.fakeevs import load_index_tree
+        cursor = create_index_db().cursor()
+        db_cursor_insert_files(cursor, [db_folder_row('/', host='h'), db_folder_row('/a', host='h'), db_file_row('/a', 'x', host='h', size=3, mtime=0)])
+        tree = load_index_tree(cursor, 'h')
+        self.assertEqual([(entry['name'], entry['is_dir']) for entry in tree('/')], [('a', True)])
+        self.assertEqual([(entry['name'], entry['size']) for entry in tree('/a/')], [('x', '3')])
+        self.assertIsNone(tree('/b/'))
+
+    def test_crawl_with_faults(self):
+        from idrive.crawler import crawl_tree, CrawlStats
+        from idrive.fakeevs import FakeEVSServer, SyntheticTree
+        with FakeEVSServer(SyntheticTree(fanout=3, depth=2, files=2, seed=1), retry_after=0, seed=1) as server:
+            self.login(server)
+            server.error_rate = server.throttle_rate = 0.1
+            stats = CrawlStats()
+            results = list(crawl_tree(['/'], 'D01', workers=4, retries=10, backoff=0.001, stats=stats))
+        self.assertEqual(len(results), 13)
+        self.assertTrue(all(result.error is None for result in results))
+        report = server.stats.report()
+        self.assertEqual(stats.report()['retries'], report['errors'] + report['throttled'])
+        self.assertEqual(report['commands']['browseFolder'], stats.report()['requests'])
+
+    def test_unknown_device(self):
+        from idrive.evsweb import idrive_browseFolder
+        from idrive.fakeevs import FakeEVSServer, SyntheticTree
+        with FakeEVSServer(SyntheticTree(depth=1, files=1)) as server:
+            self.login(server)
+            self.assertIsNotNone(idrive_browseFolder('D01', '/'))
+            with self.assertRaises(AssertionError):
+                idrive_browseFolder('D02', '/')
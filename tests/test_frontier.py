@@ -0,0 +1,45 @@
+import unittest
+
+from helpers import create_index_db
+
+
+class TestFrontier(unittest.TestCase):
+    def test_without_cursor(self):
+        from idrive.frontier import Frontier
+        frontier = Frontier(['/a/'])
+        frontier.push(['/b/', '/c/'])
+        # depth first
+        self.assertEqual(frontier.pop(2), ['/c/', '/b/'])
+        self.assertEqual(frontier.pop(2), ['/a/'])
+        self.assertEqual(frontier.pop(2), [])
+
+    def test_seed_from_database(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        from idrive.frontier import Frontier
+        cursor = create_index_db().cursor()
+        db_cursor_insert_files(cursor, [db_folder_row('/a', host='h'), db_folder_row('/b', host='h'), db_folder_row('/c', host='other')])
+        frontier = Frontier(cursor=cursor, host='h')
+        self.assertEqual(sorted(frontier.pop(10)), ['/a/', '/b/'])
+
+    def test_spill(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        from idrive.frontier import Frontier
+        cursor = create_index_db().cursor()
+        db_cursor_insert_files(cursor, [db_folder_row('/a', host='h'), db_folder_row('/b', host='h')])
+        frontier = Frontier(cursor=cursor, host='h', max_size=1)
+        self.assertEqual(len(frontier), 1)
+        seen = frontier.pop(10)
+        folders = ['/c/', '/d/']
+        db_cursor_insert_files(cursor, [db_folder_row(folder, host='h') for folder in folders])
+        frontier.push(folders)
+        self.assertEqual(len(frontier), 1)
+        # folders dropped from memory are read back from the database, but not those in flight
+        while True:
+            batch = frontier.pop(10)
+            if not batch:
+                break
+            seen.extend(batch)
+            for folder in batch:
+                cursor.execute('''UPDATE folders SET code = 0 WHERE path = ?''', (folder,))
+                frontier.done(folder)
+        self.assertEqual(sorted(seen), ['/a/', '/b/', '/c/', '/d/'])
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from helpers import create_index_db
+
+
+class TestHashFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name + '/'
+        for name, data in (('x', b'x' * 3000), ('y', b'')):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(data)
+        self.cursor = create_index_db().cursor()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rows(self, names, host='h'):
+        from idrive.db_sqlite import db_file_row
+        return [db_file_row(self.root, name, host=host, st_info=os.stat(os.path.join(self.root, name))) for name in names]
+
+    def hash(self, host='h', update_host='h'):
+        from idrive.db_sqlite import db_cursor_select_unhashed_files, db_cursor_update_file_md5s
+        from idrive.hasher import hash_files, ByteBudget
+        unhashed = db_cursor_select_unhashed_files(self.cursor, host=host)
+        results = list(hash_files(unhashed, workers=2, block_size=1024, budget=ByteBudget(1e9)))
+        db_cursor_update_file_md5s(self.cursor, [(row[0], *row[2:], md5) for row, md5, _ in results], host=update_host)
+
+    def md5s(self):
+        return dict(self.cursor.execute('''SELECT filename, md5 FROM files WHERE filename != ""'''))
+
+    def test_hash_files(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_cursor_select_unhashed_files
+        from idrive.hasher import hash_file
+        db_cursor_insert_files(self.cursor, self.rows(('x', 'y')))
+        self.hash()
+        self.assertEqual(db_cursor_select_unhashed_files(self.cursor, host='h'), [])
+        self.assertEqual(self.md5s(), dict(x=hashlib.md5(b'x' * 3000).hexdigest(), y=hashlib.md5().hexdigest()))
+        self.assertEqual(hash_file(os.path.join(self.root, 'x'), mmap_size=1), self.md5s()['x'])
+
+    def test_changed_file(self):
+        from idrive.hasher import hash_file
+        st_info = os.stat(os.path.join(self.root, 'x'))
+        key = (st_info.st_dev, st_info.st_ino, st_info.st_size, st_info.st_mtime_ns)
+        with open(os.path.join(self.root, 'x'), 'ab') as f:
+            f.write(b'x')
+        self.assertIsNone(hash_file(os.path.join(self.root, 'x'), key))
+
+    def test_insert_files(self):
+        from idrive.db_sqlite import db_cursor_insert_files
+        db_cursor_insert_files(self.cursor, self.rows(('x', 'y')))
+        self.hash()
+        # files added again keep their md5 only when unchanged
+        with open(os.path.join(self.root, 'x'), 'ab') as f:
+            f.write(b'x')
+        db_cursor_insert_files(self.cursor, self.rows(('x', 'y')))
+        self.assertEqual(self.md5s(), dict(x=None, y=hashlib.md5().hexdigest()))
+
+    def test_cached_md5s(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_cursor_fill_cached_md5s, db_cursor_select_unhashed_files
+        db_cursor_insert_files(self.cursor, self.rows(('x', 'y')))
+        self.hash()
+        # the cache refills the hashes of files indexed again, even under a new name
+        os.rename(os.path.join(self.root, 'x'), os.path.join(self.root, 'z'))
+        self.cursor.execute('''DELETE FROM entries''')
+        db_cursor_insert_files(self.cursor, self.rows(('y', 'z')))
+        self.assertEqual(db_cursor_fill_cached_md5s(self.cursor, host='h'), 2)
+        self.assertEqual(db_cursor_select_unhashed_files(self.cursor, host='h'), [])
+
+    def test_other_host(self):
+        from idrive.db_sqlite import db_cursor_insert_files
+        db_cursor_insert_files(self.cursor, self.rows(('x',)))
+        # hashes are only recorded for the files of the given host
+        self.hash(update_host='other')
+        self.assertEqual(self.md5s(), dict(x=None))
+
+    def test_hardlinks(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_cursor_select_unhashed_files
+        os.link(os.path.join(self.root, 'x'), os.path.join(self.root, 'z'))
+        db_cursor_insert_files(self.cursor, self.rows(('x', 'y', 'z')))
+        # the inode of x and z is read once, and its md5 recorded for both
+        self.assertEqual(sorted(row[2] for row in db_cursor_select_unhashed_files(self.cursor, host='h')), ['x', 'y'])
+        self.hash()
+        md5s = self.md5s()
+        self.assertEqual(md5s['x'], md5s['z'])
+        self.assertIsNotNone(md5s['z'])
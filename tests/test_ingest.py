@@ -0,0 +1,152 @@
+import unittest
+
+from helpers import create_index_db, evs_server
+
+
+def listing(name, is_dir, lmd='2020/01/01 00:00:00', size='1'):
+    return dict(name=name, is_dir=is_dir, size=size, lmd=lmd)
+
+
+class TestIngestOnline(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        self.listings = {
+            '/': [listing('a', True, size='2'), listing('x', False)],
+            '/a/': [listing('b', True), listing('c', True)],
+            '/a/b/': [listing('y', False)],
+            '/a/c/': [listing('d', True)],
+            '/a/c/d/': [listing('z', False)],
+        }
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [db_folder_row('/', host='h', device_id='D01')])
+
+    def ingest(self, recrawl=False, frontier_size=100, batch_size=1000):
+        from idrive.db_sqlite import db_cursor_reset_folders
+        from idrive.frontier import Frontier
+        from idrive.ingest import ingest_online
+        skipped = dict(folders=0, requests=0)
+        if recrawl:
+            db_cursor_reset_folders(self.cursor, ['/'], host='h', device_id='D01')
+        with evs_server(self.listings):
+            stats = ingest_online(self.cursor, Frontier(cursor=self.cursor, host='h', device_id='D01', max_size=frontier_size), 'h', 'D01', workers=1, recrawl=recrawl, batch_size=batch_size, skipped=skipped)
+        return stats.report(), skipped
+
+    def paths(self):
+        return set(path for path, in self.cursor.execute('''SELECT folder || filename FROM files'''))
+
+    def test_ingest_online(self):
+        from idrive.db_sqlite import FileStatus
+        report, _ = self.ingest()
+        self.assertEqual((report['folders'], report['files']), (5, 7))
+        self.assertEqual(self.paths(), {'/', '/x', '/a/', '/a/b/', '/a/b/y', '/a/c/', '/a/c/d/', '/a/c/d/z'})
+        codes = set(code for code, in self.cursor.execute('''SELECT code FROM files WHERE filename = ""'''))
+        self.assertEqual(codes, {FileStatus.SCANNED})
+
+    def test_recrawl_unchanged(self):
+        self.ingest()
+        report, skipped = self.ingest(recrawl=True)
+        # only the root is browsed again
+        self.assertEqual(report['requests'], 1)
+        self.assertEqual(skipped, dict(folders=1, requests=4))
+
+    def test_recrawl_removed_subfolder(self):
+        self.ingest()
+        # /a/c/ is removed with its subtree, and /a/ is listed with a new date
+        del self.listings['/a/c/'], self.listings['/a/c/d/']
+        self.listings['/a/'].pop()
+        self.listings['/'][0]['lmd'] = '2021/01/01 00:00:00'
+        report, skipped = self.ingest(recrawl=True)
+        self.assertEqual(skipped, dict(folders=1, requests=1))
+        self.assertEqual(self.paths(), {'/', '/x', '/a/', '/a/b/', '/a/b/y'})
+
+    def test_recrawl_in_batches(self):
+        self.ingest(batch_size=1)
+        self.assertEqual(self.cursor.execute('''SELECT size FROM folders WHERE path = "/a/"''').fetchone(), (2,))
+        # entries seen in an earlier batch of a folder are not taken for vanished
+        self.listings['/'].insert(0, listing('w', False))
+        self.listings['/'][1]['lmd'] = '2021/01/01 00:00:00'
+        del self.listings['/a/b/']
+        self.listings['/a/'].pop(0)
+        self.ingest(recrawl=True, batch_size=1)
+        self.assertEqual(self.paths(), {'/', '/w', '/x', '/a/', '/a/c/', '/a/c/d/', '/a/c/d/z'})
+
+    def test_recrawl_without_metadata(self):
+        self.listings['/'].append(listing('e', True))
+        self.listings['/e/'] = [listing('w', False)]
+        self.ingest()
+        # folders listed without date or size are browsed, and pending in the database
+        # until they are, so those dropped by a full frontier are still browsed
+        for file_info in self.listings['/']:
+            if file_info['is_dir']:
+                del file_info['lmd']
+        self.listings['/e/'].append(listing('v', False))
+        report, _ = self.ingest(recrawl=True, frontier_size=1)
+        self.assertIn('/e/v', self.paths())
+
+
+class TestIngestLocal(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for path in ('x', 'a/y', 'a/b/z', 'c/d/w', 'e/v'):
+            os.makedirs(os.path.dirname(os.path.join(self.root, 'tree', path)), exist_ok=True)
+            open(os.path.join(self.root, 'tree', path), 'w').close()
+        self.folder = os.path.join(self.root, 'tree') + '/'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def ingest(self, name, sharded=False, files=5, **kwargs):
+        import os
+        from idrive.db_sqlite import db_connect, db_create, db_cursor_insert_files, db_folder_row
+        from idrive.frontier import Frontier
+        from idrive.ingest import ingest_local, ingest_sharded
+        db_path = os.path.join(self.root, name)
+        db_create(db_path)
+        cursor = db_connect(db_path).cursor()
+        db_cursor_insert_files(cursor, [db_folder_row(self.folder, host='h')])
+        if sharded:
+            # a shard left by an interrupted run is resumed and merged first
+            db_create(db_path + '.shard-0009.db')
+            shard = db_connect(db_path + '.shard-0009.db')
+            db_cursor_insert_files(shard.cursor(), [db_folder_row(self.folder + 'a/', host='h')])
+            shard.commit()
+            shard.close()
+            stats = ingest_sharded(cursor, db_path, self.folder, 'h', processes=2, shards=2, workers=2)
+        else:
+            stats = ingest_local(cursor, Frontier(cursor=cursor, host='h'), 'h', workers=2, **kwargs)
+        self.assertEqual(stats.report()['files'], files)
+        rows = cursor.execute('''SELECT folder, filename, code, ino, size, mtime_ns FROM files ORDER BY folder, filename''').fetchall()
+        cursor.connection.close()
+        return rows
+
+    def test_ingest_local(self):
+        self.assertEqual(len(self.ingest('plain.db')), 11)
+
+    def test_ingest_sharded(self):
+        import os
+        self.assertEqual(self.ingest('sharded.db', sharded=True), self.ingest('plain.db'))
+        self.assertEqual([path for path in os.listdir(self.root) if '.shard-' in path], [])
+
+    def test_ingest_local_in_batches(self):
+        self.assertEqual(self.ingest('batched.db', batch_size=1, max_memory=1), self.ingest('plain.db'))
+
+    def test_incremental_in_batches(self):
+        import os
+        from idrive.db_sqlite import FileStatus, db_connect
+        from idrive.frontier import Frontier
+        from idrive.ingest import ingest_local
+        for i in range(4):
+            open(os.path.join(self.folder, f'f{i}'), 'w').close()
+        self.ingest('incremental.db', files=9)
+        # files removed since the last scan are deleted once all batches are listed
+        for i in range(3):
+            os.remove(os.path.join(self.folder, f'f{i}'))
+        cursor = db_connect(os.path.join(self.root, 'incremental.db')).cursor()
+        cursor.execute('''UPDATE folders SET code = ? WHERE path = ?''', (FileStatus.DEFAULT, self.folder))
+        ingest_local(cursor, Frontier(cursor=cursor, host='h'), 'h', workers=2, incremental=True, batch_size=1)
+        rows = cursor.execute('''SELECT filename FROM files WHERE folder = ? AND filename != ""''', (self.folder,)).fetchall()
+        self.assertEqual(sorted(rows), [('f3',), ('x',)])
+        cursor.connection.close()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import tempfile
+import unittest
+
+from helpers import create_index_db
+
+
+class TestMetrics(unittest.TestCase):
+    def tearDown(self):
+        from idrive import metrics
+        metrics.metrics_enable(False)
+        metrics.metrics_reset()
+
+    def histograms(self, report):
+        return {(h['name'], tuple(h['labels'].values())): h for h in report['histograms']}
+
+    def test_disabled(self):
+        from idrive import metrics
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        cursor = create_index_db().cursor()
+        db_cursor_insert_files(cursor, [db_folder_row('/a', host='h')])
+        metrics.metrics_count('test_items')
+        report = metrics.metrics_report()
+        self.assertEqual((report['counters'], report['histograms']), ([], []))
+
+    def test_enabled(self):
+        from idrive import metrics
+        from idrive.db_sqlite import db_cursor_insert_files, db_folder_row
+        cursor = create_index_db().cursor()
+        metrics.metrics_enable()
+        db_cursor_insert_files(cursor, [db_folder_row('/b', host='h')])
+        with metrics.MetricsTimer('test_seconds', kind='block'):
+            pass
+        metrics.metrics_count('test_items', 3)
+        histograms = self.histograms(metrics.metrics_report())
+        self.assertEqual(histograms[('db_seconds', ('db_cursor_insert_files',))]['count'], 1)
+        self.assertEqual(histograms[('test_seconds', ('block',))]['count'], 1)
+
+    def test_prometheus(self):
+        from idrive import metrics
+        metrics.metrics_enable()
+        metrics.metrics_count('test_items', 3)
+        metrics.metrics_observe('test_seconds', 0.002, kind='block')
+        text = metrics.metrics_prometheus(metrics.metrics_report(), job='test')
+        self.assertIn('idrive_test_items_total{job="test"} 3\n', text)
+        self.assertIn('idrive_test_seconds_bucket{kind="block",le="0.001",job="test"} 0\n', text)
+        self.assertIn('idrive_test_seconds_bucket{kind="block",le="+Inf",job="test"} 1\n', text)
+
+    def test_finish(self):
+        from idrive import metrics
+        parser = argparse.ArgumentParser()
+        metrics.metrics_add_arguments(parser)
+        with tempfile.TemporaryDirectory() as root:
+            stats, prometheus = os.path.join(root, 'stats.json'), os.path.join(root, 'idrive.prom')
+            args = parser.parse_args(['--stats', stats, '--prometheus', prometheus])
+            metrics.metrics_start(args)
+            metrics.metrics_count('test_items')
+            metrics.metrics_finish(args, job='test')
+            with open(stats) as f:
+                self.assertEqual(json.load(f)['counters'], [dict(name='test_items', labels=dict(), value=1)])
+            with open(prometheus) as f:
+                self.assertIn('idrive_test_items_total{job="test"} 1\n', f.read())
+            self.assertEqual(sorted(os.listdir(root)), ['idrive.prom', 'stats.json'])
+
+    def test_over_memory(self):
+        from idrive import metrics
+        metrics.metrics_enable()
+        self.assertGreater(metrics.metrics_peak_rss(), 0)
+        self.assertFalse(metrics.metrics_over_memory(None))
+        self.assertFalse(metrics.metrics_over_memory(1 << 50))
+        self.assertTrue(metrics.metrics_over_memory(1))
+        self.assertEqual(metrics.metrics_report()['counters'], [dict(name='memory_throttled', labels=dict(), value=1)])
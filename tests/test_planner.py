@@ -0,0 +1,39 @@
+import unittest
+
+from helpers import create_index_db
+
+
+class TestPlanBatches(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_insert_files, db_file_row
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [db_file_row('/a', f's{i}', host='h', size=10, mtime=100 - i) for i in range(5)] + [
+            db_file_row('/a', 'huge', host='h', size=1000, mtime=50),
+            db_file_row('/b', 'old', host='h', size=30, mtime=1),
+            db_file_row('/b', 'clean', host='h', size=30, mtime=1),
+            db_file_row('/c', 'big', host='h', size=500, mtime=2),
+        ])
+        self.cursor.execute('''UPDATE entries SET code = ? WHERE filename != "clean"''', (FileStatus.DIRTY,))
+
+    def test_plan_batches(self):
+        from idrive.planner import plan_batches
+        batches = list(plan_batches(self.cursor, 'h', batch_bytes=25, huge_size=100))
+        self.assertEqual([(batch.folder, [name for name, _ in batch.files], batch.bytes) for batch in batches], [
+            ('/a/', ['huge'], 1000), ('/a/', ['s0', 's1'], 20), ('/a/', ['s2', 's3'], 20), ('/a/', ['s4'], 10),
+            ('/b/', ['old'], 30), ('/c/', ['big'], 500)])
+        self.assertEqual([batch.number for batch in batches], [1, 2, 3, 4, 5, 6])
+
+    def test_batch_files(self):
+        from idrive.planner import plan_batches
+        batches = list(plan_batches(self.cursor, 'h', batch_files=2, huge_size=100))
+        self.assertEqual([len(batch.files) for batch in batches if batch.folder == '/a/'], [1, 2, 2, 1])
+
+    def test_budget(self):
+        from idrive.planner import plan_batches, PlanStats
+        stats = PlanStats()
+        # oldest first, within a budget
+        batches = list(plan_batches(self.cursor, 'h', priority='age', batch_bytes=25, huge_size=100, budget=560, stats=stats))
+        self.assertEqual([batch.folder for batch in batches], ['/b/', '/c/', '/a/', '/a/'])
+        self.assertEqual([[name for name, _ in batch.files] for batch in batches[2:]], [['s4', 's3'], ['s2']])
+        report = stats.report()
+        self.assertEqual((report['bytes'], report['deferred_files'], report['deferred_bytes']), (560, 3, 1020))
@@ -0,0 +1,41 @@
+import io
+import json
+import sqlite3
+import unittest
+
+
+class TestQueryFiles(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import create_table
+        self.cursor = sqlite3.connect(':memory:').cursor()
+        create_table(self.cursor, 'ibfolder')
+        create_table(self.cursor, 'ibfile')
+        self.cursor.executemany('''INSERT INTO ibfolder (DIRID, NAME) VALUES (?, ?)''', [(1, "'/a/'"), (2, "'/a/b/'"), (3, "'/c/'")])
+        self.cursor.executemany('''INSERT INTO ibfile (FILEID, DIRID, NAME, FILE_SIZE, FILE_LMD, BACKUP_STATUS) VALUES (?, ?, ?, ?, ?, ?)''', [
+            (1, 1, "'x'", 10, '2024-01-01 00:00:00', 1),
+            (2, 2, "'y'", 20, '2024-02-01 00:00:00', 0),
+            (3, 3, "'it''s'", 30, '2024-03-01 00:00:00', 1),
+            (4, 3, "'", 40, '2024-04-01 00:00:00', 1),
+        ])
+
+    def query(self, **kwargs):
+        from idrive.db_sqlite import idrive_db_query_files
+        return sorted(idrive_db_query_files(self.cursor, **kwargs).fetchall())
+
+    def test_paths(self):
+        # a lone quote is stripped once
+        self.assertEqual(self.query(), [('/a/b/y',), ('/a/x',), ('/c/',), ("/c/it''s",)])
+
+    def test_filters(self):
+        self.assertEqual(self.query(columns=('name', 'size'), folder='/a/'), [('x', 10), ('y', 20)])
+        self.assertEqual(self.query(min_size=20, max_size=30, status=(1,)), [("/c/it''s",)])
+        self.assertEqual(self.query(columns=('folder',), min_mtime='2024-02-01', max_mtime='2024-03-01'), [('/a/b/',)])
+
+    def test_query_write(self):
+        from idrive.db_sqlite import idrive_db_query_files
+        from idrive.query import query_write
+        columns = ('name', 'size')
+        stream = io.StringIO()
+        count = query_write(idrive_db_query_files(self.cursor, columns=columns, folder='/a/'), columns, stream, format='ndjson', batch_size=1)
+        self.assertEqual(count, 2)
+        self.assertEqual(sorted(map(json.loads, stream.getvalue().splitlines()), key=str), [dict(name='x', size=10), dict(name='y', size=20)])
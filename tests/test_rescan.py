@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from helpers import create_index_db
+
+
+class TestMarkChangedFolders(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_insert_files, db_file_row, db_folder_row, db_cursor_update_folder_stat, db_cursor_update_folder_status
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folders = [os.path.join(self.tmp.name, name) + '/' for name in ('same', 'changed', 'vanished')]
+        for folder in self.folders:
+            os.mkdir(folder)
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [db_folder_row(folder, host='h') for folder in self.folders])
+        for folder in self.folders:
+            db_cursor_update_folder_stat(self.cursor, folder, os.stat(folder), host='h')
+            db_cursor_update_folder_status(self.cursor, folder, FileStatus.SCANNED, host='h')
+        # a subfolder of the vanished folder, never scanned, with a file
+        db_cursor_insert_files(self.cursor, [
+            db_folder_row(self.folders[2] + 'sub/', host='h'),
+            db_file_row(self.folders[2] + 'sub/', 'x', host='h', size=1, mtime=0),
+        ])
+        open(os.path.join(self.folders[1], 'new'), 'w').close()
+        os.rmdir(self.folders[2])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_mark_changed_folders(self):
+        from idrive.db_sqlite import FileStatus
+        from idrive.rescan import mark_changed_folders
+        report = mark_changed_folders(self.cursor, 'h', workers=2)
+        self.assertEqual((report['checked'], report['changed'], report['vanished']), (3, 1, 1))
+        rows = self.cursor.execute('''SELECT folder, filename, code FROM files ORDER BY folder''').fetchall()
+        # the vanished folder is deleted with its whole subtree
+        self.assertEqual(rows, [(self.folders[1], '', FileStatus.DEFAULT), (self.folders[0], '', FileStatus.SCANNED)])
+
+    def test_failed_folders_are_rescanned(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_update_folder_status, db_cursor_select_folder_status
+        from idrive.rescan import mark_changed_folders
+        db_cursor_update_folder_status(self.cursor, self.folders[0], FileStatus.ERROR, host='h')
+        report = mark_changed_folders(self.cursor, 'h', workers=2)
+        self.assertEqual(report['changed'], 2)
+        self.assertEqual(db_cursor_select_folder_status(self.cursor, self.folders[0], host='h'), FileStatus.DEFAULT)
+
+    def test_commit_is_left_to_the_caller(self):
+        from idrive.rescan import mark_changed_folders
+        self.cursor.connection.commit()
+        mark_changed_folders(self.cursor, 'h', workers=2)
+        self.assertTrue(self.cursor.connection.in_transaction)
+        self.cursor.connection.rollback()
+        self.assertEqual(self.cursor.execute('''SELECT COUNT(*) FROM files''').fetchone()[0], 5)
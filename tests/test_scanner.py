@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name + '/'
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        for path in ('x', 'a/y', 'a/b/z', '.hidden'):
+            open(os.path.join(self.root, path), 'w').close()
+        os.symlink('a', os.path.join(self.root, 'link'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_tree(self):
+        from idrive.scanner import scan_tree
+        results = {result.folder: result for result in scan_tree([self.root], workers=2)}
+        self.assertEqual(sorted(results), [self.root, self.root + 'a/', self.root + 'a/b/'])
+        self.assertEqual([name for name, _ in results[self.root + 'a/b/'].files], ['z'])
+
+    def test_scan_folder_skips_dot_files_and_symlinks(self):
+        from idrive.scanner import scan_folder
+        result = scan_folder(self.root)
+        self.assertEqual([name for name, _ in result.files], ['x'])
+        self.assertEqual([name for name, _ in result.folders], ['a'])
+        # the symlink is counted as an entry, but neither listed nor followed
+        self.assertEqual(result.count, 3)
+        self.assertEqual(result.st_info.st_ino, os.stat(self.root).st_ino)
+
+    def test_scan_stats(self):
+        from idrive.scanner import scan_tree, ScanStats
+        stats = ScanStats()
+        list(scan_tree([self.root], workers=2, stats=stats))
+        report = stats.report()
+        self.assertEqual((report['folders'], report['files'], report['errors']), (3, 3, 0))
+        # only regular files and the folders themselves are stat-ed
+        self.assertEqual(report['stat_calls'], 6)
+
+    def test_scan_folder_error(self):
+        from idrive.scanner import scan_folder, ScanStats
+        stats = ScanStats()
+        result = scan_folder(self.root + 'missing/', stats)
+        self.assertIsInstance(result.error, OSError)
+        self.assertEqual((result.files, result.folders), ([], []))
+        self.assertEqual(stats.report()['errors'], 1)
+
+    def test_scan_folder_iter_batches(self):
+        from idrive.scanner import scan_folder_iter, ScanStats
+        for i in range(6):
+            open(os.path.join(self.root, f'f{i}'), 'w').close()
+        stats = ScanStats()
+        results = list(scan_folder_iter(self.root, stats=stats, batch_size=3))
+        self.assertEqual([len(result.files) + len(result.folders) for result in results], [3, 3, 2])
+        self.assertEqual([result.done for result in results], [False, False, True])
+        self.assertEqual(results[-1].count, 9)
+        report = stats.report()
+        self.assertEqual((report['folders'], report['files'], report['stat_calls']), (1, 7, 8))
+
+    def test_scan_tree_max_memory(self):
+        from idrive.scanner import scan_tree
+        # past max_memory, folders are still all scanned, one at a time
+        results = list(scan_tree([self.root], workers=2, batch_size=1, max_memory=1))
+        self.assertEqual(sorted(result.folder for result in results if result.done), [self.root, self.root + 'a/', self.root + 'a/b/'])
+        self.assertEqual(max(len(result.files) + len(result.folders) for result in results), 1)
+
+    def test_hardlinks(self):
+        from idrive.scanner import scan_tree, InodeCache, ScanStats
+        os.link(os.path.join(self.root, 'x'), os.path.join(self.root, 'a', 'b', 'w'))
+        stats, inodes = ScanStats(), InodeCache()
+        results = {result.folder: result for result in scan_tree([self.root], workers=1, stats=stats, inodes=inodes)}
+        report = stats.report()
+        # the second link of x is not stat-ed
+        self.assertEqual((report['files'], report['links'], report['stat_calls']), (4, 1, 6))
+        files = dict(results[self.root].files + results[self.root + 'a/b/'].files)
+        self.assertEqual(files['x'].st_ino, files['w'].st_ino)
+
+    def test_inode_cache_size(self):
+        from idrive.scanner import InodeCache
+        inodes = InodeCache(max_size=1)
+        os.link(os.path.join(self.root, 'x'), os.path.join(self.root, 'x2'))
+        os.link(os.path.join(self.root, 'a/y'), os.path.join(self.root, 'y2'))
+        x, y, z = (os.stat(os.path.join(self.root, path)) for path in ('x', 'a/y', 'a/b/z'))
+        inodes.add(z)
+        self.assertIsNone(inodes.get(z.st_dev, z.st_ino))
+        inodes.add(x)
+        inodes.add(y)
+        self.assertIsNone(inodes.get(x.st_dev, x.st_ino))
+        self.assertEqual(inodes.get(y.st_dev, y.st_ino), y)
@@ -0,0 +1,145 @@
+import unittest
+
+from helpers import create_index_db
+
+
+class TestSyncDevice(unittest.TestCase):
+    def setUp(self):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row
+        self.cursor = create_index_db().cursor()
+        db_cursor_insert_files(self.cursor, [
+            db_file_row('/l', 'same', host='local', size=1, mtime=0),
+            db_file_row('/l', 'resized', host='local', size=2, mtime=0),
+            db_file_row('/l', 'new', host='local', size=3, mtime=0),
+            db_file_row('/r', 'same', host='remote', device_id='d1', size=1, mtime=0),
+            db_file_row('/r', 'resized', host='remote', device_id='d2', size=20, mtime=0),
+            db_file_row('/r', 'new', host='remote', device_id='d3', size=3, mtime=0),
+        ])
+
+    def dirty(self):
+        from idrive.db_sqlite import FileStatus
+        return [filename for filename, in self.cursor.execute('''SELECT filename FROM files WHERE code = ? ORDER BY filename''', (FileStatus.DIRTY,))]
+
+    def test_sync_device(self):
+        from idrive.sync import sync_device
+        report = sync_device(self.cursor, 'local', '', 'remote', ['d1', 'd2'])
+        self.assertEqual((report['examined'], report['dirty']), (3, 2))
+        # a match on a device not synced with does not count
+        self.assertEqual(self.dirty(), ['new', 'resized'])
+
+    def test_dry_run(self):
+        from idrive.sync import sync_device
+        report = sync_device(self.cursor, 'local', '', 'remote', ['d1', 'd2'], dry_run=True)
+        self.assertEqual((report['examined'], report['dirty']), (3, 2))
+        self.assertEqual(self.dirty(), [])
+
+    def test_only_default_files(self):
+        from idrive.sync import sync_device
+        sync_device(self.cursor, 'local', '', 'remote', ['d1', 'd2'])
+        report = sync_device(self.cursor, 'local', '', 'remote', ['d1', 'd2'])
+        self.assertEqual((report['examined'], report['dirty']), (1, 0))
+
+
+class TestSyncHardlinks(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row
+        self.cursor = create_index_db().cursor()
+        with tempfile.TemporaryDirectory() as root:
+            for name, size in (('a', 10), ('c', 5)):
+                with open(os.path.join(root, name), 'wb') as f:
+                    f.write(b'.' * size)
+            os.link(os.path.join(root, 'a'), os.path.join(root, 'b'))
+            db_cursor_insert_files(self.cursor, [db_file_row(root, name, host='h', st_info=os.stat(os.path.join(root, name))) for name in 'abc'])
+
+    def test_file_totals(self):
+        from idrive.db_sqlite import db_cursor_select_file_totals
+        self.assertEqual(db_cursor_select_file_totals(self.cursor, host='h'), dict(files=3, bytes=25, unique_files=2, unique_bytes=15))
+
+    def test_match_of_a_link(self):
+        from idrive.db_sqlite import FileStatus, db_cursor_insert_files, db_file_row
+        from idrive.sync import sync_device
+        # a remote match of one link matches all of them
+        db_cursor_insert_files(self.cursor, [db_file_row('/r', 'b', host='remote', size=10, mtime=0)])
+        report = sync_device(self.cursor, 'h', '', 'remote', [''])
+        self.assertEqual((report['dirty'], report['dirty_bytes'], report['dirty_unique_bytes']), (1, 5, 5))
+        dirty = self.cursor.execute('''SELECT filename FROM files WHERE code = ?''', (FileStatus.DIRTY,)).fetchall()
+        self.assertEqual(dirty, [('c',)])
+
+
+class TestSyncMoves(unittest.TestCase):
+    def setUp(self):
+        self.cursor = create_index_db().cursor()
+
+    def insert(self, rows, md5s=()):
+        from idrive.db_sqlite import db_cursor_insert_files, db_file_row
+        db_cursor_insert_files(self.cursor, [db_file_row(folder, filename, host=host, size=size, mtime=mtime) for host, folder, filename, size, mtime in rows])
+        self.cursor.executemany('''UPDATE entries SET md5 = ? WHERE filename = ?''', [(md5, filename) for filename, md5 in md5s])
+
+    def codes(self):
+        return dict(self.cursor.execute('''SELECT filename, code FROM files WHERE host = "local" AND filename != ""'''))
+
+    def test_moved_files(self):
+        from idrive.db_sqlite import FileStatus
+        from idrive.sync import sync_device
+        self.insert([
+            ('local', '/l', 'renamed', 100, 1000.5),
+            ('local', '/l', 'hashed', 200, 5),
+            ('local', '/l', 'clash', 300, 7),
+            ('local', '/l', 'empty', 0, 9),
+            ('local', '/l', 'new', 100, 3000),
+            ('remote', '/r', 'original', 100, 1000),
+            ('remote', '/r', 'moved', 200, 8),
+            ('remote', '/r', 'clash', 300, 7),
+            ('remote', '/r', 'blank', 0, 9),
+        ], md5s=[('hashed', 'a'), ('moved', 'a'), ('clash', 'b')])
+        self.cursor.execute('''UPDATE entries SET md5 = "c" WHERE filename = "clash" AND folder_id = (SELECT id FROM folders WHERE path = "/r/")''')
+        report = sync_device(self.cursor, 'local', '', 'remote', [''], dry_run=True)
+        self.assertEqual((report['moved'], report['moved_bytes'], report['dirty']), (2, 300, 3))
+        report = sync_device(self.cursor, 'local', '', 'remote', [''])
+        self.assertEqual((report['moved'], report['dirty']), (2, 3))
+        self.assertEqual(self.codes(), dict(renamed=FileStatus.MOVED, hashed=FileStatus.MOVED, clash=FileStatus.DIRTY,
+            empty=FileStatus.DIRTY, new=FileStatus.DIRTY))
+
+    def test_no_moves(self):
+        from idrive.db_sqlite import FileStatus
+        from idrive.sync import sync_device
+        self.insert([('local', '/l', 'renamed', 100, 1000), ('remote', '/r', 'original', 100, 1000)])
+        report = sync_device(self.cursor, 'local', '', 'remote', [''], moves=False)
+        self.assertEqual((report['moved'], report['dirty']), (0, 1))
+        self.assertEqual(self.codes(), dict(renamed=FileStatus.DIRTY))
+
+    def test_copies(self):
+        from idrive.db_sqlite import FileStatus
+        from idrive.sync import sync_device
+        self.insert([
+            ('local', '/l', 'a', 100, 1000),
+            ('local', '/l/copies', 'b', 100, 1000),
+            ('local', '/l/copies', 'c', 100, 1000),
+            ('local', '/l', 'd', 200, 2000),
+            ('local', '/l', 'e', 200, 2000),
+            ('remote', '/r', 'a', 100, 1000),
+            ('remote', '/r', 'gone', 200, 2000),
+        ])
+        # a remote file still backing up a local file is no move, and a
+        # remote file gone locally stands for one local file only
+        for dry_run in (True, False):
+            report = sync_device(self.cursor, 'local', '', 'remote', [''], dry_run=dry_run)
+            self.assertEqual((report['moved'], report['dirty']), (1, 3))
+        self.assertEqual(self.codes(), dict(a=FileStatus.DEFAULT, b=FileStatus.DIRTY, c=FileStatus.DIRTY, d=FileStatus.MOVED, e=FileStatus.DIRTY))
+
+    def test_shared_candidate(self):
+        from idrive.db_sqlite import FileStatus
+        from idrive.sync import sync_device
+        self.insert([
+            ('local', '/l', 'l0', 100, 1000),
+            ('local', '/l', 'l1', 100, 1000),
+            ('remote', '/r', 'r0', 100, 50),
+            ('remote', '/r', 'r1', 100, 1000),
+        ], md5s=[('l0', 'a'), ('r0', 'a')])
+        # l0 pairs with r0 by md5 though r1 takes it first by mtime, which leaves r1 to l1
+        for dry_run in (True, False):
+            report = sync_device(self.cursor, 'local', '', 'remote', [''], dry_run=dry_run)
+            self.assertEqual((report['moved'], report['dirty']), (2, 0))
+        self.assertEqual(self.codes(), dict(l0=FileStatus.MOVED, l1=FileStatus.MOVED))